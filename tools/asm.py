@@ -55,6 +55,9 @@ class ASM:
 
   ID_CNT = 0
 
+  # number of macros expanded by to_list(), used for statistics
+  MACRO_CNT = 0
+
   @classmethod
   def set_compat(cls, compat):
     if compat:
@@ -99,6 +102,7 @@ class ASM:
     # insert macros
     for macro_name, macro_asm in macros.items():
       if macro_name in txt:
+        ASM.MACRO_CNT += txt.count(macro_name)
         txt = txt.replace(macro_name, macro_asm)
 
     if not comments:
@@ -1,68 +1,444 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
+import json
 import click
+import time
+import pickle
+import hashlib
+import tempfile
+from array import array
 from collections import Counter
 
+from firmware import FORMAT_HACK, FORMAT_CHOICES, EBR_ROM_WORDS, write_firmware_file
+from instrument import Stats, profiled
+from sourcemap import SourceMap
+
 OPT_LOADS = 'loads'
 OPT_CONSEC_NOPS = 'consec_nops'
 OPT_UNNEEDED_NOPS = 'unneeded_nops'
 OPT_MULTIDEST_ASSIGNMENT = 'multidest_assignment'
+OPT_DEAD_STORES = 'dead_stores'
+OPT_PEEPHOLE = 'peephole'
+OPT_JUMP_THREADING = 'jump_threading'
+OPT_UNREACHABLE = 'unreachable'
+OPT_CONSTANTS = 'constants'
+OPT_SCHEDULE = 'schedule'
 OPT_ALL = 'all'
 OPT_CHOICES=(OPT_ALL,
              OPT_LOADS,
              OPT_CONSEC_NOPS,
              OPT_UNNEEDED_NOPS,
-             OPT_MULTIDEST_ASSIGNMENT)
+             OPT_MULTIDEST_ASSIGNMENT,
+             OPT_DEAD_STORES,
+             OPT_PEEPHOLE,
+             OPT_JUMP_THREADING,
+             OPT_UNREACHABLE,
+             OPT_CONSTANTS,
+             OPT_SCHEDULE)
+
+# maps optimisation pass names to functions taking (assembler, instructions). See
+# register_optimisation_pass()
+OPTIMISATION_PASSES = {}
+
+# passes, in order, run when OPT_ALL is selected
+DEFAULT_OPTIMISATION_PIPELINE = []
+
+# maximum number of times the optimisation pipeline is repeated when iterating to a fixpoint
+OPT_MAX_ITERATIONS = 16
+
+# how many instructions either side of a NOP the scheduler looks at for something to fill it with
+SCHEDULE_WINDOW = 4
+
+# hazard models, see HazardModel
+HAZARD_INVERTED_CLOCK = 'inverted_clock'
+HAZARD_ORIGINAL = 'original'
+HAZARD_IDEAL = 'ideal'
+HAZARD_CHOICES = (HAZARD_INVERTED_CLOCK,
+                  HAZARD_ORIGINAL,
+                  HAZARD_IDEAL)
+DEFAULT_HAZARD_MODEL = HAZARD_INVERTED_CLOCK
+
+# kinds of symbol in a SymbolTable
+SYMBOL_PREDEFINED = 'predefined'
+SYMBOL_LABEL = 'label'
+SYMBOL_VARIABLE = 'variable'
+SYMBOL_CONSTANT = 'constant'
+
+# symbols may only contain these characters, see Assembler._validate_symbol()
+SYMBOL_RE = re.compile(r'[\w.:]+')
+
+# characters a numeric constant can start with
+NUMERIC_START = frozenset('0123456789+-')
+
+# identifies relocatable object files, see ObjectModule. Bump the version whenever the format
+# changes
+OBJECT_FORMAT = 'hackobj'
+OBJECT_FORMAT_VERSION = 2
+
+# a SizeReport warns once a program uses this fraction of the ROM
+ROM_BUDGET_WARNING = 0.9
+
+# name a SizeReport gives code which is not in a func_/sub_ block or VM function
+SIZE_REPORT_TOP_LEVEL = '<top level>'
+
+# annotation vm2asm.py -A writes before each VM function
+VM_FUNCTION_ANNOTATION_RE = re.compile(r'// FUNCTION (\S+)')
+
+def register_optimisation_pass(name, func, default=True):
+  """
+  Registers an optimisation pass which can then be selected by name. func is called with the
+  Assembler instance and the list of instructions and should remove instructions by setting
+  their emit attribute to False. It may return True to indicate it modified the program without
+  removing any instructions, which matters when iterating to a fixpoint.
+
+  If default is True the pass is appended to DEFAULT_OPTIMISATION_PIPELINE.
+  """
+  OPTIMISATION_PASSES[name] = func
+  if default:
+    DEFAULT_OPTIMISATION_PIPELINE.append(name)
 
 NO_JUMP = 'NOJUMP'
 
+# bump whenever the format of cache entries, or how blocks are parsed and optimised, changes
+ASSEMBLY_CACHE_VERSION = 11
+
+# c1..c6 of the C-instruction, written with A as the x input of the ALU
+COMP_TABLE = {
+    '0'     : 0b101010,
+    '1'     : 0b111111,
+    '-1'    : 0b111010,
+    'D'     : 0b001100,
+    'A'     : 0b110000,
+    '!D'    : 0b001101,
+    '!A'    : 0b110001,
+    '-D'    : 0b001111,
+    '-A'    : 0b110011,
+    'D+1'   : 0b011111,
+    'A+1'   : 0b110111,
+    'D-1'   : 0b001110,
+    'A-1'   : 0b110010,
+    'D+A'   : 0b000010,
+    'D-A'   : 0b010011,
+    'A-D'   : 0b000111,
+    'D&A'   : 0b000000,
+    'D|A'   : 0b010101,
+}
+
+# j1..j3 of the C-instruction
+JUMP_TABLE = {
+    NO_JUMP : 0b000,
+    'JGT'   : 0b001,
+    'JEQ'   : 0b010,
+    'JGE'   : 0b011,
+    'JLT'   : 0b100,
+    'JNE'   : 0b101,
+    'JLE'   : 0b110,
+    'JMP'   : 0b111,
+}
+
+# whether each jump is taken given the ALU result
+JUMP_CONDITIONS = {
+    'JGT'   : lambda v: v > 0,
+    'JEQ'   : lambda v: v == 0,
+    'JGE'   : lambda v: v >= 0,
+    'JLT'   : lambda v: v < 0,
+    'JNE'   : lambda v: v != 0,
+    'JLE'   : lambda v: v <= 0,
+    'JMP'   : lambda v: True,
+}
+
+# the jump taken when the condition of each jump is not met
+INVERTED_JUMPS = {
+    'JGT'   : 'JLE',
+    'JEQ'   : 'JNE',
+    'JGE'   : 'JLT',
+    'JLT'   : 'JGE',
+    'JNE'   : 'JEQ',
+    'JLE'   : 'JGT',
+}
+
+# computations whose result is known at assembly time
+CONSTANT_COMPS = {'0': 0, '1': 1, '-1': -1}
+
+# the computation which produces each 16 bit value, if there is one
+CONSTANT_VALUE_COMPS = {0: '0', 1: '1', 0xFFFF: '-1'}
+
+# registers tracked by liveness analysis. M is memory and writes to it are never dead
+REGISTERS = 'ADW'
+
+# d1..d4 of the C-instruction, in the order they appear in canonical dest strings
+DEST_REGISTERS = 'ADMW'
+
+def _build_c_encoding_table():
+  """
+  Returns a dict mapping every legal (dest, comp, jump) combination to its integer machine code.
+  dest is the canonical form, i.e. the destination registers in DEST_REGISTERS order without
+  separators, e.g. 'AD', 'DM'.
+
+  comp covers every HACK computation, their M and W variants as well as commuted forms of
+  commutative operations, e.g. A+D as well as D+A.
+  """
+  comps = {}
+  for comp, c1_c6 in COMP_TABLE.items():
+    variants = [comp]
+    # for some operation the ordering doesn't matter so we will accept D+A and A+D even though
+    # only D+A is defined in the comp table
+    if len(comp) == 3 and comp[1] in '+|&':
+      variants.append(comp[::-1])
+
+    for variant in variants:
+      comps[variant] = (0, 0, c1_c6)
+      if 'A' in variant:
+        comps[variant.replace('A', 'M')] = (1, 0, c1_c6)
+        comps[variant.replace('A', 'W')] = (0, 1, c1_c6)
+
+  dests = {}
+  for bits in range(16):
+    dest = ''.join(r for i, r in enumerate(DEST_REGISTERS) if bits & (1 << i))
+    d1 = int('A' in dest)
+    d2 = int('D' in dest)
+    d3 = int('M' in dest)
+    d4 = int('W' in dest)
+    dests[dest] = (d1, d2, d3, d4)
+
+  table = {}
+  for dest, (d1, d2, d3, d4) in dests.items():
+    for comp, (a, w, c1_c6) in comps.items():
+      for jump, j1_j3 in JUMP_TABLE.items():
+        # w and d4 are inverted so HACK programs run unmodified on HACKx
+        table[(dest, comp, jump)] = (1 << 15 |
+                                     (1 - w) << 14 |
+                                     (1 - d4) << 13 |
+                                     a << 12 |
+                                     c1_c6 << 6 |
+                                     d1 << 5 |
+                                     d2 << 4 |
+                                     d3 << 3 |
+                                     j1_j3)
+  return table
+
+C_ENCODING_TABLE = _build_c_encoding_table()
+
+# memoizes (dest, comp, jump) as written in the source to machine code so dest only needs to be
+# canonicalised once per distinct spelling
+_C_ENCODING_CACHE = {}
+
+# bits 14 and 13 are cleared when W is used as source or destination respectively
+HACKX_BITS = 0b0110_0000_0000_0000
+
+def format_machine_code(code, pretty_print=False):
+  """
+  Formats integer machine code as text suitable for use with $readmemb in verilog. When
+  pretty_print is True C-instructions have _ inserted between fields.
+  """
+  key = (code, pretty_print)
+  try:
+    return _FORMAT_CACHE[key]
+  except KeyError:
+    pass
+
+  txt = f'{code:016b}'
+  if pretty_print and code & 0x8000:
+    txt = f'{txt[0]}_{txt[1]}_{txt[2]}_{txt[3]}_{txt[4:10]}_{txt[10:13]}_{txt[13:]}'
+
+  # programs reuse the same machine code a lot so share the formatted text
+  _FORMAT_CACHE[key] = txt
+  return txt
+
+_FORMAT_CACHE = {}
+
 @click.command()
 @click.option('-i', '--input-asm', type=click.Path(dir_okay=False, exists=True),
               required=False,
               help='Input assembly file')
 @click.option('-o', '--output-hack', type=click.Path(dir_okay=False),
               help='Output hack file')
+@click.option('-f', '--output-format', type=click.Choice(FORMAT_CHOICES), default=FORMAT_HACK,
+              help='Format of the output. "hack" (default) is text for $readmemb, "bin-le" and '
+                   '"bin-be" are packed 16 bit words, "ihex" is Intel HEX, "hex" is text for '
+                   '$readmemh and "ebr" is a $readmemh/icebram image padded to the size of the '
+                   'EBR ROM')
 @click.option('-C', '--compat', is_flag=True,
               help='If runs in compatibility mode in which the output is '
                    'exactly produced by the reference Assembler written in '
                    'java')
+@click.option('-H', '--hazard-model', type=click.Choice(HAZARD_CHOICES),
+              help='Pipeline hazards of the hardware the program runs on, which decides where '
+                   'NOPs are needed. "inverted_clock" (default) is the RAM clocked on the falling '
+                   'edge, "original" the RAM sharing the CPU clock and "ideal" needs no NOPs, '
+                   'e.g. for simulation. Compatibility mode always uses "ideal"')
 @click.option('-P', '--pretty-print', is_flag=True,
               help='If given output will have _ inserted to make instructions '
                    'easier to read')
 @click.option('-A', '--annotate', is_flag=True,
               help='If given hack output will be annotated with source '
                    'lines or PC counts')
-@click.option('-O', '--optimise', type=click.Choice(OPT_CHOICES), default=None,
-              help='If given enables the specified optimisation. Defaults to "all".')
+@click.option('-O', '--optimise', type=click.Choice(OPT_CHOICES), multiple=True,
+              help='If given enables the specified optimisation. Can be given multiple times '
+                   'and passes are run in the order given. "all" runs all optimisations in the '
+                   'default order.')
+@click.option('--opt-fixpoint', is_flag=True,
+              help='If given the selected optimisations are repeated until they no longer '
+                   'change the program')
+@click.option('--print-opt-stats', is_flag=True,
+              help='If given statistics for each optimisation pass are printed to stderr')
 @click.option('--print-count', is_flag=True,
               help='If given the number of instructions, minus annotation '
                    'is printed to stderr')
+@click.option('--size-report', is_flag=True,
+              help='If given the size of each func_/sub_ block and VM function is printed to '
+                   'stderr, split into user instructions, NOPs and macros along with the '
+                   'instructions each optimisation removed')
+@click.option('--size-report-json', type=click.Path(dir_okay=False),
+              help='If given the size report is written as JSON to this file, - for stdout')
+@click.option('-m', '--source-map', type=click.Path(dir_okay=False),
+              help='If given a map of each PC to its line of the input is written to this file, '
+                   'see sourcemap.py')
+@click.option('--input-source-map', type=click.Path(dir_okay=False, exists=True),
+              help='Source map of the input, as written by vm2asm.py -m, which is included in '
+                   'the --source-map so PCs map to VM operations')
 @click.option('--print-symbols', is_flag=True,
               help='If given the symbol table will be printed to stderr')
+@click.option('--stats', 'print_stats', is_flag=True,
+              help='If given the time spent in each phase of assembly and counts of lines, '
+                   'macros and instructions are printed to stderr')
+@click.option('--stats-json', type=click.Path(dir_okay=False),
+              help='If given the phase timings and counts are written as JSON to this file, - '
+                   'for stdout')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help='If given assembly is run under cProfile and the profile written to this '
+                   'file, or the top functions printed to stderr if -')
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              help='If given parsed and optimised func_/sub_ blocks are cached in this directory '
+                   'and reused when unchanged')
+@click.option('--object', 'relocatable', is_flag=True,
+              help='If given a relocatable object file is written instead of machine code, to be '
+                   'linked with linker.py')
+@click.option('--stream', is_flag=True,
+              help='If given the input is assembled in streaming mode where memory use is '
+                   'proportional to the symbol table instead of the size of the source. '
+                   'Cannot be used with -O')
 def main(*args, **kwargs):
   print_count = kwargs.pop('print_count')
   print_symbols = kwargs.pop('print_symbols')
-
-  assembler = Assembler(*args, **kwargs)
-  assembler.assemble()
-  assembler.write_hack()
+  print_opt_stats = kwargs.pop('print_opt_stats')
+  stream = kwargs.pop('stream')
+  relocatable = kwargs.pop('relocatable')
+  size_report_json = kwargs.pop('size_report_json')
+  print_size_report = kwargs['size_report']
+  kwargs['size_report'] = print_size_report or size_report_json is not None
+  print_stats = kwargs.pop('print_stats')
+  stats_json = kwargs.pop('stats_json')
+  profile = kwargs.pop('profile')
+  source_map = kwargs.pop('source_map')
+  kwargs['source_map'] = source_map is not None
+  if kwargs['input_source_map'] is not None:
+    kwargs['input_source_map'] = SourceMap.read(kwargs['input_source_map'])
+
+  if stream and kwargs['optimise']:
+    raise click.UsageError('--stream cannot be used with -O')
+
+  if stream and kwargs['output_format'] != FORMAT_HACK:
+    raise click.UsageError('--stream can only be used with the hack output format')
+
+  if stream and kwargs['cache_dir'] is not None:
+    raise click.UsageError('--stream cannot be used with --cache-dir')
+
+  if kwargs['compat'] and kwargs['hazard_model'] not in (None, HAZARD_IDEAL):
+    raise click.UsageError('--compat can only be used with the ideal hazard model')
+
+  if relocatable and (stream or kwargs['cache_dir'] is not None):
+    raise click.UsageError('--object cannot be used with --stream or --cache-dir')
+
+  if relocatable and kwargs['output_format'] != FORMAT_HACK:
+    raise click.UsageError('--object cannot be used with -f')
+
+  if kwargs['size_report'] and (stream or relocatable):
+    raise click.UsageError('--size-report cannot be used with --stream or --object')
+
+  if source_map is not None and (stream or relocatable):
+    raise click.UsageError('--source-map cannot be used with --stream or --object')
+
+  stats = Stats(enabled=print_stats or stats_json is not None)
+  assembler = Assembler(*args, stats=stats, **kwargs)
+  with profiled(profile):
+    if stream:
+      assembler.assemble_stream()
+    elif relocatable:
+      assembler.assemble_object().write(kwargs['output_hack'])
+    else:
+      assembler.assemble()
+      assembler.write_output()
+      if source_map is not None:
+        assembler.source_map.write(source_map)
 
   def p(s):
     sys.stderr.write(s)
     sys.stderr.write('\n')
 
   if print_count:
-    p(f'Assembled {len(assembler.instructions)} instructions')
+    p(f'Assembled {assembler.num_instructions} instructions')
 
   if print_symbols:
     p('')
     p('SYMBOL TABLE')
-    p('='*(32+10+3))
+    p('='*(32+10+3+11))
     for sym, val in assembler.known_symbols.items():
-      p(f'{sym:32s} = {val:10d}')
+      p(f'{sym:32s} = {val:10d} {assembler.known_symbols.kind(sym):>10s}')
+    p('')
+
+  if print_opt_stats:
+    p('')
+    p('OPTIMISATION STATS')
+    p('='*(32+6+8+12+9))
+    p(f'{"PASS":32s} {"RUNS":>6s} {"REMOVED":>8s} {"TIME (ms)":>12s}')
+    for name, stats in assembler.optimisation_stats.items():
+      p(f'{name:32s} {stats["runs"]:6d} {stats["removed"]:8d} {stats["time"]*1000:12.3f}')
+    p('')
+
+    if assembler.unreachable_code:
+      p('UNREACHABLE CODE REMOVED')
+      p('='*(32+1+12))
+      for labels, count in assembler.unreachable_code:
+        name = ','.join(labels) or '<after jump>'
+        p(f'{name:32s} {count:12d}')
+      p('')
+
+  if print_size_report:
+    report = assembler.size_report.to_dict()
+    p('')
+    p('SIZE REPORT')
+    p('='*(40+5*8+5))
+    p(f'{"BLOCK":40s} {"TOTAL":>8s} {"USER":>8s} {"NOPS":>8s} {"MACRO":>8s} {"REMOVED":>8s}')
+    # largest first as that is where optimisation pays off most
+    for block in sorted(report['blocks'], key=lambda block: -block['total']):
+      removed = sum(block['removed'].values())
+      p(f'{block["name"]:40s} {block["total"]:8d} {block["user"]:8d} {block["nops"]:8d} '
+        f'{block["macro"]:8d} {removed:8d}')
+    p('-'*(40+5*8+5))
+    p(f'{"TOTAL":40s} {report["total"]:8d} {report["user"]:8d} {report["nops"]:8d} '
+      f'{report["macro"]:8d} {sum(report["removed"].values()):8d}')
+    p(f'ROM used: {report["total"]} of {report["rom_words"]} words '
+      f'({100*report["rom_used"]:.1f}%)')
+    if report['removed']:
+      p('')
+      p(f'{"REMOVED BY PASS":40s} {"COUNT":>8s}')
+      for name, count in sorted(report['removed'].items(), key=lambda item: -item[1]):
+        p(f'{name:40s} {count:8d}')
     p('')
 
+  if size_report_json is not None:
+    assembler.size_report.write_json(size_report_json)
+
+  if print_stats:
+    stats.print()
+
+  if stats_json is not None:
+    stats.write_json(stats_json)
+
 def _stderr_warn(warning):
   sys.stderr.write(f'[WARNING] {warning}\n')
 class Assembler:
@@ -112,47 +488,145 @@ class Assembler:
                compat=False,
                pretty_print=False,
                annotate=False,
-               optimise=None):
+               optimise=None,
+               output_format=FORMAT_HACK,
+               cache_dir=None,
+               opt_fixpoint=False,
+               hazard_model=None,
+               size_report=False,
+               stats=None,
+               source_map=False,
+               input_source_map=None):
+    """
+    :param optimise: name of an optimisation pass, or a sequence of them, to run in order. OPT_ALL
+                     expands to DEFAULT_OPTIMISATION_PIPELINE.
+    :param opt_fixpoint: when True the optimisation passes are repeated until they no longer
+                         change the program.
+    :param hazard_model: name of the HazardModel describing the hardware the program runs on,
+                         DEFAULT_HAZARD_MODEL if None. Compat mode always uses HAZARD_IDEAL.
+    :param size_report: when True a SizeReport of the program is kept in self.size_report. With
+                        cache_dir only blocks not found in the cache count towards the
+                        instructions removed by each optimisation pass.
+    :param stats: instrument.Stats recording the time spent in each phase of assembly and
+                  counts of what was assembled. Nothing is timed if None.
+    :param source_map: when True assemble() keeps a sourcemap.SourceMap of the program in
+                       self.source_map. Implied by input_source_map.
+    :param input_source_map: sourcemap.SourceMap of the lines of the input, such as written by
+                             vm2asm.py, which becomes the parent of self.source_map.
+    """
     self._input_asm = input_asm
     self._output_hack = output_hack
+    self._output_format = output_format
+    self._cache_dir = cache_dir
     self._compat = compat
     self._annotate = annotate
     self._pretty_print = pretty_print
-    self._optimise_options = optimise
+    self._optimise_passes = self._optimisation_pipeline(optimise)
+    self._opt_fixpoint = opt_fixpoint
+    if compat:
+      hazard_model = HAZARD_IDEAL
+    self._hazard_model = HAZARD_MODELS[hazard_model or DEFAULT_HAZARD_MODEL]
+
+    # maps optimisation pass names to Counter of runs, instructions removed and time taken
+    self.optimisation_stats = {}
+
+    # list of (labels, number of instructions) for each block removed as unreachable
+    self.unreachable_code = []
+
+    self.size_report = SizeReport() if size_report else None
+    self.stats = stats if stats is not None else Stats(enabled=False)
+
+    # maps each PC to the line of the input it was assembled from, set by assemble(). Finding
+    # the line of each instruction costs memory and time so it is only done when asked for
+    self.source_map = None
+    self._source_map_enabled = source_map or input_source_map is not None
+    self._input_source_map = input_source_map
+
+    # True while optimising part of a program, whose labels may be jumped to from elsewhere
+    self._open_labels = False
+
+    # while optimising a block for the cache, the constants it defines itself. The values of
+    # constants defined in other blocks are not part of the cache key so cannot be relied on
+    self._block_constants = None
+
+    # True when assembling a relocatable module, see assemble_object(). Symbols which are not
+    # known are then imported instead of becoming variables
+    self._relocatable = False
+    self._imports = {}
     self._next_variable_address = Assembler.VARIABLES_START_ADDRESS
 
     self._symbol_usage = Counter()
-    self.known_symbols = dict(Assembler.PREDEFINED_LABELS)
+    self.known_symbols = SymbolTable(Assembler.PREDEFINED_LABELS)
     self.hack_output = []
 
+    # emitted machine code as integers, used for output formats other than hack
+    self.machine_code = []
+
     self._warnings = []
 
     self._instructions = None
     self._postprocessed_src = None
 
+    # only used by assemble_stream() where self._instructions is never populated
+    self._num_streamed_instructions = 0
+
     self._nounce_counter = 0
 
+    # name of the func_ or sub_ block being preprocessed, None if not in a block
+    self._block_name = None
+
+    # number of blocks reused from and written to the cache
+    self.cache_stats = Counter()
+
     if annotate:
       self.hack_output.append(f'// SOURCE FILE={input_asm}')
 
   @property
   def _nounce(self):
+    """
+    Returns a value unique to this program. The counter is reset at the start of every func_ or
+    sub_ block and qualified by the block name so the nounces generated for a block do not
+    depend on the content of any other block.
+    """
     self._nounce_counter += 1
-    return hex(self._nounce_counter)
+    if self._block_name:
+      return f'{self._block_name}.{hex(self._nounce_counter)}'
+    elif self._relocatable:
+      # other modules count from 0 too
+      return f'{self.module_name}.{hex(self._nounce_counter)}'
+    else:
+      return hex(self._nounce_counter)
+
+  @property
+  def module_name(self):
+    """
+    Name of the module when assembling a relocatable object, taken from the input file
+    """
+    if self._input_asm is None:
+      return 'stdin'
+    return os.path.splitext(os.path.basename(self._input_asm))[0]
 
   @property
   def instructions(self):
+    """
+    The assembled instructions, including labels and instructions removed by the optimiser. This
+    is not a copy so must not be modified.
+    """
+    return self._instructions
+
+  @property
+  def num_instructions(self):
     if self._instructions is not None:
-      return list(self._instructions)
+      return len(self._instructions)
     else:
-      return None
+      return self._num_streamed_instructions
 
   @property
   def postprocessed_src(self):
-    if self._postprocessed_src is not None:
-      return list(self._postprocessed_src)
-    else:
-      return None
+    """
+    The source after preprocessing. This is not a copy so must not be modified.
+    """
+    return self._postprocessed_src
 
   @property
   def warnings(self):
@@ -168,25 +642,86 @@ class Assembler:
     """
     return '\n'.join(self.hack_output)
 
+  def write_output(self):
+    """
+    Writes the assembled output in the output format given on construction
+    """
+    with self.stats.phase('write'):
+      if self._output_format == FORMAT_HACK:
+        self.write_hack()
+      else:
+        write_firmware_file(self._output_hack, self.machine_code, self._output_format)
+
   def write_hack(self):
+    """
+    Writes the assembled output one line at a time so we never have to build the entire output
+    as a single string
+    """
     if self._output_hack is None:
-      print(self.dumps())
+      self._write_lines(sys.stdout, self.hack_output)
+      sys.stdout.write('\n')
     else:
       with open(self._output_hack, 'w') as fh:
-        fh.write(self.dumps())
+        self._write_lines(fh, self.hack_output)
+
+  @staticmethod
+  def _write_lines(fh, lines):
+    first = True
+    for l in lines:
+      if not first:
+        fh.write('\n')
+      fh.write(l)
+      first = False
+
+  def _read_lines(self, asm_text=None, line_numbers=None):
+    """
+    Generator which yields non-empty source lines with white space removed. When reading from a
+    file or stdin lines are read lazily. If line_numbers is given the line number, counting from
+    1, of each line yielded is appended to it.
+    """
+    if asm_text:
+      asm_lines = asm_text.split('\n')
+      yield from self._strip_lines(asm_lines, line_numbers)
+    elif self._input_asm:
+      with open(self._input_asm) as fh:
+        yield from self._strip_lines(fh, line_numbers)
+    else:
+      yield from self._strip_lines(sys.stdin, line_numbers)
 
-  def preprocess(self, asm_lines):
+  def _read_source(self, asm_text=None, line_numbers=None):
+    """
+    Like _read_lines() but times reading and counts the lines read
+    """
+    return self.stats.timed_iter('read', self._read_lines(asm_text, line_numbers), counter='lines')
+
+  @staticmethod
+  def _strip_lines(asm_lines, line_numbers=None):
+    for number, l in enumerate(asm_lines, 1):
+      l = l.strip()
+      if len(l):
+        if line_numbers is not None:
+          line_numbers.append(number)
+        yield l
+
+  def preprocess(self, asm_lines, origins=None):
     """
     :param asm_lines: list of strings, no empty lines allowed
+    :param origins: if given the index in asm_lines of the line each returned line came from is
+                    appended to it, which for macros is the line of the macro
     :return: list of strings with all macros removed
     """
-    postprocessed_lines = []
+    with self.stats.phase('preprocess'):
+      return list(self._preprocess_iter(asm_lines, origins))
 
-    def appendsrc(src):
+  def _preprocess_iter(self, asm_lines, origins=None):
+    """
+    Generator version of preprocess(). asm_lines can be any iterable of strings.
+    """
+    def expandsrc(src):
       for ll in src.splitlines():
         ll = ll.strip()
         if len(ll):
-          postprocessed_lines.append(ll)
+          yield ll
 
     # name of the current block, determined by the last func_ or sub_ label encountered
     macro_lut = {
@@ -203,12 +738,12 @@ class Assembler:
         'if_M_goto': self._parse_if_M_goto_macro,
     }
 
-    block_name = None
-    for l in asm_lines:
+    self._block_name = None
+    for idx, l in enumerate(asm_lines):
       # this must go first b/c we can have $if_D_goto $this.DONE
       if '$this' in l:
-        if block_name:
-          l = l.replace('$this', f'::{block_name}')
+        if self._block_name:
+          l = l.replace('$this', f'::{self._block_name}')
         else:
           raise Exception('$this used but not in a func_ or sub_ block')
 
@@ -216,43 +751,38 @@ class Assembler:
         found = False
         for name, func in macro_lut.items():
           if l[1:].startswith(name):
-            appendsrc(func(l))
+            for ll in expandsrc(func(l)):
+              if origins is not None:
+                origins.append(idx)
+              yield ll
+            self.stats.count('macros_expanded')
             found = True
             break
 
         if not found:
           raise Exception(f'Unknown macro found: {l}')
 
-      if l.startswith('(func_') or l.startswith('(sub_'):
-        block_name = l[1:-1]
+      if self._is_block_start(l):
+        self._block_name = l[1:-1]
+        self._nounce_counter = 0
 
       if l[0] != '$':
-        postprocessed_lines.append(l)
-
-    return postprocessed_lines
-
-  def assemble(self, asm_text=None):
-    if asm_text:
-      asm_lines = asm_text.split('\n')
-    elif self._input_asm:
-      with open(self._input_asm) as fh:
-        asm_lines = fh.readlines()
-    else:
-      asm_lines = sys.stdin.readlines()
-
-    # remove white space
-    asm_lines = [l.strip() for l in asm_lines]
+        if origins is not None:
+          origins.append(idx)
+        yield l
 
-    # remove empty lines
-    asm_lines = [l for l in asm_lines if len(l)]
-
-    asm_lines = self.preprocess(asm_lines)
+  def _parse_iter(self, asm_lines, source_lines=None):
+    """
+    Generator which parses preprocessed lines into Instruction objects, including any NOPs that
+    need to be inserted.
 
-    instructions = []
-    # first pass to parse instructions and grab labels
-    source_block = []
-    for l in asm_lines:
-      source_block.append(l)
+    Instructions do not hold their own copy of their source block. Instead they record the span
+    of line indices their source block occupies in source_lines, which should be asm_lines when
+    it is a list, or None if the lines are not retained.
+    """
+    block_start = 0
+    for idx, l in enumerate(asm_lines):
+      source_span = (source_lines, block_start, idx + 1)
       if '//' in l:
         exp, _ = l.split('//', 1)
       else:
@@ -264,69 +794,528 @@ class Assembler:
       if exp[0] == '(':
         # we do not reset source_line here b/c we want to keep
         # labels in the source block
-        instructions += self._parse_label(exp, source_block)
+        yield from self._parse_label(exp, source_span)
       else:
         # these instruction reset source_block so are in their own branch
         if exp[0] == '@':
-          instructions += self._parse_A_inst(exp, source_block)
+          yield from self._parse_A_inst(exp, source_span)
         else:
-          instructions += self._parse_C_inst(exp, source_block)
+          yield from self._parse_C_inst(exp, source_span)
+
+        block_start = idx + 1
+
+  def _parse(self, asm_lines):
+    """
+    Parses all of asm_lines, which must be a list, into a list of instructions
+    """
+    with self.stats.phase('parse'):
+      return list(self._parse_iter(asm_lines, source_lines=asm_lines))
+
+  @staticmethod
+  def _is_block_start(l):
+    return l.startswith('(func_') or l.startswith('(sub_')
+
+  def assemble(self, asm_text=None):
+    # number of each line read in the input and the index of the line read each postprocessed
+    # line came from, for the source map
+    line_numbers = array('I') if self._source_map_enabled else None
+    origins = array('I') if self._source_map_enabled else None
 
-        source_block = []
+    if self._cache_dir is None:
+      asm_lines = self.preprocess(self._read_source(asm_text, line_numbers), origins)
 
-    self._resolve_symbols(instructions)
+      # first pass to parse instructions and grab labels
+      instructions = self._parse(asm_lines)
 
-    instructions = self._optimise(instructions)
+      with self.stats.phase('resolve'):
+        self._resolve_symbols(instructions)
 
-    # do another resolve symbol pass to update label addresses
-    self._resolve_symbols(instructions)
+      with self.stats.phase('optimise'):
+        instructions = self._optimise(instructions)
+    else:
+      # blocks which are not in the cache are timed as usual, the rest is loading the cache
+      with self.stats.phase('cache'):
+        asm_lines, instructions = self._parse_blocks_cached(
+            self._read_source(asm_text, line_numbers), origins)
+
+      with self.stats.phase('resolve'):
+        self._resolve_symbols(instructions)
+
+    # optimisation moves labels
+    with self.stats.phase('resolve'):
+      self._assign_label_addresses(instructions)
+
+    if self.size_report is not None:
+      self.size_report.record_program(instructions)
+      for warning in self.size_report.warnings():
+        self.warn(warning)
 
     # final pass to emit machine code
+    with self.stats.phase('emit'):
+      pc = 0
+      for inst in instructions:
+        pc = self._emit(inst, pc, self.hack_output.append, self.machine_code)
+
+      if self._source_map_enabled:
+        source_file = '<in memory>' if asm_text else (self._input_asm or '<stdin>')
+        self.source_map = self._source_map(instructions, source_file,
+                                           array('I', (line_numbers[idx] for idx in origins)))
+
+    if self.stats.enabled:
+      self._count_instructions(instructions)
+
+    # do some basic checks
+    if len(instructions) == 0:
+      self.warn('No instructions found in input')
+    else:
+      self._check_last_instruction(instructions[-1])
+
+    self._check_symbol_usage()
+
+    # make the instructions available for inspection
+    self._instructions = instructions
+
+    # make the post processed lines available for inspection
+    self._postprocessed_src = asm_lines
+
+    # allow chaining, e.g. self.assemble().dumps()
+    return self
+
+  def _source_map(self, instructions, source_file, line_numbers):
+    """
+    Returns a SourceMap of the PC of each emitted instruction to its line in source_file and the
+    func_/sub_ block it is in, given the line number of each postprocessed line. Instructions the
+    assembler generated, such as NOPs, map to the line of the instruction before them.
+    """
+    source_map = SourceMap(parent=self._input_source_map)
+    line = None
+    block = None
     pc = 0
     for inst in instructions:
-      # gather warnings
-      self._warnings += inst.warnings()
+      if type(inst) == Label_Instruction:
+        if inst.symbol.startswith('func_') or inst.symbol.startswith('sub_'):
+          block = inst.symbol
+        continue
 
-      machine_code = inst.resolve(self.known_symbols, compat=self._compat)
+      if not inst.emit:
+        continue
 
-      if machine_code is not None:
-        compact_machine_code = machine_code.replace('_', '')
-        assert len(compact_machine_code) == 16
+      start, end = inst.source_span
+      if end > start:
+        line = line_numbers[end - 1]
+      source_map.add(pc, source_file, line, block)
+      pc += 1
 
-        # if pretty print is not set or in compat mode do not emit _ spacers
-        if self._compat or not self._pretty_print:
-          machine_code = compact_machine_code
+    return source_map
 
-        should_annotate = not self._compat and self._annotate
+  def assemble_object(self, asm_text=None):
+    """
+    Assembles the program as a relocatable module and returns it as an ObjectModule. Labels may be
+    jumped to from other modules and symbols which are not defined are left for the linker.
+    """
+    self._relocatable = True
+    self._open_labels = True
+
+    asm_lines = self.preprocess(self._read_source(asm_text))
+    instructions = self._parse(asm_lines)
+    with self.stats.phase('resolve'):
+      self._resolve_symbols(instructions)
+    with self.stats.phase('optimise'):
+      instructions = self._optimise(instructions)
+    with self.stats.phase('resolve'):
+      self._assign_label_addresses(instructions)
+
+    code = []
+    relocations = []
+    sections = [0]
+    last_inst = None
+    for inst in instructions:
+      for warning in inst.warnings():
+        self.warn(warning)
 
-        if not inst.emit:
-          if should_annotate:
-            machine_code = f'// [OPTIMISER REMOVED] {machine_code}'
-          else:
-            machine_code = None
+      # nothing falls through into a label after an unconditional jump, so the linker can move
+      # or drop the code from here on
+      if type(inst) == Label_Instruction and code and sections[-1] != len(code):
+        if type(last_inst) == C_Instruction and is_unconditional_jump(last_inst):
+          sections.append(len(code))
+
+      if not inst.emit:
+        continue
+
+      last_inst = inst
+
+      symbol = getattr(inst, 'symbol', None)
+      if type(inst) == A_Instruction and symbol is not None and (
+          symbol in self._imports or self.known_symbols.kind(symbol) == SYMBOL_LABEL):
+        relocations.append((len(code), symbol))
+        code.append(0)
+      else:
+        code.append(inst.encode(self.known_symbols, compat=self._compat))
+
+    self._instructions = instructions
+    self._postprocessed_src = asm_lines
+
+    symbols = self.known_symbols
+    return ObjectModule(name=self.module_name,
+                        code=code,
+                        relocations=relocations,
+                        labels={s: symbols[s] for s in symbols.symbols(SYMBOL_LABEL)},
+                        constants={s: symbols[s] for s in symbols.symbols(SYMBOL_CONSTANT)},
+                        imports=list(self._imports),
+                        sections=sections,
+                        falls_through=not (type(last_inst) == C_Instruction
+                                           and is_unconditional_jump(last_inst)),
+                        hazard_model=self._hazard_model.name,
+                        compat=self._compat)
+
+  def _split_blocks(self, asm_lines):
+    """
+    Generator which splits source lines into lists of lines, one for each func_ and sub_ block.
+    Lines before the first block form their own block.
+    """
+    block = []
+    for l in asm_lines:
+      if self._is_block_start(l) and len(block):
+        yield block
+        block = []
+      block.append(l)
+
+    if len(block):
+      yield block
+
+  def _block_cache_path(self, block):
+    h = hashlib.sha256()
+    options = (ASSEMBLY_CACHE_VERSION, self._compat, self._optimise_passes, self._opt_fixpoint,
+               self._hazard_model.name)
+    h.update(repr(options).encode())
+    for l in block:
+      h.update(l.encode())
+      h.update(b'\n')
+    return os.path.join(self._cache_dir, h.hexdigest() + '.pickle')
+
+  def _parse_blocks_cached(self, asm_lines, origins=None):
+    """
+    Preprocesses, parses and optimises each func_/sub_ block independently, reusing the results
+    from self._cache_dir where the content of a block is unchanged. origins is as for
+    preprocess().
+
+    Returns (postprocessed lines, instructions) for the whole program.
+    """
+    os.makedirs(self._cache_dir, exist_ok=True)
+
+    all_lines = []
+    all_instructions = []
+
+    # start of the source block of the next instruction in all_lines. This can be in a previous
+    # block if that block ended with comments
+    source_start = 0
+
+    # index in asm_lines of the first line of the block
+    block_start = 0
+
+    for block in self._split_blocks(asm_lines):
+      path = self._block_cache_path(block)
+      try:
+        with open(path, 'rb') as fh:
+          entry = pickle.load(fh)
+        self.cache_stats['hits'] += 1
+      except (OSError, EOFError, pickle.UnpicklingError):
+        entry = self._parse_block(block)
+        with open(path, 'wb') as fh:
+          pickle.dump(entry, fh)
+        self.cache_stats['misses'] += 1
+      else:
+        # replay side effects of preprocessing the block
+        self.known_symbols.update(entry['consts'])
+        for warning in entry['warnings']:
+          self.warn(warning)
+
+      base = len(all_lines)
+      all_lines += entry['lines']
+      if origins is not None:
+        origins.extend(block_start + idx for idx in entry['origins'])
+      block_start += len(block)
+
+      for kind, expression, emit, start, end, regenerated in entry['records']:
+        if kind == 'N':
+          inst = NOP_Instruction()
         else:
-          if should_annotate:
-            machine_code += f' // PC={pc}'
-          pc += 1
+          inst_cls = dict(L=Label_Instruction, A=A_Instruction, C=C_Instruction)[kind]
+          source_span = (all_lines, source_start if start == 0 else base + start, base + end)
+          inst = inst_cls(expression, source_span=source_span)
 
-        if should_annotate:
-          self.hack_output.append('')
-          # annotate each hack instruction with the source line
-          for l in inst.get_annotations():
-            self.hack_output.append(f'// {l}')
+          if kind != 'L':
+            source_start = base + end
 
-      if machine_code:
-        self.hack_output.append(machine_code)
+          if regenerated:
+            inst._regenerated = True
 
-    # do some basic checks
-    if len(instructions) == 0:
+        inst.emit = emit
+        all_instructions.append(inst)
+
+    return all_lines, all_instructions
+
+  def _parse_block(self, block):
+    """
+    Preprocesses, parses and optimises a single block. Returns a cache entry which only contains
+    builtin types so it can be loaded regardless of how this module was imported.
+    """
+    num_warnings = len(self._warnings)
+    symbols_before = dict(self.known_symbols)
+
+    origins = []
+    postprocessed_lines = self.preprocess(block, origins)
+    instructions = self._parse(postprocessed_lines)
+
+    consts = {k: v for k, v in self.known_symbols.items()
+              if k not in symbols_before or symbols_before[k] != v}
+
+    # other blocks can jump to any of our labels, and change their constants
+    self._open_labels = True
+    self._block_constants = consts
+    try:
+      with self.stats.phase('optimise'):
+        instructions = self._optimise(instructions)
+    finally:
+      self._open_labels = False
+      self._block_constants = None
+
+    return dict(lines=postprocessed_lines,
+                origins=origins,
+                records=self._instructions_to_records(instructions),
+                consts=consts,
+                warnings=self._warnings[num_warnings:])
+
+  @staticmethod
+  def _instructions_to_records(instructions):
+    records = []
+    for inst in instructions:
+      if type(inst) == NOP_Instruction:
+        kind = 'N'
+      elif type(inst) == Label_Instruction:
+        kind = 'L'
+      elif type(inst) == A_Instruction:
+        kind = 'A'
+      else:
+        kind = 'C'
+
+      start, end = inst.source_span
+      regenerated = inst._regenerated
+      records.append((kind, inst.expression, inst.emit, start, end, regenerated))
+    return records
+
+  def assemble_stream(self, asm_text=None):
+    """
+    Assembles in a streaming fashion where the output is written as it is generated. Instead of
+    holding every instruction in memory the first pass writes the instruction stream to a
+    temporary file while building the label table, and the second pass reads it back to emit
+    machine code. Peak memory is therefore proportional to the symbol table.
+
+    Optimisations are not supported b/c they need to see the whole program.
+
+    Unlike assemble() the instructions and postprocessed_src properties are not populated.
+    """
+    if self._optimise_passes:
+      raise Exception('Optimisations are not supported when streaming')
+
+    with tempfile.TemporaryFile(mode='w+') as spill:
+      with self.stats.phase('parse'):
+        last_inst = self._stream_first_pass(self._read_source(asm_text), spill)
+
+      spill.seek(0)
+
+      with self.stats.phase('emit'):
+        if self._output_hack is None:
+          self._stream_second_pass(spill, sys.stdout)
+          sys.stdout.write('\n')
+        else:
+          with open(self._output_hack, 'w') as fh:
+            self._stream_second_pass(spill, fh)
+
+    self.stats.count('instructions', self._num_streamed_instructions)
+
+    if last_inst is None:
       self.warn('No instructions found in input')
     else:
-      last_inst = instructions[-1]
+      self._check_last_instruction(last_inst)
+
+    self._check_symbol_usage()
+
+    return self
+
+  def _stream_first_pass(self, asm_lines, spill):
+    """
+    Parses asm_lines, assigns addresses to labels and writes one record per instruction to
+    spill. Each record is a single line of the form <kind><expression> where kind is one of
+    L, A, C or N (generated NOP). When annotating the source block of an instruction is
+    written before it as lines prefixed with #.
+
+    Returns the last instruction seen, None if there were no instructions.
+    """
+    seen_symbols = set()
+    pc = 0
+    last_inst = None
+
+    # lines of the source block of the instruction being parsed. pending[0] is line pending_start
+    # of the preprocessed source
+    pending = []
+    pending_start = 0
+
+    def retain(lines):
+      for l in lines:
+        pending.append(l)
+        yield l
+
+    preprocessed = self.stats.timed_iter('preprocess', self._preprocess_iter(asm_lines))
+    for inst in self._parse_iter(retain(preprocessed)):
+      self._num_streamed_instructions += 1
+      last_inst = inst
+
+      if type(inst) == Label_Instruction:
+        symbol = inst.symbol
+        if symbol in seen_symbols:
+          raise NameError(f'Redefinition of label {symbol}')
+        self._validate_symbol(symbol)
+        self.known_symbols.define(symbol, pc, SYMBOL_LABEL)
+        seen_symbols.add(symbol)
+        spill.write(f'L{inst.expression}\n')
+        continue
+
+      if not inst.generated:
+        start, end = inst.source_span
+        if self._annotate:
+          for l in pending[start - pending_start:end - pending_start]:
+            spill.write(f'#{l}\n')
+
+        del pending[:end - pending_start]
+        pending_start = end
+
+      if type(inst) == NOP_Instruction:
+        spill.write('N\n')
+      elif type(inst) == A_Instruction:
+        spill.write(f'A{inst.expression}\n')
+      else:
+        spill.write(f'C{inst.expression}\n')
+
+      pc += 1
+
+    return last_inst
+
+  def _stream_second_pass(self, spill, fh):
+    """
+    Reads back the records written by _stream_first_pass(), allocates variables as they are
+    encountered and writes machine code to fh.
+    """
+    def write(l):
+      if write.first:
+        write.first = False
+      else:
+        fh.write('\n')
+      fh.write(l)
+    write.first = True
+
+    for l in self.hack_output:
+      write(l)
+
+    pc = 0
+    source_block = []
+    for record in spill:
+      kind, expression = record[0], record[1:-1]
+
+      if kind == '#':
+        source_block.append(expression)
+        continue
+
+      if kind == 'L':
+        continue
+
+      if kind == 'N':
+        inst = NOP_Instruction()
+      elif kind == 'A':
+        inst = A_Instruction(expression, source_block=source_block)
+        if inst.symbol is not None:
+          self._use_symbol(inst.symbol)
+      else:
+        inst = C_Instruction(expression, source_block=source_block)
+
+      source_block = []
+      pc = self._emit(inst, pc, write)
+
+  def _emit(self, inst, pc, write, codes=None):
+    """
+    Resolves inst into machine code and passes each output line to write. If codes is given
+    the machine code of emitted instructions is also appended to it as an integer. Returns the PC
+    of the next instruction.
+    """
+    # gather warnings
+    for warning in inst.warnings():
+      self.warn(warning)
+
+    should_annotate = not self._compat and self._annotate
+
+    # removed instructions are only shown when annotating
+    if not inst.emit and not should_annotate:
+      return pc
+
+    code = inst.encode(self.known_symbols, compat=self._compat)
+
+    if code is None:
+      machine_code = None
+    else:
+      # if pretty print is not set or in compat mode do not emit _ spacers
+      machine_code = format_machine_code(code, self._pretty_print and not self._compat)
+
+      if not inst.emit:
+        if should_annotate:
+          machine_code = f'// [OPTIMISER REMOVED] {machine_code}'
+        else:
+          machine_code = None
+      else:
+        if should_annotate:
+          machine_code += f' // PC={pc}'
+        if codes is not None:
+          codes.append(code)
+        pc += 1
+
+      if should_annotate:
+        write('')
+        # annotate each hack instruction with the source line
+        for l in inst.get_annotations():
+          write(f'// {l}')
+
+    if machine_code:
+      write(machine_code)
+
+    return pc
+
+  def _count_instructions(self, instructions):
+    """
+    Records counts of instructions in self.stats
+    """
+    counts = Counter()
+    for inst in instructions:
+      if type(inst) == Label_Instruction:
+        counts['labels'] += 1
+        continue
+
+      if inst.generated and _is_nop(inst):
+        counts['nops_inserted'] += 1
+        if not inst.emit:
+          counts['nops_removed'] += 1
+
+      if inst.emit:
+        counts['instructions'] += 1
+      else:
+        counts['instructions_removed'] += 1
+
+    counts['symbols'] = len(self.known_symbols)
+    self.stats.counters.update(counts)
 
-      if type(last_inst) != C_Instruction or last_inst.jump == NO_JUMP:
-        self.warn('Last instruction should be a jump instruction')
+  def _check_last_instruction(self, last_inst):
+    if type(last_inst) != C_Instruction or last_inst.jump == NO_JUMP:
+      self.warn('Last instruction should be a jump instruction')
 
+  def _check_symbol_usage(self):
     for symbol in self.known_symbols.keys():
       # ignore labels in PREDEFINED_LABELS since this code is mostly
       # intended to detect unused user-defined labels
@@ -336,36 +1325,23 @@ class Assembler:
       if symbol not in self._symbol_usage:
         self.warn(f'{symbol} is defined but never used')
 
-    # make the instructions available for inspection
-    self._instructions = instructions
-
-    # make the post processed lines available for inspection
-    self._postprocessed_src = asm_lines
-
-    # allow chaining, e.g. self.assemble().dumps()
-    return self
+  def _parse_A_inst(self, l, source_span):
+    return [A_Instruction(l, source_span=source_span)]
 
-  def _parse_A_inst(self, l, source_block):
-    return [A_Instruction(l, source_block=source_block)];
+  def _parse_label(self, l, source_span):
+    return [Label_Instruction(l, source_span=source_span)]
 
-  def _parse_label(self, l, source_block):
-    return [Label_Instruction(l, source_block=source_block)]
-
-  def _parse_C_inst(self, l, source_block):
-    inst = C_Instruction(l, source_block=source_block)
+  def _parse_C_inst(self, l, source_span):
+    inst = C_Instruction(l, source_span=source_span)
 
     ret = []
-
-    # pre/post nops only emitted when not in compat mode
-    if not self._compat:
-      for _ in range(inst.num_pre_nops()):
-        ret.append(NOP_Instruction())
+    for _ in range(self._hazard_model.num_pre_nops(inst)):
+      ret.append(NOP_Instruction())
 
     ret.append(inst)
 
-    if not self._compat:
-      for _ in range(inst.num_post_nops()):
-        ret.append(NOP_Instruction())
+    for _ in range(self._hazard_model.num_post_nops(inst)):
+      ret.append(NOP_Instruction())
 
     return ret
 
@@ -492,9 +1468,12 @@ class Assembler:
 
     _, name, value = parts
 
-    value = Instruction('').parse_numeric_constant(value)
+    inst = Instruction('')
+    value = inst.parse_numeric_constant(value)
+    for warning in inst.warnings():
+      self.warn(warning)
 
-    self.known_symbols[name] = value
+    self.known_symbols.define(name, value, SYMBOL_CONSTANT)
 
     return ''
 
@@ -553,64 +1532,148 @@ class Assembler:
     '''
 
   def _resolve_symbols(self, instructions):
-    # find all labels and update
+    """
+    Defines every label and assigns RAM addresses to variables in the order they are first used.
+    Label addresses are provisional until _assign_label_addresses() runs after optimisation.
+    """
+    # we can't use self.known_symbols to detect redefinitions b/c labels may redefine predefined
+    # symbols
+    labels = set()
     pc = 0
-
-    # tracks symbols seen _this_ pass. We can't use self.known_symbols b/c  this can be called more
-    # than once and thus self.known_symbols is not a reliable way of detecting re-defintions
-    seen_symbols = set()
-
-    def add_symbol(s, v):
-      for c in s:
-        if c in '.:_':
-          continue
-        if c.isalnum():
-          continue
-        raise NameError(f'Invalid character {c} in symbol {s}')
-
-      self.known_symbols[s] = v
-      seen_symbols.add(s)
-
     for inst in instructions:
       if type(inst) == Label_Instruction:
-        symbol = inst.symbols()[0]
-        if symbol in seen_symbols:
+        symbol = inst.symbol
+        if symbol in labels:
           raise NameError(f'Redefinition of label {symbol}')
-        add_symbol(symbol, pc)
+        labels.add(symbol)
+        self._validate_symbol(symbol)
+        self.known_symbols.define(symbol, pc, SYMBOL_LABEL)
       elif inst.emit:
         pc += 1
 
-    # find all variables and assign RAM location if not
-    # already known
     for inst in instructions:
-      if inst.emit and type(inst) == A_Instruction:
-        for s in inst.symbols():
-          if not s in self.known_symbols:
-            add_symbol(s, self._next_variable_address)
-            self._next_variable_address += 1
-          else:
-            self._symbol_usage[s] += 1
-
-  def _optimise(self, instructions):
-    oopt = self._optimise_options
-    doall = oopt == OPT_ALL
-    if doall or oopt == OPT_LOADS:
-      self._remove_redundant_loads(instructions)
-
-    if doall or oopt == OPT_CONSEC_NOPS:
-      self._remove_consecutive_nops(instructions)
-
-    if doall or oopt == OPT_UNNEEDED_NOPS:
-      self._remove_unneeded_nops(instructions)
-
-    if doall or oopt == OPT_MULTIDEST_ASSIGNMENT:
-      self._optimise_using_multi_destination_assignments(instructions)
+      if inst.emit and type(inst) == A_Instruction and inst.symbol is not None:
+        self._use_symbol(inst.symbol)
 
-    return instructions
-
-  def _optimise_using_multi_destination_assignments(self, instructions):
+  def _use_symbol(self, symbol):
     """
-    Optimises code such as:
+    Records a use of symbol, making it a variable if it is not yet known
+    """
+    if symbol not in self.known_symbols:
+      self._validate_symbol(symbol)
+      if self._relocatable:
+        # the linker decides whether this is a label of another module or a variable
+        self._imports[symbol] = True
+        return
+      self.known_symbols.define(symbol, self._next_variable_address, SYMBOL_VARIABLE)
+      self._next_variable_address += 1
+    self._symbol_usage[symbol] += 1
+
+  def _assign_label_addresses(self, instructions):
+    """
+    Sets the address of every label to the number of instructions emitted before it
+    """
+    known_symbols = self.known_symbols
+    pc = 0
+    for inst in instructions:
+      if type(inst) == Label_Instruction:
+        known_symbols.set_value(inst.symbol, pc)
+      elif inst.emit:
+        pc += 1
+
+  @staticmethod
+  def _validate_symbol(s):
+    if SYMBOL_RE.fullmatch(s):
+      return
+
+    for c in s:
+      if c in '.:_':
+        continue
+      if c.isalnum():
+        continue
+      raise NameError(f'Invalid character {c} in symbol {s}')
+
+  @staticmethod
+  def _optimisation_pipeline(optimise):
+    """
+    Returns the list of optimisation pass names specified by optimise
+    """
+    if optimise is None:
+      names = []
+    elif isinstance(optimise, str):
+      names = [optimise]
+    else:
+      names = list(optimise)
+
+    passes = []
+    for name in names:
+      if name == OPT_ALL:
+        passes += DEFAULT_OPTIMISATION_PIPELINE
+      elif name in OPTIMISATION_PASSES:
+        passes.append(name)
+      else:
+        raise ValueError(f'Unknown optimisation {name}')
+
+    return passes
+
+  def _optimise(self, instructions):
+    """
+    Runs the selected optimisation passes in order. When iterating to a fixpoint the passes are
+    repeated until none of them change the program, at most OPT_MAX_ITERATIONS times.
+    """
+    if not self._optimise_passes:
+      return instructions
+
+    for _ in range(OPT_MAX_ITERATIONS if self._opt_fixpoint else 1):
+      changed = False
+      for name in self._optimise_passes:
+        if self._run_optimisation_pass(name, instructions):
+          changed = True
+
+      if not changed:
+        break
+
+    # label addresses are only known once nothing else will change the program
+    if OPT_CONSTANTS in self._optimise_passes and not self._open_labels:
+      emitted_before = [inst.emit for inst in instructions]
+      self._fold_label_loads(instructions)
+      removed = emitted_before.count(True) - sum(1 for inst in instructions if inst.emit)
+      self.optimisation_stats[OPT_CONSTANTS]['removed'] += removed
+      if self.size_report is not None:
+        self.size_report.record_pass(OPT_CONSTANTS, instructions, emitted_before)
+
+    return instructions
+
+  def _control_flow_graph(self, instructions):
+    return ControlFlowGraph(instructions, open_labels=self._open_labels)
+
+  def _run_optimisation_pass(self, name, instructions):
+    """
+    Runs a single optimisation pass and records its statistics. Returns True if the pass
+    changed the program.
+    """
+    num_before = sum(1 for inst in instructions if inst.emit)
+    if self.size_report is not None:
+      emitted_before = [inst.emit for inst in instructions]
+
+    start = time.perf_counter()
+    modified = OPTIMISATION_PASSES[name](self, instructions)
+    elapsed = time.perf_counter() - start
+
+    removed = num_before - sum(1 for inst in instructions if inst.emit)
+    if self.size_report is not None:
+      self.size_report.record_pass(name, instructions, emitted_before)
+
+    stats = self.optimisation_stats.setdefault(name, Counter())
+    stats['runs'] += 1
+    stats['removed'] += removed
+    stats['time'] += elapsed
+
+    return bool(modified) or removed != 0
+
+  def _optimise_using_multi_destination_assignments(self, instructions):
+    """
+    Optimises code such as:
 
       A = A + 1
       D = A
@@ -625,9 +1688,30 @@ class Assembler:
       2. X is then the rvalue in a Y=X
       3. Y is not read between 1 and 2
     """
+    cfg = self._control_flow_graph(instructions)
+
     candidate_inst = None
+    candidate_pos = None
+    a_loaded = False
     read_vars = set()
-    for inst in (inst for inst in instructions if inst.emit):
+    prev_block = None
+    for block, idx, inst in ((block, idx, inst)
+                             for block in cfg.blocks
+                             for idx, inst in enumerate(block.instructions)):
+      # we can only carry on across a label if the block can only be entered by falling through
+      # from the previous block
+      if block is not prev_block:
+        if block.unique_predecessor is None or block.unique_predecessor is not prev_block:
+          candidate_inst = None
+        prev_block = block
+
+      # loading A replaces the value we would be copying out of A, and changes what M refers to
+      if type(inst) == A_Instruction:
+        if candidate_inst is not None and candidate_inst.dest in ('A', 'M'):
+          candidate_inst = None
+        a_loaded = True
+        continue
+
       if type(inst) != C_Instruction:
         continue
 
@@ -652,6 +1736,12 @@ class Assembler:
         if inst.dest in read_vars:
           canoptimise = False
 
+        # writing A or M earlier must not be undone by, or change the address of, an
+        # A-instruction in between, and the write must be safe where the candidate is
+        if canoptimise and inst.dest in ('A', 'M'):
+          merged = C_Instruction(f'{candidate_inst.dest},{inst.dest}={candidate_inst.comp}')
+          canoptimise = not a_loaded and not self._replacement_hazard(*candidate_pos, merged)
+
         if canoptimise:
           inst.emit = False
           candidate_inst.dest += ',' + inst.dest
@@ -667,6 +1757,8 @@ class Assembler:
       if len(inst.dest) == 1:
         # we only optimise away single assignments
         candidate_inst = inst
+        candidate_pos = (block, idx)
+        a_loaded = False
         read_vars = set()
 
         # continue b/c we shall do no more with this instruction
@@ -688,24 +1780,47 @@ class Assembler:
       if len(inst.dest) > 1:
         candidate_inst = None
 
+  def _replacement_hazard(self, block, idx, inst):
+    """
+    Returns True if the instruction at idx in block could not be replaced by inst without
+    breaking the hazard model.
+    """
+    prev = [inst for inst in block.instructions[:idx] if inst.emit][-1:]
+    after = [inst for inst in block.instructions[idx + 1:] if inst.emit][:1]
+
+    # the instructions outside the block are not known
+    if not prev or not after:
+      return True
+
+    return self._hazard_model.hazard(prev[0], inst) or self._hazard_model.hazard(inst, after[0])
+
   def _remove_unneeded_nops(self, instructions):
     """
-    Removes nops inserted after M writes if the next instruction
-    is an A-instruction or a C-instruction that doesn't read or
-    write to memory
+    Removes nops inserted by the assembler if the instructions either side of them can execute
+    back to back under the hazard model, e.g. the nop after an M write if the next instruction
+    doesn't access memory. A nop after a label is kept b/c we cannot see what jumps there.
     """
-    last_inst = None
-    for inst in (inst for inst in instructions if inst.emit):
-      if last_inst:
-        if last_inst.generated and last_inst.expression == '0':
-          if type(inst) == A_Instruction:
-            last_inst.emit = False
+    # labels are not emitted, so note which instructions come straight after one
+    emitted = []
+    after_label = []
+    label_seen = False
+    for inst in instructions:
+      if type(inst) == Label_Instruction:
+        label_seen = True
+      elif inst.emit:
+        emitted.append(inst)
+        after_label.append(label_seen)
+        label_seen = False
 
-          if type(inst) == C_Instruction:
-            last_inst.emit = 'M' in inst.dest or 'M' in inst.comp
+    last_inst = None
+    for idx, inst in enumerate(emitted):
+      if (inst.generated and _is_nop(inst) and last_inst and not after_label[idx]
+          and idx + 1 < len(emitted)
+          and not self._hazard_model.hazard(last_inst, emitted[idx + 1])):
+        inst.emit = False
+        continue
 
-      if type(inst) != Label_Instruction:
-        last_inst = inst
+      last_inst = inst
 
   def _remove_consecutive_nops(self, instructions):
     last_inst = None
@@ -718,50 +1833,622 @@ class Assembler:
         last_inst = inst
 
   def _remove_redundant_loads(self, instructions):
-    last_a_inst = None
-    for inst in (inst for inst in instructions if inst.emit):
-      if type(inst) == A_Instruction:
-        if last_a_inst:
-          # compare based on expression not on resulting machine code b/c
-          # it is possible for one load to refer to a label and another to
-          # a RAM variable and they *happen* to have the same value. If we
-          # remove one and the label address changes then we will a bug
-          if last_a_inst.expression == inst.expression:
+    cfg = self._control_flow_graph(instructions)
+
+    # the last A-instruction in effect at the end of each block
+    exit_loads = {}
+    for block in cfg.blocks:
+      # what is in A on entry is only known if control can only arrive from a block we have
+      # already seen. Otherwise a label such as (LOOP) may be reached with anything in A
+      last_a_inst = exit_loads.get(block.unique_predecessor)
+
+      for idx, inst in enumerate(block.instructions):
+        if type(inst) == A_Instruction:
+          if last_a_inst:
+            # compare based on expression not on resulting machine code b/c
+            # it is possible for one load to refer to a label and another to
+            # a RAM variable and they *happen* to have the same value. If we
+            # remove one and the label address changes then we will a bug
+            if last_a_inst.expression == inst.expression and not self._removal_hazard(block, idx):
+              inst.emit = False
+          last_a_inst = inst
+
+        # modifying A should force the next A-instruction to emit
+        if type(inst) == C_Instruction:
+          if 'A' in inst.dest:
+            last_a_inst = None
+
+      exit_loads[block] = last_a_inst
+
+  def _remove_dead_stores(self, instructions):
+    """
+    Removes instructions whose only effect is to write registers which are overwritten before
+    they are read, e.g. the D=A in
+
+      D=A
+      @SP
+      D=M
+
+    Writes to M are never removed, nor are jumps b/c they use the result of the computation, nor
+    C-instructions without a destination b/c they are used as NOPs.
+    """
+    cfg = self._control_flow_graph(instructions)
+    _, live_out = cfg.liveness()
+
+    for block in cfg.blocks:
+      live = set(live_out[block])
+      for idx in range(len(block.instructions) - 1, -1, -1):
+        inst = block.instructions[idx]
+        written = inst.registers_written()
+
+        dead = written and not (written & live)
+        if dead and isinstance(inst, C_Instruction):
+          dead = 'M' not in inst.dest and inst.jump == NO_JUMP
+
+        if dead and not self._removal_hazard(block, idx):
+          inst.emit = False
+          continue
+
+        live = (live - written) | inst.registers_read()
+
+  def _removal_hazard(self, block, idx):
+    """
+    Returns True if the instruction at idx in block cannot be removed without breaking the
+    hazard model, i.e. if the instructions either side of it may then not execute back to back.
+    It may be all that separates an M-write from the next memory access, if the NOP after the
+    write was removed, or fill the slot before an M-write.
+    """
+    prev = None
+    for i in range(idx - 1, -1, -1):
+      if block.instructions[i].emit:
+        prev = [block.instructions[i]]
+        break
+    else:
+      # we cannot see what jumps here from a computed jump
+      if block.address_taken:
+        return True
+      if any(not pred.instructions for pred in block.predecessors):
+        return True
+      prev = [pred.instructions[-1] for pred in block.predecessors]
+
+    after = None
+    for inst in block.instructions[idx + 1:]:
+      if inst.emit:
+        after = inst
+        break
+
+    if after is None:
+      return any(self._hazard_model.hazard_after(inst) for inst in prev)
+
+    return any(self._hazard_model.hazard(inst, after) for inst in prev)
+
+  def _apply_peephole_rules(self, instructions):
+    """
+    Rewrites windows of instructions matching PEEPHOLE_RULES in a single pass over each basic
+    block. Windows never span labels, and only the last instruction of a window can jump.
+    """
+    cfg = self._control_flow_graph(instructions)
+    matcher = peephole_matcher()
+
+    for block in cfg.blocks:
+      window = list(block.instructions)
+      idx = 0
+      while idx < len(window):
+        # after a rewrite try again at the same place b/c the result may match another rule
+        if not self._apply_peephole_rule(matcher, block, window, idx):
+          idx += 1
+
+  def _apply_peephole_rule(self, matcher, block, window, idx):
+    for rule, bindings in matcher.matches(window, idx):
+      matched = window[idx:idx + len(rule.pattern)]
+      try:
+        rewrites = rule.instantiate(matched, bindings, compat=self._compat)
+      except Exception:
+        # the substitution produced something which cannot be encoded
+        continue
+
+      result = [new or inst for inst, new in rewrites]
+      if self._peephole_hazard(block, window, idx, len(matched), result):
+        continue
+
+      kept = set()
+      for inst, new in rewrites:
+        kept.add(id(inst))
+        if new is not None:
+          inst.dest, inst.comp, inst.jump = new.dest, new.comp, new.jump
+          inst.regenerate_expression()
+
+      for inst in matched:
+        if id(inst) not in kept:
+          inst.emit = False
+
+      window[idx:idx + len(matched)] = [inst for inst, _ in rewrites]
+      return True
+
+    return False
+
+  def _peephole_hazard(self, block, window, idx, length, result):
+    """
+    Returns True if replacing window[idx:idx+length] with result puts instructions back to back
+    which the hazard model does not allow, e.g. a memory access straight after an M-write.
+    """
+    model = self._hazard_model
+    if idx > 0:
+      before = [window[idx - 1]]
+    elif block.address_taken or any(not pred.instructions for pred in block.predecessors):
+      # we cannot see what runs before, so assume the worst
+      before = [C_Instruction('M=0')]
+    else:
+      before = [pred.instructions[-1] for pred in block.predecessors]
+
+    if idx + length < len(window):
+      after = window[idx + length]
+    else:
+      # the instruction after the block is not known
+      after = None
+
+    if any(model.hazard(prev, result[0]) for prev in before):
+      return True
+
+    if any(model.hazard(prev, inst) for prev, inst in zip(result, result[1:])):
+      return True
+
+    if after is None:
+      return model.hazard_after(result[-1])
+
+    return model.hazard(result[-1], after)
+
+  def _thread_jumps(self, instructions):
+    """
+    Shortens the path taken by jumps:
+
+      1. a jump to an unconditional jump is retargeted to where that jump goes
+      2. a jump to the instruction after it is removed
+      3. a conditional jump over an unconditional jump is inverted, e.g.
+
+           @ELSE
+           D;JEQ            @END
+           @END      =>     D;JNE
+           0;JMP          (ELSE)
+         (ELSE)
+
+    Each jump avoided saves two cycles, one to load the target and one to jump.
+    """
+    modified = self._retarget_jumps(instructions)
+    modified = self._remove_jumps_to_next(instructions) or modified
+    modified = self._invert_branches(instructions) or modified
+    return modified
+
+  def _retarget_jumps(self, instructions):
+    cfg = self._control_flow_graph(instructions)
+    modified = False
+    for block in cfg.blocks:
+      load = cfg.exclusive_jump_load(block)
+      if load is None or block.jump_target is None:
+        continue
+
+      target = self._final_jump_target(cfg, block.jump_target)
+      if target != block.jump_target:
+        load.retarget(target)
+        modified = True
+
+    return modified
+
+  @staticmethod
+  def _final_jump_target(cfg, label):
+    """
+    Follows blocks which do nothing but jump, e.g. @X; 0;JMP, starting at label and returns the
+    label where they end up
+    """
+    seen = {label}
+    while True:
+      insts = cfg.label_blocks[label].instructions
+      if len(insts) != 2 or type(insts[0]) != A_Instruction:
+        return label
+
+      load, jump = insts
+      if jump.dest or not is_unconditional_jump(jump):
+        return label
+
+      # stop at loops such as (END) @END 0;JMP
+      if load.symbol not in cfg.label_blocks or load.symbol in seen:
+        return label
+
+      label = load.symbol
+      seen.add(label)
+
+  def _remove_jumps_to_next(self, instructions):
+    cfg = self._control_flow_graph(instructions)
+    live_in, _ = cfg.liveness()
+
+    modified = False
+    for block in cfg.blocks:
+      if block.jump_target is None:
+        continue
+
+      target = cfg.label_blocks[block.jump_target]
+      if target.index != block.index + 1:
+        continue
+
+      jump_idx = len(block.instructions) - 1
+      if self._removal_hazard(block, jump_idx):
+        continue
+
+      # computations with a destination still need to happen
+      jump = block.instructions[jump_idx]
+      if jump.dest:
+        jump.jump = NO_JUMP
+        jump.regenerate_expression()
+      else:
+        jump.emit = False
+      modified = True
+
+      # the target load can go too if nothing else uses it
+      load = cfg.jump_target_load(block)
+      load_idx = block.instructions.index(load)
+      if any(_reads_a(inst) for inst in block.instructions[load_idx + 1:]):
+        continue
+      if 'A' in live_in[target] or self._removal_hazard(block, load_idx):
+        continue
+      load.emit = False
+
+    return modified
+
+  def _invert_branches(self, instructions):
+    cfg = self._control_flow_graph(instructions)
+    live_in, _ = cfg.liveness()
+
+    modified = False
+    for block in cfg.blocks[:-2]:
+      jump = block.jump_instruction
+      if jump is None or jump.jump not in INVERTED_JUMPS or 'M' in jump.dest:
+        continue
+
+      # the block jumped over must only be reachable from here and do nothing but jump
+      over = cfg.blocks[block.index + 1]
+      target = cfg.blocks[block.index + 2]
+      if block.jump_target is None or cfg.label_blocks[block.jump_target] is not target:
+        continue
+      if over.labels or len(over.instructions) != 2:
+        continue
+
+      over_load, over_jump = over.instructions
+      if type(over_load) != A_Instruction or over_load.symbol not in cfg.label_blocks:
+        continue
+      if over_jump.dest or not is_unconditional_jump(over_jump):
+        continue
+
+      # after inverting we fall through to target with A loaded with the other label
+      load = cfg.exclusive_jump_load(block)
+      if load is None or 'A' in live_in[target]:
+        continue
+
+      load.retarget(over_load.symbol)
+      jump.jump = INVERTED_JUMPS[jump.jump]
+      jump.regenerate_expression()
+      over_load.emit = False
+      over_jump.emit = False
+      modified = True
+
+    return modified
+
+  def _remove_unreachable_code(self, instructions):
+    """
+    Removes blocks which cannot be reached from the first instruction, such as code after an
+    unconditional jump or subroutines which are never called. Blocks removed are recorded in
+    self.unreachable_code.
+    """
+    cfg = self._control_flow_graph(instructions)
+    reachable = cfg.reachable_blocks()
+
+    for block in cfg.blocks:
+      if block in reachable or not block.instructions:
+        continue
+
+      for inst in block.instructions:
+        inst.emit = False
+      self.unreachable_code.append((block.labels, len(block.instructions)))
+
+  def _load_value(self, inst, labels):
+    """
+    Returns what inst loads into A: an int if it is known, otherwise the symbol. Labels are
+    always returned as symbols b/c their addresses change as instructions are removed, as are
+    constants defined outside the block being optimised for the cache.
+    """
+    if inst.symbol is None:
+      return inst.value
+    if inst.symbol in labels or inst.symbol not in self.known_symbols:
+      return inst.symbol
+    if (self._block_constants is not None and inst.symbol not in self._block_constants
+        and self.known_symbols.kind(inst.symbol) != SYMBOL_PREDEFINED):
+      return inst.symbol
+    return self.known_symbols[inst.symbol] & 0x7FFF
+
+  def _propagate_constants(self, instructions):
+    """
+    Tracks what A, D and W hold through each basic block, and into blocks with a single
+    predecessor, and uses it to
+
+      1. remove A-instructions which load what A already holds
+      2. remove C-instructions which write registers with what they already hold
+      3. replace computations with a known result of 0, 1 or -1 with that constant, e.g.
+         @0; D=A becomes @0; D=0, which may leave the A-instruction dead
+      4. make jumps with a known outcome unconditional, or remove them
+
+    A register holds either an int, a symbol whose value is not known yet, or nothing if it is
+    not in the dict.
+    """
+    cfg = self._control_flow_graph(instructions)
+    labels = set(cfg.label_blocks)
+
+    modified = False
+    exit_values = {}
+    for block in cfg.blocks:
+      values = dict(exit_values.get(block.unique_predecessor, {}))
+
+      for idx, inst in enumerate(block.instructions):
+        if type(inst) == A_Instruction:
+          value = self._load_value(inst, labels)
+          if values.get('A') == value and not self._removal_hazard(block, idx):
+            inst.emit = False
+          else:
+            values['A'] = value
+          continue
+
+        if type(inst) != C_Instruction:
+          continue
+
+        result = evaluate_comp(inst.comp, values)
+        if result is None and inst.comp in REGISTERS:
+          # copying a register copies what we know of it, even if it is only a symbol
+          result = values.get(inst.comp)
+
+        written = inst.registers_written()
+        if (result is not None and written and 'M' not in inst.dest
+            and inst.jump == NO_JUMP
+            and all(values.get(r) == result for r in written)
+            and not self._removal_hazard(block, idx)):
+          inst.emit = False
+          continue
+
+        if isinstance(result, int):
+          if result in CONSTANT_VALUE_COMPS and inst.comp not in CONSTANT_COMPS:
+            inst.comp = CONSTANT_VALUE_COMPS[result]
+            inst.regenerate_expression()
+            modified = True
+
+          if inst.jump in JUMP_CONDITIONS and not is_unconditional_jump(inst):
+            signed = result - 0x10000 if result & 0x8000 else result
+            if JUMP_CONDITIONS[inst.jump](signed):
+              inst.jump = 'JMP'
+              inst.regenerate_expression()
+              modified = True
+            elif inst.dest:
+              inst.jump = NO_JUMP
+              inst.regenerate_expression()
+              modified = True
+            elif not self._removal_hazard(block, idx):
+              inst.emit = False
+              continue
+
+        for r in written:
+          if result is None:
+            values.pop(r, None)
+          else:
+            values[r] = result
+
+      exit_values[block] = values
+
+    return modified
+
+  def _fold_label_loads(self, instructions):
+    """
+    Removes loads of labels whose address is already in A. A label's address is final once all
+    instructions before it are, so walking the program in order we can use the addresses of the
+    labels already passed.
+    """
+    cfg = self._control_flow_graph(instructions)
+    addresses = {}
+    exit_a = {}
+    pc = 0
+    for block in cfg.blocks:
+      for label in block.labels:
+        addresses[label] = pc
+
+      a = exit_a.get(block.unique_predecessor)
+      for idx, inst in enumerate(block.instructions):
+        if type(inst) == A_Instruction:
+          if inst.symbol is None:
+            value = inst.value
+          elif inst.symbol in addresses:
+            value = addresses[inst.symbol]
+          elif inst.symbol in cfg.label_blocks or inst.symbol not in self.known_symbols:
+            value = None
+          else:
+            value = self.known_symbols[inst.symbol] & 0x7FFF
+
+          if value is not None and value == a and not self._removal_hazard(block, idx):
             inst.emit = False
-        last_a_inst = inst
+            continue
+          a = value
+
+        elif 'A' in inst.dest:
+          a = evaluate_comp(inst.comp, {'A': a})
+
+        pc += 1
+
+      exit_a[block] = a
+
+  def _schedule_hazard_slots(self, instructions):
+    """
+    Fills the NOPs generated around M-writes with instructions from up to SCHEDULE_WINDOW
+    instructions away in the same basic block, e.g.
+
+      A=W
+      0
+      M=D
+      W=W+1
+
+    becomes
+
+      A=W
+      W=W+1
+      M=D
+
+    An instruction can only move past instructions it is independent of, and the result must
+    still obey the memory timing rules.
+    """
+    cfg = self._control_flow_graph(instructions)
+    positions = None
+
+    for block in cfg.blocks:
+      work = list(block.instructions)
+      filled = False
+      for idx, inst in enumerate(work):
+        if inst.emit and inst.generated and _is_nop(inst) and self._fill_hazard_slot(work, idx):
+          filled = True
+
+      if not filled:
+        continue
+
+      if positions is None:
+        positions = {id(inst): pos for pos, inst in enumerate(instructions)}
+
+      # the block occupies the same positions in the program, just in a different order
+      for old, new in zip(block.instructions, work):
+        instructions[positions[id(old)]] = new
+
+  def _fill_hazard_slot(self, work, idx):
+    """
+    Tries to swap the NOP at work[idx] with a nearby instruction, which then takes its place,
+    and removes the NOP. Returns True if it did.
+    """
+    nop = work[idx]
+    for distance in range(1, SCHEDULE_WINDOW + 1):
+      for k in (idx + distance, idx - distance):
+        if not 0 <= k < len(work):
+          continue
+
+        inst = work[k]
+        if not inst.emit or not _schedulable(inst):
+          continue
+
+        lo, hi = min(idx, k), max(idx, k)
+        if not all(_independent(inst, other) for other in work[lo + 1:hi] if other.emit):
+          continue
+
+        work[idx], work[k] = inst, nop
+        nop.emit = False
+        if not self._schedule_hazard(work, lo, hi):
+          return True
+
+        work[idx], work[k] = nop, inst
+        nop.emit = True
+
+    return False
 
-      # modifying A should force the next A-instruction to emit
-      if type(inst) == C_Instruction:
-        if 'A' in inst.dest:
-          last_a_inst = None
+  def _schedule_hazard(self, work, lo, hi):
+    """
+    Returns True if the instructions in work[lo:hi+1], together with those either side, break the
+    hazard model. Instructions moved by the scheduler never access memory so only the end of the
+    block needs care, where the instruction after it is not known.
+    """
+    prev = next((inst for inst in reversed(work[:lo]) if inst.emit), None)
+    after = next((inst for inst in work[hi + 1:] if inst.emit), None)
+
+    seq = [inst for inst in work[lo:hi + 1] if inst.emit]
+    if prev is not None:
+      seq.insert(0, prev)
+
+    if after is None:
+      if self._hazard_model.hazard_after(seq[-1]):
+        return True
+    else:
+      seq.append(after)
+
+    return any(self._hazard_model.hazard(prev, inst) for prev, inst in zip(seq, seq[1:]))
+
+register_optimisation_pass(OPT_LOADS, Assembler._remove_redundant_loads)
+register_optimisation_pass(OPT_CONSEC_NOPS, Assembler._remove_consecutive_nops)
+register_optimisation_pass(OPT_UNNEEDED_NOPS, Assembler._remove_unneeded_nops)
+register_optimisation_pass(OPT_MULTIDEST_ASSIGNMENT,
+                           Assembler._optimise_using_multi_destination_assignments)
+register_optimisation_pass(OPT_DEAD_STORES, Assembler._remove_dead_stores)
+register_optimisation_pass(OPT_PEEPHOLE, Assembler._apply_peephole_rules)
+register_optimisation_pass(OPT_JUMP_THREADING, Assembler._thread_jumps)
+register_optimisation_pass(OPT_UNREACHABLE, Assembler._remove_unreachable_code)
+register_optimisation_pass(OPT_CONSTANTS, Assembler._propagate_constants)
+register_optimisation_pass(OPT_SCHEDULE, Assembler._schedule_hazard_slots)
 
 class Instruction:
-  def __init__(self, expression, generated=False, source_block=None):
+  # there is one instance per line of the program so we use __slots__ to keep them small
+  __slots__ = ('expression', 'generated', 'emit', '_src', '_src_start', '_src_len', '_warnings',
+               '_regenerated')
+
+  def __init__(self, expression, generated=False, source_block=None, source_span=None):
     """
     :param generated: when True means the instruction was generated by us instead of coming
                       from the user.
     :param source_block: source block is all text between the last instruction
                          and this one, inclusive of the instruction itself.
                          This includes comments and jump labels.
+    :param source_span: alternative to source_block as a tuple of (lines, start, end) where
+                        lines[start:end] is the source block. This lets instructions share
+                        the source text instead of each holding a list of lines. lines may be
+                        None if the source is not retained.
     """
 
     self.expression = expression
 
     self.generated = generated
-    self.source_block = source_block
     self.emit = True
 
-    self._warnings = []
+    # the length is stored instead of the end b/c small ints are shared by the interpreter
+    if source_span is not None:
+      self._src, self._src_start, end = source_span
+      self._src_len = end - self._src_start
+    elif source_block is not None:
+      self._src, self._src_start, self._src_len = source_block, 0, len(source_block)
+    else:
+      self._src, self._src_start, self._src_len = None, 0, 0
+
+    # most instructions never warn so the list is only created when needed
+    self._warnings = None
+
+    # set when an optimiser rewrites the expression
+    self._regenerated = False
+
+  @property
+  def source_block(self):
+    if self._src is None:
+      return None
+    else:
+      return self._src[self._src_start:self._src_start + self._src_len]
+
+  @property
+  def source_span(self):
+    """
+    Returns (start, end) of the source block in the lines this instruction was parsed from
+    """
+    return self._src_start, self._src_start + self._src_len
 
   def warnings(self):
-    return list(self._warnings)
+    if self._warnings is None:
+      return []
+    else:
+      return list(self._warnings)
 
   def get_annotations(self):
     """
     Returns a list of annotations lines
     """
-    if self.source_block:
-      return self.source_block
+    source_block = self.source_block
+    if source_block:
+      # the source block is shared with the assembler so rather than modify it we substitute
+      # the regenerated expression here
+      if self._regenerated:
+        source_block[-1] = self.expression
+      return source_block
     else:
       ret = []
       if self.generated:
@@ -770,8 +2457,13 @@ class Instruction:
       return ret
 
   def warn(self, warning):
+    """
+    Records a warning. Warnings are reported by the Assembler when it
+    gathers them.
+    """
+    if self._warnings is None:
+      self._warnings = []
     self._warnings.append(warning)
-    _stderr_warn(warning)
 
   def parse_numeric_constant(self, token):
     """
@@ -829,34 +2521,45 @@ class Instruction:
     """
     raise NotImplementedError()
 
-  def num_pre_nops(self):
+  def registers_read(self):
     """
-    Returns number of nop instructions that needs to be inserted BEFORE
-    this instruction should be executed.
+    Returns the set of registers, out of REGISTERS, whose value this instruction uses
     """
-    raise NotImplementedError()
+    return set()
 
-  def num_post_nops(self):
+  def registers_written(self):
     """
-    Returns number of nop instructions that needs to be inserted AFTER
-    this instruction should be executed.
+    Returns the set of registers, out of REGISTERS, this instruction writes to
     """
-    raise NotImplementedError()
+    return set()
 
-  def resolve(self, known_symbols, compat=False):
+  def encode(self, known_symbols, compat=False):
     """
-    Resolves this instruction into HACK machine code. Returns
-    machine code as text, suitable for use with $readmemb in verilog.
+    Resolves this instruction into HACK machine code. Returns machine code
+    as an integer, or None if this instruction does not emit machine code.
 
     If compat is True then all use of non-HACK compatible instructions
     will fail.
     """
     raise NotImplementedError()
 
+  def resolve(self, known_symbols, compat=False):
+    """
+    Like encode() but returns machine code as text, suitable for use with
+    $readmemb in verilog.
+    """
+    code = self.encode(known_symbols, compat=compat)
+    if code is None:
+      return None
+    else:
+      return format_machine_code(code)
+
   def __str__(self):
     return f'[{type(self).__name__}] {self.expression}'
 
 class Label_Instruction(Instruction):
+  __slots__ = ('symbol',)
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.emit = False
@@ -864,44 +2567,72 @@ class Label_Instruction(Instruction):
     if len(self.expression) < 3:
       raise SyntaxError(f'Invalid Label instruction: {self.expression}')
 
+    self.symbol = sys.intern(self.expression[1:-1])
+
   def symbols(self):
-    return [self.expression[1:-1]]
+    return [self.symbol]
 
-  def resolve(self, known_symbols, compat=False):
+  def encode(self, known_symbols, compat=False):
     return None
 
 class A_Instruction(Instruction):
+  # the operand is parsed once, on construction, into either value or symbol
+  __slots__ = ('value', 'symbol')
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     if len(self.expression) < 2:
       raise SyntaxError(f'Invalid A instruction: {self.expression}')
 
-  def symbols(self):
     v = self.expression[1:]
 
-    # we have a valid numeric constant so this isn't a symbol
-    try:
-      self.parse_numeric_constant(v)
+    # numeric constants always start with a digit or a sign, so most symbols can be told apart
+    # without trying to parse them
+    if v[0] in NUMERIC_START:
+      try:
+        self.value = self.parse_numeric_constant(v)
+        self.symbol = None
+        return
+      except SyntaxError:
+        pass
+
+    # not a valid numeric constant so this is a symbol. Symbols are referenced many times so
+    # intern them to share a single copy
+    self.value = None
+    self.symbol = sys.intern(v)
+
+  def symbols(self):
+    if self.symbol is None:
       return []
-    except SyntaxError:
-      return [v]
+    else:
+      return [self.symbol]
 
-  def resolve(self, known_symbols, compat=False):
-    src = self.expression
-    try:
-      val = self.parse_numeric_constant(src[1:])
-    except SyntaxError:
-      val = None
+  def retarget(self, symbol):
+    """
+    Makes this instruction load symbol instead. Used by optimisers to redirect jumps
+    """
+    self.symbol = sys.intern(symbol)
+    self.value = None
+    self.expression = '@' + symbol
+    self._regenerated = True
+
+  def registers_written(self):
+    return {'A'}
 
-    if val is None:
-      label = src[1:]
+  def encode(self, known_symbols, compat=False):
+    if self.symbol is None:
+      val = self.value
+    else:
+      label = self.symbol
       if not label in known_symbols:
         raise NameError(f'Unknown label {label}')
       val = known_symbols[label]
 
-    return f'0{val:015b}'
+    return val & 0x7FFF
 
 class C_Instruction(Instruction):
+  __slots__ = ('dest', 'comp', 'jump')
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.expression = self.expression.replace(' ', '')
@@ -926,8 +2657,9 @@ class C_Instruction(Instruction):
     else:
       comp = src
 
-    self.dest = dest
-    self.comp = comp
+    # there are only a handful of distinct values so share them
+    self.dest = sys.intern(dest)
+    self.comp = sys.intern(comp)
     self.jump = jump
 
   def regenerate_expression(self):
@@ -945,102 +2677,985 @@ class C_Instruction(Instruction):
       expr += ';' + self.jump
 
     self.expression = expr
-
-    if self.source_block:
-      self.source_block[-1] = expr
+    self._regenerated = True
 
   def symbols(self):
     return []
 
-  def num_pre_nops(self):
-    # writes need an op to allow the RAM address to settle
-    if 'M' in self.dest:
-      return 1
-    else:
-      return 0
+  def registers_read(self):
+    regs = {r for r in REGISTERS if r in self.comp}
 
-  def num_post_nops(self):
-    # writes need an op to allow the RAM to update
-    if 'M' in self.dest:
-      return 1
-    else:
-      return 0
+    # accessing M uses A as the address, and jumping uses A as the destination
+    if 'M' in self.comp or 'M' in self.dest or self.jump != NO_JUMP:
+      regs.add('A')
 
-  def resolve(self, known_symbols, compat=False):
-    a = int('M' in self.comp)
-    w = int('W' in self.comp)
-    d1 = int('A' in self.dest)
-    d2 = int('D' in self.dest)
-    d3 = int('M' in self.dest)
-    d4 = int('W' in self.dest)
-    j1 = int(self.jump in 'JLT JLE JNE')
-    j2 = int(self.jump in 'JLE JGE JEQ')
-    j3 = int(self.jump in 'JGT JGE JNE')
-
-    if compat and (w or d4):
+    return regs
+
+  def registers_written(self):
+    return {r for r in REGISTERS if r in self.dest}
+
+  def encode(self, known_symbols=None, compat=False):
+    key = (self.dest, self.comp, self.jump)
+    try:
+      code = _C_ENCODING_CACHE[key]
+    except KeyError:
+      code = _C_ENCODING_CACHE[key] = self._encode_uncached()
+
+    if compat and code & HACKX_BITS != HACKX_BITS:
       raise SyntaxError('W is not available when in compatibility mode')
 
-    comp_table = {
-        '0'     : '101010',
-        '1'     : '111111',
-        '-1'    : '111010',
-        'D'     : '001100',
-        'A'     : '110000',
-        '!D'    : '001101',
-        '!A'    : '110001',
-        '-D'    : '001111',
-        '-A'    : '110011',
-        'D+1'   : '011111',
-        'A+1'   : '110111',
-        'D-1'   : '001110',
-        'A-1'   : '110010',
-        'D+A'   : '000010',
-        'D-A'   : '010011',
-        'A-D'   : '000111',
-        'D&A'   : '000000',
-        'D|A'   : '010101',
-    }
+    return code
 
-    comp = self.comp
+  def _encode_uncached(self):
+    for c in self.dest:
+      if c not in DEST_REGISTERS and c != ',':
+        raise SyntaxError(f'Invalid destination {self.dest}: {self.expression}')
+
+    dest = ''.join(r for r in DEST_REGISTERS if r in self.dest)
 
     # remove all white space
-    comp = comp.replace(' ', '')
+    comp = self.comp.replace(' ', '')
 
-    if a and w:
+    if 'M' in comp and 'W' in comp:
       raise SyntaxError('Cannot use W and M in computation at the same time')
 
-    if a:
-      # replace M with A in comp for lookup purposes
-      comp = comp.replace('M', 'A')
-
-    if w:
-      # replace W with A in comp for lookup purposes
-      comp = comp.replace('W', 'A')
+    if self.jump not in JUMP_TABLE:
+      raise SyntaxError(f'Unsupported jump {self.jump}: {self.expression}')
 
     try:
-      c1_c6 = comp_table[comp]
+      return C_ENCODING_TABLE[(dest, comp, self.jump)]
     except KeyError:
-      try:
-        # for some operation the ordering doesn't matter
-        # so we will accept D+A and A+D even though only
-        # D+A is defined in the comp t able
-        if len(comp) == 3 and comp[1] in '+|&':
-          comp = comp[::-1]
-          c1_c6 = comp_table[comp]
-        else:
-          raise
-      except KeyError:
-        raise Exception(f'Unsupported computation {comp}: {self.expression}')
+      raise Exception(f'Unsupported computation {comp}: {self.expression}')
 
-    # invert w and d
-    w = 1 - w
-    d4 = 1 - d4
-    return f'1_{w}_{d4}_{a}_{c1_c6}_{d1}{d2}{d3}_{j1}{j2}{j3}'
+  def resolve(self, known_symbols=None, compat=False):
+    return format_machine_code(self.encode(known_symbols, compat=compat), pretty_print=True)
 
 class NOP_Instruction(C_Instruction):
+  __slots__ = ()
+
   def __init__(self):
     super().__init__('0', generated=True)
 
+def is_unconditional_jump(inst):
+  """
+  Returns True if inst always jumps, either b/c it is a JMP or b/c it jumps on a constant
+  computation that satisfies the jump condition
+  """
+  if inst.jump == 'JMP':
+    return True
+
+  value = CONSTANT_COMPS.get(inst.comp)
+  if value is None or inst.jump not in JUMP_CONDITIONS:
+    return False
+
+  return JUMP_CONDITIONS[inst.jump](value)
+
+def evaluate_comp(comp, values):
+  """
+  Returns the 16 bit result of the computation comp given values, a dict of register -> value,
+  or None if the result is not known. Only int values are used, and M is never known.
+  """
+  def operand(token):
+    if token == '1':
+      return 1
+    value = values.get(token)
+    return value if isinstance(value, int) else None
+
+  if comp in CONSTANT_COMPS:
+    return CONSTANT_COMPS[comp] & 0xFFFF
+
+  if len(comp) == 1:
+    return operand(comp)
+
+  if len(comp) == 2 and comp[0] in '!-':
+    x = operand(comp[1])
+    if x is None:
+      return None
+    return (~x if comp[0] == '!' else -x) & 0xFFFF
+
+  for op, func in (('+', lambda x, y: x + y),
+                   ('-', lambda x, y: x - y),
+                   ('&', lambda x, y: x & y),
+                   ('|', lambda x, y: x | y)):
+    if op in comp[1:]:
+      x, y = comp.split(op, 1)
+      x = operand(x)
+      y = operand(y)
+      if x is None or y is None:
+        return None
+      return func(x, y) & 0xFFFF
+
+  return None
+
+def _reads_a(inst):
+  # M is read from the address in A, but that does not make use of the value of A
+  return type(inst) != A_Instruction and 'A' in inst.comp
+
+def _writes_a(inst):
+  return type(inst) == A_Instruction or 'A' in inst.dest
+
+def _is_nop(inst):
+  return isinstance(inst, C_Instruction) and inst.dest == '' and inst.expression == '0'
+
+def _accesses_memory(inst):
+  return isinstance(inst, C_Instruction) and ('M' in inst.dest or 'M' in inst.comp)
+
+def _writes_memory(inst):
+  return isinstance(inst, C_Instruction) and 'M' in inst.dest
+
+def _schedulable(inst):
+  # jumps end their block, and something which accesses memory could never sit next to an M-write
+  if isinstance(inst, C_Instruction):
+    return inst.jump == NO_JUMP and not _is_nop(inst) and not _accesses_memory(inst)
+  return type(inst) == A_Instruction
+
+def _independent(inst, other):
+  """
+  Returns True if inst and other give the same result whichever order they execute in
+  """
+  read, written = inst.registers_read(), inst.registers_written()
+  other_read, other_written = other.registers_read(), other.registers_written()
+  if written & (other_read | other_written) or other_written & read:
+    return False
+
+  return not (_accesses_memory(inst) and _accesses_memory(other)
+              and (_writes_memory(inst) or _writes_memory(other)))
+
+def _reads_memory(inst):
+  return isinstance(inst, C_Instruction) and 'M' in inst.comp
+
+def _may_precede_memory_write(inst):
+  return _is_nop(inst) or not (_accesses_memory(inst) or _writes_a(inst))
+
+class ObjectModule:
+  """
+  A relocatable module written by `assembler.py --object` and read by linker.py.
+
+  code holds the machine code of every emitted instruction, with A-instructions which load a
+  label or an imported symbol left as 0 and listed in relocations as (index, symbol). Addresses
+  in labels are relative to the start of the module. Imports are the symbols this module uses
+  but does not define, in the order they are first used. The linker resolves them to the labels
+  and constants of other modules and allocates the rest as variables.
+
+  sections holds the index of the first instruction of each section. A section starts at a label
+  which follows an unconditional jump, so no code falls through into it and the linker is free
+  to move it. Only the last section can fall through, into the next module, if falls_through is
+  True.
+  """
+  __slots__ = ('name', 'code', 'relocations', 'labels', 'constants', 'imports', 'sections',
+               'falls_through', 'hazard_model', 'compat')
+
+  def __init__(self, name, code, relocations, labels, constants, imports, sections, falls_through,
+               hazard_model, compat):
+    self.name = name
+    self.code = code
+    self.relocations = relocations
+    self.labels = labels
+    self.constants = constants
+    self.imports = imports
+    self.sections = sections
+    self.falls_through = falls_through
+    self.hazard_model = hazard_model
+    self.compat = compat
+
+  def to_dict(self):
+    return dict(format=OBJECT_FORMAT,
+                version=OBJECT_FORMAT_VERSION,
+                name=self.name,
+                hazard_model=self.hazard_model,
+                compat=self.compat,
+                code=self.code,
+                relocations=[list(r) for r in self.relocations],
+                labels=self.labels,
+                constants=self.constants,
+                imports=self.imports,
+                sections=self.sections,
+                falls_through=self.falls_through)
+
+  @classmethod
+  def from_dict(cls, d):
+    if d.get('format') != OBJECT_FORMAT or d.get('version') != OBJECT_FORMAT_VERSION:
+      raise ValueError(f'Not a version {OBJECT_FORMAT_VERSION} {OBJECT_FORMAT} object')
+
+    return cls(name=d['name'],
+               code=d['code'],
+               relocations=[(idx, symbol) for idx, symbol in d['relocations']],
+               labels=d['labels'],
+               constants=d['constants'],
+               imports=d['imports'],
+               sections=d['sections'],
+               falls_through=d['falls_through'],
+               hazard_model=d['hazard_model'],
+               compat=d['compat'])
+
+  def write(self, path=None):
+    """
+    Writes this module as JSON to path, or stdout if path is None
+    """
+    if path is None:
+      json.dump(self.to_dict(), sys.stdout)
+      sys.stdout.write('\n')
+    else:
+      with open(path, 'w') as fh:
+        json.dump(self.to_dict(), fh)
+
+  @classmethod
+  def read(cls, path):
+    with open(path) as fh:
+      return cls.from_dict(json.load(fh))
+
+class SizeReport:
+  """
+  Attributes the emitted instructions of a program to the func_/sub_ block or VM function they
+  are in. VM functions are found from the annotations written by vm2asm.py -A. The instructions
+  of each block are split into those written by the user, NOPs inserted for hazards and those
+  from macro expansions, and the instructions each optimisation pass removed are counted too.
+  """
+
+  def __init__(self, rom_words=EBR_ROM_WORDS):
+    self.rom_words = rom_words
+
+    # maps block names, in program order, to a Counter of user, nops and macro instructions
+    self.blocks = {}
+
+    # maps block names to a Counter of instructions removed by each optimisation pass
+    self.removed = {}
+
+    # address of the first instruction of each block
+    self.addresses = {}
+
+  @staticmethod
+  def _walk(instructions):
+    """
+    Generator of (instruction, block name, True if from a macro) for each of instructions
+    """
+    block = SIZE_REPORT_TOP_LEVEL
+    in_macro = False
+    for inst in instructions:
+      if type(inst) == Label_Instruction:
+        if inst.symbol.startswith('func_') or inst.symbol.startswith('sub_'):
+          block = inst.symbol
+        yield inst, block, in_macro
+        continue
+
+      # labels share the source block of the next instruction so it is only looked at here
+      if not inst.generated:
+        for l in inst.source_block or ():
+          if l.startswith('// MACRO_START'):
+            in_macro = True
+          elif l.startswith('// MACRO_END'):
+            in_macro = False
+          else:
+            m = VM_FUNCTION_ANNOTATION_RE.match(l)
+            if m:
+              block = m.group(1)
+
+      yield inst, block, in_macro
+
+  def record_pass(self, name, instructions, emitted_before):
+    """
+    Records the instructions removed by optimisation pass name given which of instructions were
+    emitted before it ran
+    """
+    for (inst, block, _), emitted in zip(self._walk(instructions), emitted_before):
+      if emitted != inst.emit:
+        removed = self.removed.setdefault(block, Counter())
+        removed[name] += 1 if emitted else -1
+
+  def record_program(self, instructions):
+    """
+    Records the size of each block of the final program
+    """
+    pc = 0
+    for inst, block, in_macro in self._walk(instructions):
+      sizes = self.blocks.get(block)
+      if sizes is None:
+        sizes = self.blocks[block] = Counter()
+        self.addresses[block] = pc
+
+      if type(inst) == Label_Instruction or not inst.emit:
+        continue
+
+      if inst.generated and _is_nop(inst):
+        sizes['nops'] += 1
+      elif in_macro:
+        sizes['macro'] += 1
+      else:
+        sizes['user'] += 1
+      pc += 1
+
+    # blocks optimised away entirely only show up in removed
+    for block in self.removed:
+      if block not in self.blocks:
+        self.blocks[block] = Counter()
+        self.addresses[block] = None
+
+  @property
+  def total(self):
+    return sum(sum(sizes.values()) for sizes in self.blocks.values())
+
+  def warnings(self):
+    if self.total > self.rom_words:
+      return [f'Program of {self.total} instructions does not fit in the {self.rom_words} word '
+              f'ROM']
+    elif self.total >= self.rom_words * ROM_BUDGET_WARNING:
+      return [f'Program uses {self.total} of the {self.rom_words} words of the ROM '
+              f'({100 * self.total / self.rom_words:.1f}%)']
+    return []
+
+  def to_dict(self):
+    blocks = []
+    for name, sizes in self.blocks.items():
+      removed = self.removed.get(name, Counter())
+      blocks.append(dict(name=name,
+                         address=self.addresses[name],
+                         total=sum(sizes.values()),
+                         user=sizes['user'],
+                         nops=sizes['nops'],
+                         macro=sizes['macro'],
+                         removed=dict(removed)))
+
+    removed = Counter()
+    for counts in self.removed.values():
+      removed.update(counts)
+
+    return dict(total=self.total,
+                rom_words=self.rom_words,
+                rom_used=self.total / self.rom_words,
+                user=sum(block['user'] for block in blocks),
+                nops=sum(block['nops'] for block in blocks),
+                macro=sum(block['macro'] for block in blocks),
+                removed=dict(removed),
+                blocks=blocks)
+
+  def write_json(self, path):
+    """
+    Writes the report as JSON to path, or stdout if path is '-'
+    """
+    if path == '-':
+      json.dump(self.to_dict(), sys.stdout, indent=2)
+      sys.stdout.write('\n')
+    else:
+      with open(path, 'w') as fh:
+        json.dump(self.to_dict(), fh, indent=2)
+
+class SymbolTable(dict):
+  """
+  Maps symbols to their values like a dict. In addition every symbol is interned and given an
+  integer id, in the order symbols are first defined, and a kind which is one of SYMBOL_LABEL,
+  SYMBOL_VARIABLE, SYMBOL_CONSTANT or SYMBOL_PREDEFINED. Assigning a value directly defines a
+  constant unless the symbol is already known.
+  """
+  __slots__ = ('_ids', '_kinds')
+
+  def __init__(self, predefined=None):
+    super().__init__()
+    self._ids = {}
+    self._kinds = {}
+    for symbol, value in (predefined or {}).items():
+      self.define(symbol, value, SYMBOL_PREDEFINED)
+
+  def define(self, symbol, value, kind):
+    """
+    Sets the value and kind of symbol, giving it an id if it is new. Returns the id.
+    """
+    symbol = sys.intern(symbol)
+    symbol_id = self._ids.setdefault(symbol, len(self._ids))
+    self._kinds[symbol] = kind
+    dict.__setitem__(self, symbol, value)
+    return symbol_id
+
+  def set_value(self, symbol, value):
+    """
+    Changes the value of a known symbol, e.g. the address of a label after optimisation
+    """
+    dict.__setitem__(self, symbol, value)
+
+  def id(self, symbol):
+    return self._ids[symbol]
+
+  def kind(self, symbol):
+    return self._kinds[symbol]
+
+  def symbols(self, kind):
+    """
+    Returns the symbols of the given kind in id order
+    """
+    return [symbol for symbol in self._ids if self._kinds[symbol] == kind]
+
+  def __setitem__(self, symbol, value):
+    self.define(symbol, value, self._kinds.get(symbol, SYMBOL_CONSTANT))
+
+  def update(self, *args, **kwargs):
+    for symbol, value in dict(*args, **kwargs).items():
+      self[symbol] = value
+
+class HazardModel:
+  """
+  Describes the pipeline hazards of a hardware variant: how many NOPs the assembler puts around
+  an instruction, and which instructions cannot execute back to back. Optimisations only remove
+  or move instructions when the result is free of hazards, so removing NOPs follows the same
+  rules as inserting them.
+  """
+  name = None
+
+  def num_pre_nops(self, inst):
+    """
+    Returns number of nop instructions that needs to be inserted BEFORE inst
+    """
+    return 0
+
+  def num_post_nops(self, inst):
+    """
+    Returns number of nop instructions that needs to be inserted AFTER inst
+    """
+    return 0
+
+  def hazard(self, prev, inst):
+    """
+    Returns True if inst cannot execute straight after prev
+    """
+    return False
+
+  def hazard_after(self, prev):
+    """
+    Returns True if prev cannot be followed by an instruction which is not known, e.g. the first
+    instruction of another block. NOPs inserted before an instruction are always in the same
+    block as it, so only what prev needs after it matters.
+    """
+    return False
+
+class IdealHazardModel(HazardModel):
+  """
+  Memory behaves like a register, as in the CPU emulator of the course, so no NOPs are needed
+  """
+  name = HAZARD_IDEAL
+
+class InvertedClockHazardModel(HazardModel):
+  """
+  The RAM is clocked on the falling edge of the CPU clock, see README. Reads need no NOPs. The
+  cycle before a write must leave A and memory alone, and nothing may access memory in the cycle
+  after it.
+  """
+  name = HAZARD_INVERTED_CLOCK
+
+  def num_pre_nops(self, inst):
+    # writes need an op to allow the RAM address to settle
+    return 1 if _writes_memory(inst) else 0
+
+  def num_post_nops(self, inst):
+    # writes need an op to allow the RAM to update
+    return 1 if _writes_memory(inst) else 0
+
+  def hazard(self, prev, inst):
+    if _writes_memory(prev) and _accesses_memory(inst):
+      return True
+
+    return _writes_memory(inst) and not _may_precede_memory_write(prev)
+
+  def hazard_after(self, prev):
+    return _writes_memory(prev)
+
+class OriginalClockHazardModel(InvertedClockHazardModel):
+  """
+  The RAM shares the clock of the CPU, as before the 2020-04-29 update in README. A new address
+  only reaches the RAM on the next clock edge so reads also need the cycle before them to leave
+  A alone.
+  """
+  name = HAZARD_ORIGINAL
+
+  def num_pre_nops(self, inst):
+    return 1 if _accesses_memory(inst) else 0
+
+  def hazard(self, prev, inst):
+    if _reads_memory(inst) and _writes_a(prev):
+      return True
+
+    return super().hazard(prev, inst)
+
+HAZARD_MODELS = {model.name: model for model in (InvertedClockHazardModel(),
+                                                 OriginalClockHazardModel(),
+                                                 IdealHazardModel())}
+
+class BasicBlock:
+  """
+  A run of instructions which can only be entered at the top and only left at the bottom
+  """
+
+  def __init__(self, index):
+    self.index = index
+
+    # labels which mark the start of this block
+    self.labels = []
+
+    # emitted A- and C-instructions, in program order
+    self.instructions = []
+
+    self.successors = []
+    self.predecessors = []
+
+    # the label jumped to, None if there is no jump or the target is not known
+    self.jump_target = None
+
+    # True if the block ends in a jump whose target could not be determined, e.g. A=M;JMP
+    self.computed_jump = False
+
+    # True if the address of this block escapes into a register, in which case it may be the
+    # target of a computed jump and we do not know all of its predecessors
+    self.address_taken = False
+
+  @property
+  def jump_instruction(self):
+    if self.instructions:
+      inst = self.instructions[-1]
+      if isinstance(inst, C_Instruction) and inst.jump != NO_JUMP:
+        return inst
+    return None
+
+  @property
+  def falls_through(self):
+    inst = self.jump_instruction
+    return inst is None or not is_unconditional_jump(inst)
+
+  @property
+  def unique_predecessor(self):
+    """
+    The only block control can arrive from, or None if there is more than one or some of them
+    are unknown. The first block never has one b/c it is entered when the program starts.
+    """
+    if self.index == 0 or self.address_taken or len(self.predecessors) != 1:
+      return None
+    return self.predecessors[0]
+
+  def __str__(self):
+    labels = ','.join(self.labels)
+    succs = ','.join(str(block.index) for block in self.successors)
+    return f'[BasicBlock {self.index}] ({labels}) {len(self.instructions)} insts -> {succs}'
+
+class ControlFlowGraph:
+  """
+  Splits a program into basic blocks. Blocks start at labels and after jumps. Only instructions
+  which are emitted are considered, so the graph must be rebuilt after instructions are
+  removed.
+
+  The target of a jump is taken from the last A-instruction before it in the same block. If there
+  is none, or A was computed, the jump is a computed jump and may go to any block whose address
+  is taken.
+
+  If open_labels is True the instructions are only part of a program and every label may be
+  jumped to from code we cannot see, so all blocks with labels, and the first block, are treated
+  as address taken.
+  """
+
+  def __init__(self, instructions, open_labels=False):
+    self.blocks = []
+    self.open_labels = open_labels
+
+    # label -> block the label starts
+    self.label_blocks = {}
+
+    self._split(instructions)
+    self._link()
+    self._find_address_taken()
+
+    if open_labels:
+      for block in self.blocks:
+        if block.labels:
+          block.address_taken = True
+
+      # code we cannot see may also fall through into the first block
+      self.blocks[0].address_taken = True
+
+  @property
+  def entry(self):
+    return self.blocks[0]
+
+  @property
+  def address_taken_blocks(self):
+    return [block for block in self.blocks if block.address_taken]
+
+  def reachable_blocks(self):
+    """
+    Returns the set of blocks which can be reached from the entry block. A computed jump can
+    reach any block whose address is taken, and with open_labels so can code we cannot see.
+    """
+    roots = [self.entry]
+    if self.open_labels:
+      roots += self.address_taken_blocks
+
+    reachable = set()
+    pending = list(roots)
+    while pending:
+      block = pending.pop()
+      if block in reachable:
+        continue
+
+      reachable.add(block)
+      pending.extend(block.successors)
+      if block.computed_jump:
+        pending.extend(self.address_taken_blocks)
+
+    return reachable
+
+  def _new_block(self):
+    block = BasicBlock(len(self.blocks))
+    self.blocks.append(block)
+    return block
+
+  def _split(self, instructions):
+    block = self._new_block()
+    for inst in instructions:
+      if type(inst) == Label_Instruction:
+        if block.instructions:
+          block = self._new_block()
+        label = inst.symbol
+        block.labels.append(label)
+        self.label_blocks[label] = block
+
+      elif inst.emit:
+        block.instructions.append(inst)
+        if isinstance(inst, C_Instruction) and inst.jump != NO_JUMP:
+          block = self._new_block()
+
+    # a program ending in a jump leaves an empty block behind
+    if len(self.blocks) > 1 and not block.instructions and not block.labels:
+      self.blocks.pop()
+
+  @staticmethod
+  def jump_target_load(block):
+    """
+    Returns the A-instruction which supplies the target of the jump that ends block, or None if
+    A is not loaded in this block or is computed. The jump itself is not considered b/c the PC is
+    loaded with the value of A before the jump instruction modifies it.
+    """
+    for inst in reversed(block.instructions[:-1]):
+      if type(inst) == A_Instruction:
+        return inst
+      if _writes_a(inst):
+        return None
+    return None
+
+  def exclusive_jump_load(self, block):
+    """
+    Like jump_target_load() but returns None unless the value loaded is only used by the jump,
+    i.e. A is not read before the jump or on the fall through path of a conditional jump. Such a
+    load can be changed to redirect the jump.
+    """
+    load = self.jump_target_load(block)
+    if load is None:
+      return None
+
+    idx = block.instructions.index(load)
+    if any(_reads_a(inst) for inst in block.instructions[idx + 1:]):
+      return None
+
+    if block.falls_through and not self._a_overwritten_on_entry(block.index + 1):
+      return None
+
+    return load
+
+  def _add_edge(self, src, dst):
+    if dst not in src.successors:
+      src.successors.append(dst)
+      dst.predecessors.append(src)
+
+  def _link(self):
+    for block in self.blocks:
+      if block.jump_instruction is not None:
+        load = self.jump_target_load(block)
+        target = self.label_blocks.get(load.symbol) if load else None
+        if target is None:
+          block.computed_jump = True
+        else:
+          block.jump_target = load.symbol
+          self._add_edge(block, target)
+
+      if block.falls_through and block.index + 1 < len(self.blocks):
+        self._add_edge(block, self.blocks[block.index + 1])
+
+  def _find_address_taken(self):
+    """
+    A label's address escapes when it is loaded into A other than to jump to it directly. A
+    jump target load also escapes if A is read before the jump, or on the fall through path of a
+    conditional jump.
+    """
+    computed_loads = set()
+    for block in self.blocks:
+      if block.computed_jump:
+        computed_loads.add(self.jump_target_load(block))
+
+    escaped = set()
+    for block in self.blocks:
+      load = None
+      if block.jump_target is not None:
+        load = self.exclusive_jump_load(block)
+
+      for inst in block.instructions:
+        if type(inst) != A_Instruction or inst is load:
+          continue
+
+        if inst.symbol in self.label_blocks:
+          escaped.add(inst.symbol)
+
+        # numeric jump targets can land anywhere so we know nothing about any predecessors
+        if inst.symbol is None and inst.value != 0 and inst in computed_loads:
+          escaped.update(self.label_blocks)
+          for b in self.blocks:
+            b.address_taken = True
+
+    for label in escaped:
+      self.label_blocks[label].address_taken = True
+
+  def liveness(self):
+    """
+    Returns (live_in, live_out), dicts of block -> set of registers live when entering and
+    leaving the block respectively. All registers are live when leaving by a computed jump, or by
+    running off the end of the program, b/c we do not know what will execute next.
+    """
+    uses = {}
+    kills = {}
+    for block in self.blocks:
+      use = set()
+      kill = set()
+      for inst in reversed(block.instructions):
+        written = inst.registers_written()
+        use = (use - written) | inst.registers_read()
+        kill |= written
+      uses[block] = use
+      kills[block] = kill
+
+    last = self.blocks[-1]
+    live_in = {block: set() for block in self.blocks}
+    live_out = {}
+
+    changed = True
+    while changed:
+      changed = False
+      for block in reversed(self.blocks):
+        out = set()
+        if block.computed_jump or (block is last and block.falls_through):
+          out.update(REGISTERS)
+        for succ in block.successors:
+          out |= live_in[succ]
+        live_out[block] = out
+
+        live = uses[block] | (out - kills[block])
+        if live != live_in[block]:
+          live_in[block] = live
+          changed = True
+
+    return live_in, live_out
+
+  def _a_overwritten_on_entry(self, index):
+    """
+    Returns True if the block at index writes A before reading it
+    """
+    if index >= len(self.blocks):
+      return True
+
+    for inst in self.blocks[index].instructions:
+      if _reads_a(inst):
+        return False
+      if _writes_a(inst):
+        return True
+    return False
+
+class PeepholeRule:
+  """
+  Rewrites a window of consecutive instructions into fewer instructions. pattern and replacement
+  are lists of instruction expressions which may contain wildcards:
+
+    %<name>   matches one of the registers A, D, M or W
+    $<name>   matches the operand of an A-instruction, e.g. @$x
+
+  A wildcard that appears more than once must match the same text each time, and wildcards in
+  the replacement are substituted with what they matched. If guard is given it is called with a
+  dict of wildcard name -> matched text and the rule only applies when it returns True.
+
+  Replacement C-instructions reuse, in order, the matched C-instructions so annotations still
+  point at the source. Replacement A-instructions must be copies of a pattern A-instruction and
+  keep the instruction it matched.
+  """
+  WILDCARD_RE = re.compile(r'([%$])(\w+)')
+
+  def __init__(self, pattern, replacement, guard=None):
+    self.pattern = [p.replace(' ', '') for p in pattern]
+    self.replacement = [r.replace(' ', '') for r in replacement]
+    self.guard = guard
+
+    if len(self.replacement) >= len(self.pattern):
+      raise ValueError(f'Peephole rule {pattern} does not shrink the program')
+
+    self._regexes = [self._compile(p) for p in self.pattern]
+    self._alignment = self._align()
+
+  @classmethod
+  def _compile(cls, pattern):
+    regex = ''
+    seen = set()
+    pos = 0
+    for m in cls.WILDCARD_RE.finditer(pattern):
+      kind, name = m.groups()
+      regex += re.escape(pattern[pos:m.start()])
+      if name in seen:
+        regex += f'(?P={name})'
+      elif kind == '%':
+        regex += f'(?P<{name}>[ADMW])'
+      else:
+        regex += f'(?P<{name}>.+)'
+      seen.add(name)
+      pos = m.end()
+    regex += re.escape(pattern[pos:])
+    return re.compile(regex)
+
+  def _align(self):
+    """
+    Returns, for each replacement instruction, the index of the matched instruction it reuses
+    """
+    alignment = []
+    pos = 0
+    for r in self.replacement:
+      is_a = r.startswith('@')
+      while pos < len(self.pattern):
+        p = self.pattern[pos]
+        pos += 1
+        if is_a and p == r:
+          alignment.append(pos - 1)
+          break
+        if not is_a and not p.startswith('@'):
+          alignment.append(pos - 1)
+          break
+      else:
+        raise ValueError(f'Cannot align {r} with peephole pattern {self.pattern}')
+    return alignment
+
+  @property
+  def keys(self):
+    """
+    Keys of instructions this rule can start matching at, None if it can start at any C-instruction
+    """
+    first = self.pattern[0]
+    if first.startswith('@'):
+      return ['@']
+
+    dest = first.split('=', 1)[0] if '=' in first else ''
+    if '%' in dest:
+      return None
+    return [dest]
+
+  def match(self, instructions):
+    """
+    Returns the dict of wildcard bindings if instructions match the pattern, None otherwise
+    """
+    bindings = {}
+    for regex, inst in zip(self._regexes, instructions):
+      m = regex.fullmatch(inst.expression)
+      if m is None:
+        return None
+
+      for name, value in m.groupdict().items():
+        if bindings.setdefault(name, value) != value:
+          return None
+
+    if self.guard is not None and not self.guard(bindings):
+      return None
+
+    return bindings
+
+  def instantiate(self, matched, bindings, compat=False):
+    """
+    Returns a list of (matched instruction, rewritten instruction) pairs, one per replacement
+    instruction. The rewritten instruction is None if the matched one is kept as is. Raises if
+    a rewritten instruction cannot be encoded.
+    """
+    substitute = lambda m: bindings[m.group(2)]
+
+    ret = []
+    for r, idx in zip(self.replacement, self._alignment):
+      inst = matched[idx]
+      if r.startswith('@'):
+        ret.append((inst, None))
+      else:
+        new = C_Instruction(self.WILDCARD_RE.sub(substitute, r))
+        new.encode(compat=compat)
+        ret.append((inst, new))
+    return ret
+
+class PeepholeMatcher:
+  """
+  Indexes peephole rules by the kind of instruction they start with so that only a handful of
+  rules are tried at each instruction
+  """
+
+  def __init__(self, rules):
+    self.rules_by_key = {}
+    self.any_c_rules = []
+
+    for rule in rules:
+      keys = rule.keys
+      if keys is None:
+        self.any_c_rules.append(rule)
+      else:
+        for key in keys:
+          self.rules_by_key.setdefault(key, []).append(rule)
+
+  @staticmethod
+  def key(inst):
+    return '@' if type(inst) == A_Instruction else inst.dest
+
+  def rules_for(self, inst):
+    rules = self.rules_by_key.get(self.key(inst), [])
+    if isinstance(inst, C_Instruction) and self.any_c_rules:
+      rules = rules + self.any_c_rules
+    return rules
+
+  def matches(self, instructions, idx):
+    """
+    Yields (rule, bindings) for each rule matching instructions starting at idx, in the order
+    the rules were registered
+    """
+    for rule in self.rules_for(instructions[idx]):
+      window = instructions[idx:idx + len(rule.pattern)]
+      if len(window) < len(rule.pattern):
+        continue
+
+      bindings = rule.match(window)
+      if bindings is not None:
+        yield rule, bindings
+
+def _not_memory(*names):
+  return lambda bindings: all(bindings[name] != 'M' for name in names)
+
+PEEPHOLE_RULES = [
+  # X=Y followed by a unary operation on X, e.g. A=M; A=A-1 as emitted for $load_sp
+  PeepholeRule(['%x=%y', '%x=%x+1'], ['%x=%y+1'], guard=_not_memory('x')),
+  PeepholeRule(['%x=%y', '%x=%x-1'], ['%x=%y-1'], guard=_not_memory('x')),
+  PeepholeRule(['%x=%y', '%x=-%x'], ['%x=-%y'], guard=_not_memory('x')),
+  PeepholeRule(['%x=%y', '%x=!%x'], ['%x=!%y'], guard=_not_memory('x')),
+
+  # copying a register back to where it came from
+  PeepholeRule(['%x=%y', '%y=%x'], ['%x=%y'], guard=_not_memory('x', 'y')),
+
+  # a load which is replaced straight away
+  PeepholeRule(['@$x', '@$y'], ['@$y']),
+]
+
+_PEEPHOLE_MATCHER = None
+
+def register_peephole_rule(pattern, replacement, guard=None):
+  """
+  Adds a rule, see PeepholeRule, to those applied by the peephole optimisation
+  """
+  global _PEEPHOLE_MATCHER
+  PEEPHOLE_RULES.append(PeepholeRule(pattern, replacement, guard))
+  _PEEPHOLE_MATCHER = None
+
+def peephole_matcher():
+  global _PEEPHOLE_MATCHER
+  if _PEEPHOLE_MATCHER is None:
+    _PEEPHOLE_MATCHER = PeepholeMatcher(PEEPHOLE_RULES)
+  return _PEEPHOLE_MATCHER
+
 if __name__ == '__main__':
   main()
 
@@ -1616,3 +4231,981 @@ def test_automatic_variable_address_assignment():
   a = Assembler(pretty_print=True, compat=False).assemble(src)
   assert a.known_symbols['ARG0'] != a.known_symbols['ARG1']
 
+def test_assemble_stream():
+  with open('tests/blink.hack') as fh:
+    expected = fh.read().strip()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    output_hack = f'{tmpdir}/blink.hack'
+    Assembler('tests/blink.asm', output_hack=output_hack).assemble_stream()
+    with open(output_hack) as fh:
+      assert fh.read() == expected
+
+def test_assemble_stream_annotate():
+  src = '''
+    $const FOO 3
+    (LOOP)
+      @FOO
+      M=D
+      @VAR
+      D=M
+      @LOOP
+      0;JEQ
+  '''
+  with tempfile.TemporaryDirectory() as tmpdir:
+    output_hack = f'{tmpdir}/out.hack'
+    assembler = Assembler(output_hack=output_hack, annotate=True).assemble_stream(src)
+    with open(output_hack) as fh:
+      streamed = fh.read()
+
+  expected = Assembler(annotate=True).assemble(src)
+  assert streamed == expected.dumps()
+  assert assembler.known_symbols['VAR'] == expected.known_symbols['VAR']
+  assert assembler.num_instructions == expected.num_instructions
+
+def test_c_encoding():
+  assert C_Instruction('D=D+A').encode() == C_Instruction('D=A+D').encode()
+  assert C_Instruction('MD=M+1').encode() == C_Instruction('D,M=M+1').encode()
+  assert C_Instruction('0;JMP').resolve() == '1_1_1_0_101010_000_111'
+  assert C_Instruction('W=W+1').resolve() == '1_0_0_0_110111_000_000'
+  assert C_Instruction('AMD=M|D;JNE').encode() == 0b1111010101111101
+
+  # every legal combination is precomputed
+  assert len(C_ENCODING_TABLE) == 16 * len(JUMP_TABLE) * len({comp for _, comp, _ in C_ENCODING_TABLE})
+
+  try:
+    C_Instruction('W=D').encode(compat=True)
+    assert False, 'Should have thrown SyntaxError exception'
+  except SyntaxError:
+    pass
+
+  try:
+    C_Instruction('D=D*A').encode()
+    assert False, 'Should have thrown exception'
+  except Exception as ex:
+    assert 'Unsupported computation' in str(ex)
+
+def test_format_machine_code():
+  assert format_machine_code(0b1110101010000111) == '1110101010000111'
+  assert format_machine_code(0b1110101010000111, pretty_print=True) == '1_1_1_0_101010_000_111'
+  assert format_machine_code(0x00FF, pretty_print=True) == '0000000011111111'
+
+def test_compact_instructions():
+  src = '''
+    // increment
+    @SP
+    M=M+1
+  '''
+  assembler = Assembler().assemble(src)
+  inst_vec = assembler.instructions
+  assert inst_vec is assembler.instructions
+
+  for inst in inst_vec:
+    assert not hasattr(inst, '__dict__')
+
+  assert inst_vec[0].source_block == ['// increment', '@SP']
+  assert inst_vec[0].symbol == 'SP'
+  assert inst_vec[2].source_block == ['M=M+1']
+
+def test_regenerated_annotations():
+  src = '''
+    A=A+1 // comment
+    D=A
+  '''
+  assembler = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT, annotate=True).assemble(src)
+  assert assembler.instructions[0].get_annotations() == ['A,D=A+1']
+
+  # the shared source is left untouched
+  assert assembler.postprocessed_src[0] == 'A=A+1 // comment'
+
+def test_machine_code():
+  with open('tests/blink.hack') as fh:
+    expected = [int(l, 2) for l in fh.read().split()]
+
+  asm = Assembler('tests/blink.asm', annotate=True, pretty_print=True).assemble()
+  assert asm.machine_code == expected
+
+def test_write_output_formats():
+  import firmware
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for fmt in firmware.FORMAT_CHOICES:
+      output = f'{tmpdir}/blink.{fmt}'
+      Assembler('tests/blink.asm', output_hack=output, output_format=fmt).assemble().write_output()
+
+    with open(f'{tmpdir}/blink.bin-le', 'rb') as fh:
+      data = fh.read()
+
+    asm = Assembler('tests/blink.asm').assemble()
+    assert len(data) == 2*len(asm.machine_code)
+    assert int.from_bytes(data[:2], 'little') == asm.machine_code[0]
+
+    with open(f'{tmpdir}/blink.hex') as fh:
+      assert [int(l, 16) for l in fh] == asm.machine_code
+
+def test_assembly_cache():
+  src = '''
+    @0
+    D=A
+    $call func_FOO
+    @END
+    0;JEQ
+
+  (func_FOO)
+    $const kFoo 3
+    @kFoo
+    D=A
+    $return
+
+  (func_BAR)
+    @$this.DONE
+    0;JEQ
+  ($this.DONE)
+    $return
+  (END)
+  '''
+  # whole program optimisations such as removing the unused func_BAR cannot be done one block at
+  # a time so stick to those which give the same result
+  optimise = [OPT_LOADS, OPT_UNNEEDED_NOPS, OPT_MULTIDEST_ASSIGNMENT, OPT_PEEPHOLE]
+  expected = Assembler(annotate=True, optimise=optimise).assemble(src).dumps()
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+    assembler = Assembler(annotate=True, optimise=optimise, cache_dir=cache_dir).assemble(src)
+    assert assembler.cache_stats['misses'] == 3
+    assert assembler.dumps() == expected
+
+    assembler = Assembler(annotate=True, optimise=optimise, cache_dir=cache_dir).assemble(src)
+    assert assembler.cache_stats['hits'] == 3
+    assert assembler.known_symbols['kFoo'] == 3
+    assert assembler.dumps() == expected
+
+    # only the edited block needs to be reassembled
+    src = src.replace('D=A\n    $return', 'D=A+1\n    $return')
+    assembler = Assembler(annotate=True, optimise=optimise, cache_dir=cache_dir).assemble(src)
+    assert assembler.cache_stats['hits'] == 2
+    assert assembler.cache_stats['misses'] == 1
+    assert assembler.dumps() == Assembler(annotate=True, optimise=optimise).assemble(src).dumps()
+
+    # func_BAR could be jumped to from another block
+    assembler = Assembler(optimise=OPT_ALL, cache_dir=cache_dir).assemble(src)
+    assert not assembler.unreachable_code
+
+    # different optimisation options do not share cache entries
+    assembler = Assembler(cache_dir=cache_dir).assemble(src)
+    assert assembler.cache_stats['misses'] == 3
+
+def test_assembly_cache_constants():
+  src = '''
+  (func_A)
+    $const kFoo 0
+    $return
+
+  (func_B)
+    @kFoo
+    D=A
+    @R1
+    M=D
+    $return
+  '''
+  with tempfile.TemporaryDirectory() as cache_dir:
+    Assembler(optimise=OPT_ALL, cache_dir=cache_dir).assemble(src)
+
+    # func_B is unchanged so comes from the cache, but must load the new value of kFoo
+    src = src.replace('kFoo 0', 'kFoo 1')
+    assembler = Assembler(optimise=OPT_ALL, cache_dir=cache_dir).assemble(src)
+    assert assembler.cache_stats['hits'] == 1
+    assert assembler.dumps() == Assembler(optimise=OPT_ALL, cache_dir=cache_dir + '/new').assemble(
+        src).dumps()
+    assert '@kFoo' in _emitted(assembler)
+
+def test_optimisation_pipeline():
+  assert Assembler(optimise=OPT_ALL)._optimise_passes == DEFAULT_OPTIMISATION_PIPELINE
+  assert Assembler(optimise=[OPT_MULTIDEST_ASSIGNMENT, OPT_LOADS])._optimise_passes == [
+      OPT_MULTIDEST_ASSIGNMENT, OPT_LOADS]
+
+  try:
+    Assembler(optimise='bogus')
+    assert False, 'Should have failed'
+  except ValueError:
+    pass
+
+def test_optimisation_stats():
+  src = '''
+      @SP
+      M=M+1
+      @SP
+      M=M+1
+  '''
+  assembler = Assembler(optimise=[OPT_LOADS, OPT_CONSEC_NOPS]).assemble(src)
+  assert assembler.optimisation_stats[OPT_LOADS]['runs'] == 1
+  assert assembler.optimisation_stats[OPT_LOADS]['removed'] == 1
+  assert assembler.optimisation_stats[OPT_CONSEC_NOPS]['removed'] == 1
+
+def test_optimisation_fixpoint():
+  src = '''
+    A=A+1
+    @SP
+    M=D
+    @SP
+    D=A
+  '''
+  calls = []
+  def record_pass(assembler, instructions):
+    calls.append(len(calls))
+
+  register_optimisation_pass('test_record', record_pass, default=False)
+  try:
+    assembler = Assembler(optimise=[OPT_LOADS, 'test_record'], opt_fixpoint=True).assemble(src)
+    # the first iteration removes the second @SP, the second changes nothing
+    assert len(calls) == 2
+    assert assembler.optimisation_stats[OPT_LOADS]['runs'] == 2
+  finally:
+    del OPTIMISATION_PASSES['test_record']
+
+def test_control_flow_graph():
+  src = '''
+      @R2
+      M=0
+    (LOOP)
+      @R1
+      D=M
+      @END
+      D;JEQ
+      @R1
+      M=D-1
+      @LOOP
+      0;JMP
+    (END)
+      @END
+      0;JMP
+  '''
+  cfg = ControlFlowGraph(Assembler().assemble(src).instructions)
+  entry, loop, body, end = cfg.blocks
+  assert loop.labels == ['LOOP'] and end.labels == ['END']
+
+  assert entry.successors == [loop]
+  assert loop.jump_target == 'END'
+  assert loop.successors == [end, body]
+  assert body.successors == [loop]
+  assert not body.falls_through
+  assert end.successors == [end]
+
+  assert loop.predecessors == [entry, body]
+  assert loop.unique_predecessor is None
+  assert body.unique_predecessor is loop
+  assert not any(block.address_taken or block.computed_jump for block in cfg.blocks)
+
+def test_control_flow_graph_computed_jump():
+  src = '''
+      @RET
+      D=A
+      @R13
+      M=D
+      @FUNC
+      0;JMP
+    (RET)
+      @RET
+      0;JMP
+    (FUNC)
+      @R13
+      A=M
+      0;JMP
+  '''
+  cfg = ControlFlowGraph(Assembler().assemble(src).instructions)
+  ret = cfg.label_blocks['RET']
+  func = cfg.label_blocks['FUNC']
+
+  # RET is stored in R13 and so can be reached by the computed jump in FUNC
+  assert ret.address_taken
+  assert ret.unique_predecessor is None
+  assert not func.address_taken
+  assert func.computed_jump
+  assert func.successors == []
+  assert cfg.address_taken_blocks == [ret]
+
+def test_optimise_load_across_labels():
+  # LOOP is reached with A=LOOP so @R1 must be loaded again
+  src = '''
+      @R1
+      D=M
+    (LOOP)
+      @R1
+      M=D
+      @LOOP
+      0;JMP
+  '''
+  inst_vec = Assembler(optimise=OPT_LOADS).assemble(src).instructions
+  assert all(inst.emit for inst in inst_vec if type(inst) == A_Instruction)
+
+  # the fall through of a conditional jump can only be reached from the jump
+  src = '''
+      @END
+      D;JEQ
+      @END
+      M=D
+    (END)
+  '''
+  inst_vec = Assembler(optimise=OPT_LOADS).assemble(src).instructions
+  assert [inst.emit for inst in inst_vec if type(inst) == A_Instruction] == [True, False]
+
+def test_multidest_assignment_across_labels():
+  # D=M is executed on every iteration but M=0 only once
+  src = '''
+      M=0
+    (LOOP)
+      D=M
+      @LOOP
+      D;JNE
+  '''
+  inst_vec = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src).instructions
+  assert all(inst.emit for inst in inst_vec if type(inst) == C_Instruction)
+
+  # @SP replaces A so A cannot be copied into D
+  src = '''
+      A=A+1
+      @SP
+      D=A
+  '''
+  inst_vec = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src).instructions
+  assert all(inst.emit for inst in inst_vec)
+
+  # @R0 changes what M refers to
+  src = '''
+      M=D-1
+      @R0
+      D=M
+  '''
+  inst_vec = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src).instructions
+  assert all(inst.emit for inst in inst_vec)
+
+def test_registers_read_written():
+  inst = C_Instruction('M=D+1')
+  assert inst.registers_read() == {'A', 'D'}
+  assert inst.registers_written() == set()
+
+  inst = C_Instruction('A,D=W;JGT')
+  assert inst.registers_read() == {'A', 'W'}
+  assert inst.registers_written() == {'A', 'D'}
+
+  assert A_Instruction('@SP').registers_written() == {'A'}
+
+def test_liveness():
+  src = '''
+      @R1
+      D=M
+    (LOOP)
+      @LOOP
+      D=D-1;JGT
+      W=0
+  '''
+  cfg = ControlFlowGraph(Assembler().assemble(src).instructions)
+  live_in, live_out = cfg.liveness()
+  entry, loop, tail = cfg.blocks
+  assert live_out[entry] == {'D'}
+  # falls off the end of the program so everything is live
+  assert live_out[tail] == set(REGISTERS)
+  # W is overwritten after the loop
+  assert live_out[loop] == {'A', 'D'}
+  assert live_in[loop] == {'D'}
+
+def test_optimise_dead_stores():
+  src = '''
+      D=A
+      @SP
+      D=M
+      @R1
+      @R2
+      M=D
+      A=D
+      D;JEQ
+  '''
+  inst_vec = Assembler(optimise=OPT_DEAD_STORES).assemble(src).instructions
+  removed = [inst.expression for inst in inst_vec if not inst.emit]
+  assert removed == ['D=A', '@R1']
+
+  # D is read at LOOP, which is reached from the jump
+  src = '''
+      @LOOP
+      D=A
+      0;JMP
+      D=1
+      D=0
+    (LOOP)
+      M=D
+  '''
+  inst_vec = Assembler(optimise=OPT_DEAD_STORES).assemble(src).instructions
+  removed = [inst.expression for inst in inst_vec if type(inst) != Label_Instruction and not inst.emit]
+  assert removed == ['D=1']
+
+  # the NOP after M=D is gone so removing D=A would put M=D and D=M next to each other
+  src = '''
+      M=D
+      D=A
+      D=M
+  '''
+  assembler = Assembler(optimise=[OPT_UNNEEDED_NOPS, OPT_DEAD_STORES]).assemble(src)
+  assert all(inst.emit for inst in assembler.instructions if inst.expression == 'D=A')
+
+def test_peephole_rule():
+  rule = PeepholeRule(['%x=%y', '%x=%x-1'], ['%x=%y-1'])
+  assert rule.keys is None
+  assert rule.match([C_Instruction('A=M'), C_Instruction('A=A-1')]) == {'x': 'A', 'y': 'M'}
+  # x must be the same register each time
+  assert rule.match([C_Instruction('A=M'), C_Instruction('D=D-1')]) is None
+
+  rule = PeepholeRule(['@$x', '@$y'], ['@$y'])
+  assert rule.keys == ['@']
+  assert rule.match([A_Instruction('@SP'), A_Instruction('@R1')]) == {'x': 'SP', 'y': 'R1'}
+
+  try:
+    PeepholeRule(['D=A'], ['D=A'])
+    assert False, 'Should have failed'
+  except ValueError:
+    pass
+
+def test_peephole_optimisation():
+  src = '''
+      @SP
+      A=M
+      A=A-1
+      D=M
+  '''
+  assembler = Assembler(optimise=OPT_PEEPHOLE, annotate=True).assemble(src)
+  emitted = [inst.expression for inst in assembler.instructions if inst.emit]
+  assert emitted == ['@SP', 'A=M-1', 'D=M']
+  assert 'A=M-1' in assembler.dumps()
+
+  # no rewriting across labels
+  src = '''
+      A=M
+    (LOOP)
+      A=A-1
+      @LOOP
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_PEEPHOLE).assemble(src)
+  assert all(inst.emit for inst in assembler.instructions if type(inst) != Label_Instruction)
+
+  # the ALU can use W in place of A
+  src = '''
+      D=W
+      D=D-1
+  '''
+  assembler = Assembler(optimise=OPT_PEEPHOLE).assemble(src)
+  assert [inst.expression for inst in assembler.instructions if inst.emit] == ['D=W-1']
+
+def test_peephole_memory_hazard():
+  # the NOP after M=D is removed b/c @R1 does not access memory, so removing @R1 would put the
+  # write right before a read
+  src = '''
+      M=D
+      @R1
+      D=M
+  '''
+  register_peephole_rule(['@R1', 'D=M'], ['D=M'])
+  try:
+    assembler = Assembler(optimise=[OPT_UNNEEDED_NOPS, OPT_PEEPHOLE]).assemble(src)
+    assert [inst.expression for inst in assembler.instructions if inst.emit] == [
+        '0', 'M=D', '@R1', 'D=M']
+  finally:
+    PEEPHOLE_RULES.pop()
+    global _PEEPHOLE_MATCHER
+    _PEEPHOLE_MATCHER = None
+
+def test_register_peephole_rule():
+  src = '''
+      D=0
+      D=D+1
+  '''
+  register_peephole_rule(['D=0', 'D=D+1'], ['D=1'])
+  try:
+    assembler = Assembler(optimise=OPT_PEEPHOLE).assemble(src)
+    assert [inst.expression for inst in assembler.instructions if inst.emit] == ['D=1']
+  finally:
+    PEEPHOLE_RULES.pop()
+    global _PEEPHOLE_MATCHER
+    _PEEPHOLE_MATCHER = None
+
+def _emitted(assembler):
+  return [inst.expression for inst in assembler.instructions if inst.emit]
+
+def test_jump_threading_retarget():
+  src = '''
+      @HOP
+      D;JGT
+      D=D+1
+      @END
+      0;JMP
+    (HOP)
+      @END
+      0;JMP
+    (END)
+      @END
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_JUMP_THREADING, annotate=True).assemble(src)
+  # the first jump goes straight to END, which makes the jump at HOP a jump to the next
+  # instruction
+  assert _emitted(assembler) == ['@END', 'D;JGT', 'D=D+1', '@END', '0;JMP', '@END', '0;JMP']
+  assert '// @HOP' not in assembler.dumps()
+
+def test_jump_threading_next_instruction():
+  # A is read at NEXT so the load has to stay
+  src = '''
+      @NEXT
+      0;JEQ
+    (NEXT)
+      D=A
+      @NEXT
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_JUMP_THREADING).assemble(src)
+  assert _emitted(assembler) == ['@NEXT', 'D=A', '@NEXT', '0;JMP']
+
+  # the computation still has to happen
+  src = '''
+      @NEXT
+      D=D-1;JGT
+    (NEXT)
+      @NEXT
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_JUMP_THREADING).assemble(src)
+  assert _emitted(assembler) == ['D=D-1', '@NEXT', '0;JMP']
+
+def test_jump_threading_invert():
+  src = '''
+      @IF_TRUE
+      D;JNE
+      @IF_FALSE
+      0;JEQ
+    (IF_TRUE)
+      @IF_TRUE
+      0;JMP
+    (IF_FALSE)
+      @IF_FALSE
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_JUMP_THREADING).assemble(src)
+  assert _emitted(assembler)[:2] == ['@IF_FALSE', 'D;JEQ']
+  assert len(_emitted(assembler)) == 6
+
+  # not if IF_TRUE reads the A loaded by the jump
+  src = src.replace('''(IF_TRUE)
+      @IF_TRUE''', '''(IF_TRUE)
+      D=A
+      @IF_TRUE''')
+  assembler = Assembler(optimise=OPT_JUMP_THREADING).assemble(src)
+  assert _emitted(assembler)[:4] == ['@IF_TRUE', 'D;JNE', '@IF_FALSE', '0;JEQ']
+
+def test_unreachable_code():
+  src = '''
+      $call func_FOO
+      @END
+      0;JMP
+      // dead as it follows an unconditional jump
+      D=D+1
+    (func_FOO)
+      D=D-1
+      $return
+    (func_UNUSED)
+      D=!D
+      $return
+    (END)
+      @END
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_UNREACHABLE).assemble(src)
+  assert [(labels, count) for labels, count in assembler.unreachable_code] == [
+      ([], 1), (['func_UNUSED'], 10)]
+
+  # func_FOO is only reachable via the $call, and RETURN_FROM via $return
+  emitted = [inst.expression for inst in assembler.instructions if inst.emit]
+  assert 'D=D-1' in emitted and 'D=!D' not in emitted
+
+def test_reachable_blocks():
+  src = '''
+      @R13
+      A=M
+      0;JMP
+    (TAKEN)
+      D=A
+    (NOT_TAKEN)
+      @NOT_TAKEN
+      0;JMP
+    (LOADER)
+      @TAKEN
+      D=A
+  '''
+  instructions = Assembler().assemble(src).instructions
+  cfg = ControlFlowGraph(instructions)
+  reachable = cfg.reachable_blocks()
+  # TAKEN is reachable through the computed jump even though LOADER is not reachable
+  assert cfg.label_blocks['TAKEN'] in reachable
+  assert cfg.label_blocks['NOT_TAKEN'] in reachable
+  assert cfg.label_blocks['LOADER'] not in reachable
+
+  cfg = ControlFlowGraph(instructions, open_labels=True)
+  assert cfg.label_blocks['LOADER'] in cfg.reachable_blocks()
+
+def test_evaluate_comp():
+  assert evaluate_comp('-1', {}) == 0xFFFF
+  assert evaluate_comp('D+A', {'A': 2, 'D': 3}) == 5
+  assert evaluate_comp('A-D', {'A': 2, 'D': 3}) == 0xFFFF
+  assert evaluate_comp('!D', {'D': 0}) == 0xFFFF
+  assert evaluate_comp('D+1', {'D': 0xFFFF}) == 0
+  assert evaluate_comp('D&M', {'D': 0}) is None
+  # symbols have no value until labels are resolved
+  assert evaluate_comp('A+1', {'A': 'LOOP'}) is None
+
+def test_constant_propagation():
+  src = '''
+      @5
+      D=A
+      @5
+      D=A
+      @0
+      D=A
+  '''
+  assembler = Assembler(optimise=OPT_CONSTANTS).assemble(src)
+  assert _emitted(assembler) == ['@5', 'D=A', '@0', 'D=0']
+
+  # D is known to be 0 so the jump is always taken
+  src = '''
+      D=0
+      @END
+      D;JEQ
+      D=D+1
+    (END)
+      @END
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_CONSTANTS).assemble(src)
+  assert _emitted(assembler)[:3] == ['D=0', '@END', '0;JEQ']
+
+  # nothing is known at a label with more than one predecessor
+  src = '''
+      @5
+      D=A
+    (LOOP)
+      @5
+      D=A
+      @LOOP
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_CONSTANTS).assemble(src)
+  assert _emitted(assembler) == ['@5', 'D=A', '@5', 'D=A', '@LOOP', '0;JMP']
+
+def test_constant_propagation_labels():
+  # LOOP is at address 2, which is what A holds after the loop
+  src = '''
+      @2
+      D=A
+    (LOOP)
+      D=D-1
+      @LOOP
+      D;JGT
+      @2
+      @LOOP
+      0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_CONSTANTS).assemble(src)
+  assert _emitted(assembler) == ['@2', 'D=A', 'D=D-1', '@LOOP', 'D;JGT', '0;JMP']
+  assert assembler.known_symbols['LOOP'] == 2
+
+def test_multidest_assignment_memory_write():
+  # @SP changes where M=D writes so D,M=A would write to the wrong address
+  src = '''
+    @256
+    D=A
+    @SP
+    M=D
+  '''
+  assembler = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src)
+  assert _emitted(assembler) == ['@256', 'D=A', '@SP', '0', 'M=D', '0']
+
+  # merging is fine when the write can safely move to the candidate
+  src = '''
+    W=W+1
+    0
+    D=D+1
+    0
+    M=D
+  '''
+  assembler = Assembler(optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src)
+  assert _emitted(assembler) == ['W=W+1', '0', 'D,M=D+1', '0', '0', '0']
+
+  # @100 would overwrite A if A=D were merged into D=D+1, so M=0 would write RAM[100]
+  src = '''
+    D=D+1
+    @100
+    A=D
+    M=0
+  '''
+  assembler = Assembler(hazard_model=HAZARD_IDEAL, optimise=OPT_MULTIDEST_ASSIGNMENT).assemble(src)
+  assert _emitted(assembler) == ['D=D+1', '@100', 'A=D', 'M=0']
+
+def test_schedule_hazard_slots():
+  src = '''
+    @LCL
+    D=M
+    A=W
+    M=D
+    W=W+1
+  '''
+  assembler = Assembler(optimise=OPT_SCHEDULE).assemble(src)
+  assert _emitted(assembler) == ['@LCL', 'D=M', 'A=W', 'W=W+1', 'M=D', '0']
+
+  # D=D+1 changes the D written to memory so it can only fill the slot after the write
+  src = '''
+    A=W
+    M=D
+    D=D+1
+    @R1
+    D=M
+  '''
+  assembler = Assembler(optimise=OPT_SCHEDULE).assemble(src)
+  assert _emitted(assembler) == ['A=W', '0', 'M=D', 'D=D+1', '@R1', 'D=M']
+
+def test_schedule_hazard_slots_dependencies():
+  # W=D cannot move before D=M, and nothing may move past the jump
+  src = '''
+    @R0
+    D=M
+    W=D
+    A=W
+    M=D
+    @END
+    0;JMP
+  (END)
+    D=D+1
+  '''
+  assembler = Assembler(optimise=OPT_SCHEDULE).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'D=M', 'W=D', 'A=W', '0', 'M=D', '@END', '0;JMP', 'D=D+1']
+
+  # whatever fills the slot before an M-write must not change A or access memory
+  src = '''
+    A=W
+    M=D
+    @R1
+  '''
+  assembler = Assembler(optimise=OPT_SCHEDULE).assemble(src)
+  assert _emitted(assembler) == ['A=W', '0', 'M=D', '@R1']
+
+def test_hazard_models():
+  src = '''
+    @R0
+    D=M
+    M=D+1
+  '''
+  assembler = Assembler(hazard_model=HAZARD_INVERTED_CLOCK).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'D=M', '0', 'M=D+1', '0']
+
+  assembler = Assembler(hazard_model=HAZARD_ORIGINAL).assemble(src)
+  assert _emitted(assembler) == ['@R0', '0', 'D=M', '0', 'M=D+1', '0']
+
+  assembler = Assembler(hazard_model=HAZARD_IDEAL).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'D=M', 'M=D+1']
+
+  # compat mode never inserts NOPs
+  assembler = Assembler(compat=True, hazard_model=HAZARD_ORIGINAL).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'D=M', 'M=D+1']
+
+def test_optimise_unneeded_nops_hazard_model():
+  # D=M leaves A alone so D=D+M does not need a NOP before it
+  src = '''
+    @R0
+    D=M
+    D=D+M
+    @R1
+    D=D+M
+  '''
+  assembler = Assembler(hazard_model=HAZARD_ORIGINAL, optimise=OPT_UNNEEDED_NOPS).assemble(src)
+  assert _emitted(assembler) == ['@R0', '0', 'D=M', 'D=D+M', '@R1', '0', 'D=D+M']
+
+  # W=W+1 leaves A and memory alone so it can take the place of the NOP before the write, but
+  # the NOP after LOOP is needed when jumping there
+  src = '''
+    @R0
+    W=W+1
+    M=D
+    (LOOP)
+    M=D
+  '''
+  assembler = Assembler(optimise=OPT_UNNEEDED_NOPS).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'W=W+1', 'M=D', '0', 'M=D', '0']
+  assert [inst.emit for inst in assembler.instructions if inst.generated] == [
+      False, False, True, True]
+
+  # falling through to LOOP needs no NOP before the write, but jumping there may
+  src = '''
+    @R0
+    D=A
+  (LOOP)
+    M=D
+    @LOOP
+    0;JMP
+  '''
+  assembler = Assembler(optimise=OPT_UNNEEDED_NOPS).assemble(src)
+  assert _emitted(assembler) == ['@R0', 'D=A', '0', 'M=D', '@LOOP', '0;JMP']
+
+def test_symbol_table():
+  table = SymbolTable(dict(R0=0, SP=0))
+  assert table.define('LOOP', 4, SYMBOL_LABEL) == 2
+  table['kFoo'] = 3
+  table.update(kBar=5)
+
+  assert table == dict(R0=0, SP=0, LOOP=4, kFoo=3, kBar=5)
+  assert table.id('R0') == 0
+  assert table.id('kBar') == 4
+  assert table.kind('SP') == SYMBOL_PREDEFINED
+  assert table.kind('kFoo') == SYMBOL_CONSTANT
+  assert table.symbols(SYMBOL_LABEL) == ['LOOP']
+
+  # changing the value keeps the id and kind
+  table.set_value('LOOP', 2)
+  assert table['LOOP'] == 2
+  assert table.id('LOOP') == 2
+  assert table.kind('LOOP') == SYMBOL_LABEL
+
+def test_symbol_kinds():
+  src = '''
+    $const kFoo 3
+    @kFoo
+    D=A
+    @VAR
+    M=D
+  (LOOP)
+    @LOOP
+    0;JMP
+  '''
+  assembler = Assembler().assemble(src)
+  symbols = assembler.known_symbols
+  assert symbols.kind('kFoo') == SYMBOL_CONSTANT
+  assert symbols.kind('VAR') == SYMBOL_VARIABLE
+  assert symbols.kind('LOOP') == SYMBOL_LABEL
+  assert symbols.kind('SCREEN') == SYMBOL_PREDEFINED
+  assert symbols.symbols(SYMBOL_VARIABLE) == ['VAR']
+
+def test_label_addresses_after_optimisation():
+  src = '''
+    @0
+    @0
+    D=A
+  (LOOP)
+    @LOOP
+    D;JGT
+  '''
+  assembler = Assembler(optimise=OPT_LOADS).assemble(src)
+  assert assembler.known_symbols['LOOP'] == 2
+
+def test_size_report():
+  src = '''
+    @R0
+    M=0
+    $call func_INC
+  (END)
+    @END
+    0;JMP
+  (func_INC)
+    @0
+    @R0
+    M=M+1
+    $return
+  '''
+  assembler = Assembler(optimise=OPT_LOADS, size_report=True).assemble(src)
+  report = assembler.size_report.to_dict()
+
+  assert report['total'] == len(assembler.machine_code)
+  assert [block['name'] for block in report['blocks']] == [SIZE_REPORT_TOP_LEVEL, 'func_INC']
+
+  # NOPs around the M-writes of macros are counted as NOPs
+  top, func = report['blocks']
+  assert (top['user'], top['nops'], top['macro']) == (4, 6, 9)
+  assert func['address'] == top['total']
+  assert (func['user'], func['nops'], func['macro']) == (3, 4, 6)
+
+  # the second @SP of $return
+  assert func['removed'] == {OPT_LOADS: 1}
+  assert report['removed'] == {OPT_LOADS: assembler.optimisation_stats[OPT_LOADS]['removed']}
+
+def test_size_report_vm_functions():
+  src = '''
+    @256
+    D=A
+  // FUNCTION Main.main 0
+  (Main.main)
+    @Main.main
+    0;JMP
+  '''
+  report = Assembler(hazard_model=HAZARD_IDEAL, size_report=True).assemble(src).size_report
+  assert {name: sum(sizes.values()) for name, sizes in report.blocks.items()} == {
+      SIZE_REPORT_TOP_LEVEL: 2, 'Main.main': 2}
+
+def test_size_report_rom_budget():
+  report = SizeReport(rom_words=10)
+  report.blocks['func_A'] = Counter(user=8)
+  assert report.warnings() == []
+
+  report.blocks['func_A']['nops'] = 1
+  assert 'of the 10 words' in report.warnings()[0]
+
+  report.blocks['func_A']['macro'] = 2
+  assert 'does not fit' in report.warnings()[0]
+
+def test_stats():
+  stats = Stats()
+  src = '''
+    @R0
+    M=0
+    $call func_F
+  (END)
+    @END
+    0;JMP
+  (func_F)
+    $return
+  '''
+  assembler = Assembler(optimise=OPT_ALL, stats=stats).assemble(src)
+
+  assert {'read', 'preprocess', 'parse', 'resolve', 'optimise', 'emit'} <= set(stats.timers)
+  assert stats.counters['lines'] == 8
+  assert stats.counters['macros_expanded'] == 2
+  assert stats.counters['labels'] == 3
+  assert stats.counters['instructions'] == len(assembler.machine_code)
+  assert stats.counters['nops_inserted'] - stats.counters['nops_removed'] == sum(
+      1 for inst in assembler.instructions if inst.emit and type(inst) == NOP_Instruction)
+
+def test_source_map():
+  import tempfile
+  src = '''
+    @R0
+    D=M
+
+    // comment
+    $call func_F
+  (END)
+    @END
+    0;JMP
+  (func_F)
+    D=D+1
+    $return
+  '''
+  # the map is only made when asked for
+  assert Assembler().assemble(src).source_map is None
+
+  assembler = Assembler(source_map=True).assemble(src)
+  source_map = assembler.source_map
+  lines = [source_map.lookup(pc)[1] for pc in range(len(assembler.machine_code))]
+  blocks = [source_map.lookup(pc)[2] for pc in range(len(assembler.machine_code))]
+
+  # the code of a macro maps to the line it was used on
+  assert lines[:2] == [2, 3]
+  assert set(lines[2:lines.index(8)]) == {6}
+  assert lines[-1] == 12
+  assert blocks[0] is None and blocks[-1] == 'func_F'
+  assert source_map.lookup(0)[0] == '<in memory>'
+
+  # the cache gives the same map
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for _ in range(2):
+      cached = Assembler(cache_dir=tmpdir, source_map=True).assemble(src)
+      assert cached.source_map.to_dict() == source_map.to_dict()
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+"""
+Throughput benchmarks for the assembler and the VM translator. Large synthetic .asm and .vm
+programs are generated, assembled and translated end to end with the time of each phase recorded,
+and results are stored as JSON so they can be compared between commits, e.g.
+
+  python bench.py run -o before.json
+  git checkout my-branch
+  python bench.py run -o after.json
+  python bench.py compare before.json after.json
+
+Programs are generated from a seed so every run of the same configuration benchmarks the same
+program. Times are the best of --repeat runs. Peak memory is measured in a separate run with
+tracemalloc b/c tracing slows Python down too much to time at the same time.
+"""
+
+import os
+import json
+import time
+import random
+import platform
+import subprocess
+import tracemalloc
+
+import click
+
+from assembler import Assembler, OPT_ALL, HAZARD_IDEAL
+from instrument import Stats
+from vm2asm import VM2ASM
+
+BENCH_ASM = 'asm'
+BENCH_ASM_OPTIMISED = 'asm-O'
+BENCH_ASM_STREAM = 'asm-stream'
+BENCH_VM = 'vm'
+BENCH_VM_ASM = 'vm-asm'
+BENCH_CHOICES = (BENCH_ASM,
+                 BENCH_ASM_OPTIMISED,
+                 BENCH_ASM_STREAM,
+                 BENCH_VM,
+                 BENCH_VM_ASM)
+
+# identifies result files written by this module
+RESULTS_FORMAT = 'hackbench'
+RESULTS_FORMAT_VERSION = 1
+
+# C-instructions generated programs are made of. Only HACK instructions are used so programs can
+# be assembled in any mode
+ASM_COMPUTATIONS = ('D=M', 'M=D', 'D=D+M', 'M=M+1', 'M=M-1', 'D=A', 'D=D-1', 'AM=M+1', 'MD=D+1',
+                    'D=!D', 'M=0', 'D=D&M', 'D=D|A', 'M=D-M', 'A=M')
+
+# jumps used for loops in generated programs
+ASM_JUMPS = ('D;JNE', 'D;JGT', 'D;JLT', 'D;JGE')
+
+# number of variables and constants generated programs use
+NUM_VARIABLES = 64
+NUM_CONSTANTS = 8
+
+VM_BINARY_OPS = ('add', 'sub', 'and', 'or', 'eq', 'lt', 'gt')
+VM_UNARY_OPS = ('neg', 'not')
+VM_SEGMENTS = ('local', 'static', 'temp', 'this', 'that')
+
+def generate_asm(num_instructions, label_density=0.05, macro_density=0.05, num_functions=16,
+                 seed=0):
+  """
+  Returns the source of an assembly program of about num_instructions statements, not counting
+  what macros expand to, split evenly between the main program and num_functions functions
+  called with $call. label_density and macro_density are the chance of each statement being a
+  loop label or a macro. The program assembles without warnings.
+  """
+  rng = random.Random(seed)
+  lines = []
+  constants = [f'kC{idx}' for idx in range(NUM_CONSTANTS)]
+
+  for name in constants:
+    lines.append(f'$const {name} {rng.randrange(0x4000)}')
+  for name in constants:
+    lines += [f'@{name}', 'D=A']
+
+  functions = [f'func_F{idx}' for idx in range(num_functions)]
+  for name in functions:
+    lines.append(f'$call {name}')
+
+  per_block = max(num_instructions // (num_functions + 1), 1)
+  lines += _generate_asm_block(rng, 'MAIN', per_block, label_density, macro_density, constants)
+  lines += ['(END)', '@END', '0;JMP']
+
+  for name in functions:
+    lines.append(f'({name})')
+    lines += _generate_asm_block(rng, name, per_block, label_density, macro_density, constants)
+    lines.append('$return')
+
+  return '\n'.join(lines) + '\n'
+
+def _generate_asm_block(rng, prefix, num_instructions, label_density, macro_density, constants):
+  lines = []
+
+  # labels which have not been jumped to yet. Every label must be used to avoid warnings
+  unused_labels = []
+  num_labels = 0
+
+  def variable():
+    return f'v{rng.randrange(NUM_VARIABLES)}'
+
+  def jump_to_label():
+    return unused_labels.pop() if unused_labels else None
+
+  for _ in range(num_instructions):
+    roll = rng.random()
+    if roll < label_density:
+      label = f'{prefix}.L{num_labels}'
+      num_labels += 1
+      lines.append(f'({label})')
+      unused_labels.append(label)
+    elif roll < label_density + macro_density:
+      kind = rng.randrange(4)
+      label = jump_to_label() if kind >= 2 else None
+      if kind == 0:
+        lines.append(f'$copy_mm {variable()} {variable()}')
+      elif kind == 1:
+        lines.append(f'$copy_mv {variable()} {rng.choice(constants)}')
+      elif label is not None:
+        if kind == 2:
+          lines.append(f'$if_var_goto {variable()} {label}')
+        else:
+          lines += [f'@{variable()}', f'$if_M_goto {label}']
+      else:
+        lines.append(f'$copy_mm {variable()} {variable()}')
+    elif unused_labels and rng.random() < 0.2:
+      lines += [f'@{jump_to_label()}', rng.choice(ASM_JUMPS)]
+    else:
+      roll = rng.random()
+      if roll < 0.6:
+        lines.append(f'@{variable()}')
+      elif roll < 0.8:
+        lines.append(f'@{rng.choice(constants)}')
+      else:
+        lines.append(f'@{rng.randrange(0x8000)}')
+      lines.append(rng.choice(ASM_COMPUTATIONS))
+
+  while unused_labels:
+    lines += [f'@{jump_to_label()}', rng.choice(ASM_JUMPS)]
+
+  return lines
+
+def generate_vm(num_operations, label_density=0.05, num_functions=16, seed=0):
+  """
+  Returns the source of a VM program of about num_operations operations split evenly between
+  num_functions functions, all called from Sys.init. label_density is the chance of each
+  operation being a loop label.
+  """
+  rng = random.Random(seed)
+  functions = [f'Main.f{idx}' for idx in range(num_functions)]
+
+  # bootstrap as vm2asm.py does, minus the setup of SP
+  lines = ['call Sys.init 0', 'function Sys.init 0']
+  for name in functions:
+    lines += [f'call {name} 0', 'pop temp 0']
+  lines += ['label END', 'goto END']
+
+  per_function = max(num_operations // max(num_functions, 1), 1)
+  for idx, name in enumerate(functions):
+    num_locals = rng.randrange(1, 5)
+    lines.append(f'function {name} {num_locals}')
+    lines += _generate_vm_body(rng, per_function, num_locals, label_density, functions[idx + 1:])
+    lines += ['push constant 0', 'return']
+
+  return '\n'.join(lines) + '\n'
+
+def _generate_vm_body(rng, num_operations, num_locals, label_density, callees):
+  lines = []
+  unused_labels = []
+  num_labels = 0
+
+  # keep track of the stack so operations never pop more than was pushed
+  depth = 0
+
+  def push():
+    segment = rng.choice(('constant',) + VM_SEGMENTS)
+    if segment == 'constant':
+      return f'push constant {rng.randrange(0x8000)}'
+    return f'push {segment} {_vm_segment_index(rng, segment, num_locals)}'
+
+  for _ in range(num_operations):
+    roll = rng.random()
+    if roll < label_density:
+      label = f'L{num_labels}'
+      num_labels += 1
+      lines.append(f'label {label}')
+      unused_labels.append(label)
+    elif unused_labels and depth >= 1 and roll < 2 * label_density:
+      lines.append(f'if-goto {unused_labels.pop()}')
+      depth -= 1
+    elif callees and roll < 2 * label_density + 0.02:
+      lines += [f'call {rng.choice(callees)} 0', 'pop temp 0']
+    elif depth >= 2 and roll < 0.4:
+      lines.append(rng.choice(VM_BINARY_OPS))
+      depth -= 1
+    elif depth >= 1 and roll < 0.5:
+      lines.append(rng.choice(VM_UNARY_OPS))
+    elif depth >= 1 and roll < 0.75:
+      segment = rng.choice(VM_SEGMENTS)
+      lines.append(f'pop {segment} {_vm_segment_index(rng, segment, num_locals)}')
+      depth -= 1
+    else:
+      lines.append(push())
+      depth += 1
+
+  for label in unused_labels:
+    lines += ['push constant 0', f'if-goto {label}']
+
+  return lines
+
+def _vm_segment_index(rng, segment, num_locals):
+  if segment == 'local':
+    return rng.randrange(num_locals)
+  elif segment == 'temp':
+    return rng.randrange(8)
+  return rng.randrange(16)
+
+def _run_benchmark(name, asm_src, vm_src, stats):
+  """
+  Runs benchmark name once, recording phases in stats
+  """
+  if name == BENCH_ASM:
+    Assembler(stats=stats).assemble(asm_src)
+  elif name == BENCH_ASM_OPTIMISED:
+    Assembler(optimise=OPT_ALL, stats=stats).assemble(asm_src)
+  elif name == BENCH_ASM_STREAM:
+    Assembler(output_hack=os.devnull, stats=stats).assemble_stream(asm_src)
+  elif name == BENCH_VM:
+    VM2ASM(no_init=True, stats=stats).translate(vm_src)
+  elif name == BENCH_VM_ASM:
+    translator = VM2ASM(no_init=True, stats=stats).translate(vm_src)
+    Assembler(optimise=OPT_ALL, stats=stats).assemble(translator.dumps())
+  else:
+    raise ValueError(f'Unknown benchmark {name}')
+
+def run_benchmark(name, asm_src, vm_src, repeat=3, memory=True):
+  """
+  Returns the results of benchmark name as a dict
+  """
+  best = None
+  times = []
+  for _ in range(repeat):
+    stats = Stats()
+    start = time.perf_counter()
+    _run_benchmark(name, asm_src, vm_src, stats)
+    elapsed = time.perf_counter() - start
+    times.append(elapsed)
+    if best is None or elapsed < best[0]:
+      best = (elapsed, stats)
+
+  elapsed, stats = best
+  source = vm_src if name == BENCH_VM or name == BENCH_VM_ASM else asm_src
+  num_lines = source.count('\n')
+  result = dict(name=name,
+                time=elapsed,
+                times=times,
+                lines=num_lines,
+                lines_per_second=num_lines / elapsed if elapsed else None,
+                phases=dict(stats.timers),
+                counters=dict(stats.counters),
+                peak_memory=None)
+
+  if memory:
+    tracemalloc.start()
+    try:
+      _run_benchmark(name, asm_src, vm_src, Stats(enabled=False))
+      result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+  return result
+
+def git_commit():
+  """
+  Returns the commit the tools are at, with -dirty appended if there are uncommitted changes, or
+  None if that cannot be found
+  """
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                            check=True, capture_output=True, text=True).stdout
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+  return f'{commit}-dirty' if status.strip() else commit
+
+def compare_results(old, new):
+  """
+  Returns a list of (name, old time, new time, ratio, old peak memory, new peak memory) for the
+  benchmarks in both old and new, which are results as written by run
+  """
+  old_results = {result['name']: result for result in old['results']}
+  rows = []
+  for result in new['results']:
+    before = old_results.get(result['name'])
+    if before is None:
+      continue
+    ratio = result['time'] / before['time'] if before['time'] else None
+    rows.append((result['name'], before['time'], result['time'], ratio,
+                 before['peak_memory'], result['peak_memory']))
+  return rows
+
+def _load_results(path):
+  with open(path) as fh:
+    results = json.load(fh)
+
+  if results.get('format') != RESULTS_FORMAT:
+    raise click.ClickException(f'{path} is not a benchmark result file')
+  if results.get('version') != RESULTS_FORMAT_VERSION:
+    raise click.ClickException(f'{path} has version {results.get("version")}, expected '
+                               f'{RESULTS_FORMAT_VERSION}')
+  return results
+
+def _format_memory(num_bytes):
+  if num_bytes is None:
+    return '-'
+  return f'{num_bytes / (1024 * 1024):.1f}M'
+
+@click.group()
+def main():
+  pass
+
+@main.command()
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              help='If given results are written as JSON to this file for use with compare')
+@click.option('-b', '--benchmark', 'benchmarks', type=click.Choice(BENCH_CHOICES), multiple=True,
+              help='Benchmark to run, can be given multiple times. Defaults to all')
+@click.option('--size', type=int, default=20000,
+              help='Number of statements in the generated .asm program')
+@click.option('--vm-size', type=int, default=5000,
+              help='Number of operations in the generated .vm program')
+@click.option('--label-density', type=float, default=0.05,
+              help='Chance of each statement being a label')
+@click.option('--macro-density', type=float, default=0.05,
+              help='Chance of each .asm statement being a macro')
+@click.option('--functions', type=int, default=16,
+              help='Number of functions in the generated programs')
+@click.option('--seed', type=int, default=0,
+              help='Seed of the generated programs')
+@click.option('--repeat', type=int, default=3,
+              help='Number of times each benchmark is run, the best time is kept')
+@click.option('--no-memory', is_flag=True,
+              help='If given peak memory is not measured, which saves a run of each benchmark')
+def run(output, benchmarks, size, vm_size, label_density, macro_density, functions, seed, repeat,
+        no_memory):
+  """
+  Runs the benchmarks
+  """
+  config = dict(size=size, vm_size=vm_size, label_density=label_density,
+                macro_density=macro_density, functions=functions, seed=seed, repeat=repeat)
+
+  asm_src = generate_asm(size, label_density, macro_density, functions, seed)
+  vm_src = generate_vm(vm_size, label_density, functions, seed)
+
+  results = []
+  click.echo(f'{"BENCHMARK":16s} {"TIME (ms)":>12s} {"LINES/S":>12s} {"PEAK MEM":>10s}', err=True)
+  for name in benchmarks or BENCH_CHOICES:
+    result = run_benchmark(name, asm_src, vm_src, repeat=repeat, memory=not no_memory)
+    results.append(result)
+    click.echo(f'{name:16s} {result["time"]*1000:12.1f} {result["lines_per_second"]:12.0f} '
+               f'{_format_memory(result["peak_memory"]):>10s}', err=True)
+    for phase, elapsed in result['phases'].items():
+      click.echo(f'  {phase:14s} {elapsed*1000:12.1f}', err=True)
+
+  if output is not None:
+    with open(output, 'w') as fh:
+      json.dump(dict(format=RESULTS_FORMAT,
+                     version=RESULTS_FORMAT_VERSION,
+                     commit=git_commit(),
+                     python=platform.python_version(),
+                     timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     config=config,
+                     results=results), fh, indent=2)
+
+@main.command()
+@click.argument('old', type=click.Path(dir_okay=False, exists=True))
+@click.argument('new', type=click.Path(dir_okay=False, exists=True))
+@click.option('--threshold', type=float,
+              help='If given exits with an error if any benchmark is slower by more than this '
+                   'fraction, e.g. 0.1 for 10%')
+def compare(old, new, threshold):
+  """
+  Compares the results of two runs
+  """
+  old_results = _load_results(old)
+  new_results = _load_results(new)
+
+  if old_results['config'] != new_results['config']:
+    click.echo('[WARNING] Results were run with different configurations', err=True)
+
+  click.echo(f'{old_results["commit"]} -> {new_results["commit"]}')
+  click.echo(f'{"BENCHMARK":16s} {"OLD (ms)":>10s} {"NEW (ms)":>10s} {"CHANGE":>8s} '
+             f'{"OLD MEM":>10s} {"NEW MEM":>10s}')
+
+  regressions = []
+  for name, old_time, new_time, ratio, old_mem, new_mem in compare_results(old_results,
+                                                                          new_results):
+    change = f'{100*(ratio - 1):+.1f}%' if ratio is not None else '-'
+    click.echo(f'{name:16s} {old_time*1000:10.1f} {new_time*1000:10.1f} {change:>8s} '
+               f'{_format_memory(old_mem):>10s} {_format_memory(new_mem):>10s}')
+    if threshold is not None and ratio is not None and ratio > 1 + threshold:
+      regressions.append(name)
+
+  if regressions:
+    raise click.ClickException(f'Slower by more than {100*threshold:.0f}%: '
+                               f'{", ".join(regressions)}')
+
+if __name__ == '__main__':
+  main()
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def test_generate_asm():
+  src = generate_asm(2000, seed=1)
+  assert src == generate_asm(2000, seed=1)
+  assert src != generate_asm(2000, seed=2)
+
+  assembler = Assembler().assemble(src)
+  assert assembler.warnings == []
+  assert assembler.num_instructions > 2000
+
+  # the same program assembles in compat mode
+  Assembler(compat=True, hazard_model=HAZARD_IDEAL).assemble(src)
+
+def test_generate_vm():
+  src = generate_vm(1000, seed=1)
+  translator = VM2ASM(no_init=True).translate(src)
+  assembler = Assembler(optimise=OPT_ALL).assemble(translator.dumps())
+  assert assembler.warnings == []
+
+def test_run_benchmark():
+  asm_src = generate_asm(200)
+  vm_src = generate_vm(100)
+  result = run_benchmark(BENCH_VM_ASM, asm_src, vm_src, repeat=2)
+  assert len(result['times']) == 2
+  assert result['time'] == min(result['times'])
+  assert {'parse', 'expand', 'optimise', 'emit'} <= set(result['phases'])
+  assert result['peak_memory'] > 0
+
+def test_compare_results():
+  old = dict(results=[dict(name=BENCH_ASM, time=2.0, peak_memory=10),
+                      dict(name=BENCH_VM, time=1.0, peak_memory=None)])
+  new = dict(results=[dict(name=BENCH_ASM, time=1.0, peak_memory=8),
+                      dict(name=BENCH_ASM_STREAM, time=1.0, peak_memory=8)])
+  assert compare_results(old, new) == [(BENCH_ASM, 2.0, 1.0, 0.5, 10, 8)]
@@ -0,0 +1,165 @@
+"""
+Writers for the machine code produced by the assembler in formats other than the textual
+.hack format, which is 17 bytes per instruction and only understood by $readmemb.
+
+All writers take a sequence of 16 bit integers, one per instruction.
+"""
+
+import sys
+from array import array
+
+FORMAT_HACK = 'hack'
+FORMAT_BIN_LE = 'bin-le'
+FORMAT_BIN_BE = 'bin-be'
+FORMAT_IHEX = 'ihex'
+FORMAT_HEX = 'hex'
+FORMAT_EBR = 'ebr'
+FORMAT_CHOICES = (FORMAT_HACK,
+                  FORMAT_BIN_LE,
+                  FORMAT_BIN_BE,
+                  FORMAT_IHEX,
+                  FORMAT_HEX,
+                  FORMAT_EBR)
+
+# formats which are written as bytes instead of text
+BINARY_FORMATS = (FORMAT_BIN_LE, FORMAT_BIN_BE)
+
+# the icebreaker has 30 EBR units of 256x16 size, see README
+EBR_NUM_BLOCKS = 30
+EBR_BLOCK_WORDS = 256
+EBR_ROM_WORDS = EBR_NUM_BLOCKS * EBR_BLOCK_WORDS
+
+# number of data bytes in each Intel HEX data record
+IHEX_RECORD_BYTES = 16
+
+def write_firmware(fh, codes, fmt):
+  """
+  Writes codes to fh in format fmt. fh must be opened in binary mode for BINARY_FORMATS and text
+  mode otherwise.
+  """
+  writers = {
+      FORMAT_BIN_LE: lambda fh, codes: write_binary(fh, codes, 'little'),
+      FORMAT_BIN_BE: lambda fh, codes: write_binary(fh, codes, 'big'),
+      FORMAT_IHEX: write_ihex,
+      FORMAT_HEX: write_readmemh,
+      FORMAT_EBR: write_ebr_image,
+  }
+
+  try:
+    writer = writers[fmt]
+  except KeyError:
+    raise ValueError(f'Unsupported firmware format {fmt}')
+
+  writer(fh, codes)
+
+def write_firmware_file(path, codes, fmt):
+  """
+  Like write_firmware() but writes to path, or stdout if path is None
+  """
+  binary = fmt in BINARY_FORMATS
+  if path is None:
+    fh = sys.stdout.buffer if binary else sys.stdout
+    write_firmware(fh, codes, fmt)
+    fh.flush()
+  else:
+    with open(path, 'wb' if binary else 'w') as fh:
+      write_firmware(fh, codes, fmt)
+
+def write_binary(fh, codes, byteorder='little'):
+  """
+  Writes codes as packed 16 bit words
+  """
+  words = array('H', codes)
+  if (byteorder == 'little') != (sys.byteorder == 'little'):
+    words.byteswap()
+  fh.write(words.tobytes())
+
+def write_readmemh(fh, codes):
+  """
+  Writes codes as one 4 digit hex word per line, suitable for use with $readmemh in verilog
+  """
+  for code in codes:
+    fh.write(f'{code:04x}\n')
+
+def write_ebr_image(fh, codes):
+  """
+  Writes codes as an image of the entire EBR ROM, one 4 digit hex word per line padded with 0s to
+  EBR_ROM_WORDS words. This is the format expected by icebram which can swap the content of the
+  ROM in a bitstream without rebuilding it.
+  """
+  if len(codes) > EBR_ROM_WORDS:
+    raise ValueError(f'Program of {len(codes)} instructions does not fit in the '
+                     f'{EBR_ROM_WORDS} word EBR ROM')
+
+  write_readmemh(fh, codes)
+  for _ in range(EBR_ROM_WORDS - len(codes)):
+    fh.write('0000\n')
+
+def _ihex_record(record_type, address, data):
+  record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+  checksum = (-sum(record)) & 0xFF
+  return f':{record.hex().upper()}{checksum:02X}\n'
+
+def write_ihex(fh, codes):
+  """
+  Writes codes in Intel HEX format. Addresses are byte addresses and each word is stored big
+  endian. The largest possible program (32K words) fits in the 64KB addressable without extended
+  address records.
+  """
+  data = array('H', codes)
+  if sys.byteorder == 'little':
+    data.byteswap()
+  data = data.tobytes()
+
+  if len(data) > 0x10000:
+    raise ValueError('Program too large for Intel HEX output')
+
+  for address in range(0, len(data), IHEX_RECORD_BYTES):
+    fh.write(_ihex_record(0x00, address, data[address:address + IHEX_RECORD_BYTES]))
+
+  # end of file
+  fh.write(_ihex_record(0x01, 0, b''))
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def test_binary():
+  import io
+  fh = io.BytesIO()
+  write_binary(fh, [0x1234, 0xEC10], 'little')
+  assert fh.getvalue() == b'\x34\x12\x10\xEC'
+
+  fh = io.BytesIO()
+  write_binary(fh, [0x1234, 0xEC10], 'big')
+  assert fh.getvalue() == b'\x12\x34\xEC\x10'
+
+def test_readmemh():
+  import io
+  fh = io.StringIO()
+  write_readmemh(fh, [0x1234, 0xEC10])
+  assert fh.getvalue() == '1234\nec10\n'
+
+def test_ihex():
+  import io
+  fh = io.StringIO()
+  write_ihex(fh, [0x0002, 0xEC10] + [0]*8)
+  lines = fh.getvalue().splitlines()
+  assert lines[0] == ':100000000002EC10000000000000000000000000F2'
+  assert lines[1] == ':0400100000000000EC'
+  assert lines[-1] == ':00000001FF'
+
+def test_ebr_image():
+  import io
+  fh = io.StringIO()
+  write_ebr_image(fh, [0xFFFF])
+  lines = fh.getvalue().splitlines()
+  assert len(lines) == EBR_ROM_WORDS
+  assert lines[0] == 'ffff'
+  assert lines[-1] == '0000'
+
+  try:
+    write_ebr_image(io.StringIO(), [0]*(EBR_ROM_WORDS+1))
+    assert False, 'Should have failed'
+  except ValueError:
+    pass
@@ -0,0 +1,1471 @@
+#!/usr/bin/env python3
+
+"""
+Instruction set simulator for HACK and HACKx machine code.
+
+Every word of the program is decoded once, up front, into either an int, for A-instructions, or
+a tuple describing a C-instruction, so the main loop does no bit twiddling. The simulator follows
+CPUx.v: the y input of the ALU is A, M or W, M is written and jumps go to the value A held before
+the instruction, and bits 14 and 13 of C-instructions are inverted so HACK programs run unmodified.
+Pipeline hazards are not modelled, so the NOPs inserted by the assembler simply take a cycle.
+
+RAM is an array of unsigned 16 bit words, so the screen and keyboard can be viewed without copying
+and the screen rendered to PBM or PNG by byte operations rather than a loop over the pixels. If
+NumPy is installed the RAM can also be used as a NumPy array, again without copying.
+"""
+
+import sys
+import json
+import time
+import zlib
+import struct
+from array import array
+from collections import Counter
+
+import click
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from assembler import (Assembler, COMP_TABLE, OPT_CHOICES, SIZE_REPORT_TOP_LEVEL,
+                       VM_FUNCTION_ANNOTATION_RE)
+from vm2asm import Operation
+from sourcemap import SourceMap
+
+RAM_SIZE = 0x8000
+ROM_SIZE = 0x8000
+ADDRESS_MASK = 0x7FFF
+
+# memory mapped I/O, see the predefined symbols of the assembler
+SCREEN_ADDRESS = 16384
+KBD_ADDRESS = 24576
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+SCREEN_ROW_BYTES = SCREEN_WIDTH // 8
+
+# most instructions BlockSimulator puts in one block, which bounds the time spent compiling code
+# that only runs once
+BLOCK_MAX_LENGTH = 256
+
+# cycle budget of BlockSimulator.run() without max_cycles
+UNLIMITED_CYCLES = 1 << 62
+
+# furthest a return can land after the jump of its call, which is followed by the return address
+# label, after any NOPs the hazard model puts after jumps
+RETURN_DISTANCE = 4
+
+# number of rows of each table printed by Profile
+PROFILE_TOP = 20
+
+def _operation_names(cls):
+  names = {cls.__name__.split('_', 1)[0]}
+  for subclass in cls.__subclasses__():
+    names |= _operation_names(subclass)
+  return names
+
+# first words of the annotations vm2asm.py -A writes before each operation, see
+# Operation.get_annotations(), and before the initialisation code
+VM_OPERATIONS = frozenset(_operation_names(Operation) | {'INIT'})
+
+# sources of the y input of the ALU, selected by the w and a bits
+Y_A = 0
+Y_M = 1
+Y_W = 2
+
+# ALU of the computations in COMP_TABLE taking (x, y), where x is D and y is A, M or W
+_ALU_COMPS = {
+    '0'  : lambda x, y: 0,
+    '1'  : lambda x, y: 1,
+    '-1' : lambda x, y: 0xFFFF,
+    'D'  : lambda x, y: x,
+    'A'  : lambda x, y: y,
+    '!D' : lambda x, y: x ^ 0xFFFF,
+    '!A' : lambda x, y: y ^ 0xFFFF,
+    '-D' : lambda x, y: -x & 0xFFFF,
+    '-A' : lambda x, y: -y & 0xFFFF,
+    'D+1': lambda x, y: (x + 1) & 0xFFFF,
+    'A+1': lambda x, y: (y + 1) & 0xFFFF,
+    'D-1': lambda x, y: (x - 1) & 0xFFFF,
+    'A-1': lambda x, y: (y - 1) & 0xFFFF,
+    'D+A': lambda x, y: (x + y) & 0xFFFF,
+    'D-A': lambda x, y: (x - y) & 0xFFFF,
+    'A-D': lambda x, y: (y - x) & 0xFFFF,
+    'D&A': lambda x, y: x & y,
+    'D|A': lambda x, y: x | y,
+}
+
+# maps c1..c6 to the ALU function
+ALU_FUNCTIONS = {COMP_TABLE[comp]: func for comp, func in _ALU_COMPS.items()}
+
+def alu(c1_c6, x, y):
+  """
+  Computes the output of the ALU bit by bit as the hardware does. Used for the combinations of
+  c1..c6 which are not in COMP_TABLE.
+  """
+  zx, nx, zy, ny, f, no = ((c1_c6 >> bit) & 1 for bit in range(5, -1, -1))
+  if zx:
+    x = 0
+  if nx:
+    x ^= 0xFFFF
+  if zy:
+    y = 0
+  if ny:
+    y ^= 0xFFFF
+  out = (x + y) & 0xFFFF if f else x & y
+  if no:
+    out ^= 0xFFFF
+  return out
+
+def _alu_function(c1_c6):
+  try:
+    return ALU_FUNCTIONS[c1_c6]
+  except KeyError:
+    return lambda x, y: alu(c1_c6, x, y)
+
+# Python expressions of the computations in COMP_TABLE given the expressions of x and y, used by
+# BlockSimulator
+_ALU_EXPRESSIONS = {
+    '0'  : '0',
+    '1'  : '1',
+    '-1' : '0xFFFF',
+    'D'  : '{x}',
+    'A'  : '{y}',
+    '!D' : '{x} ^ 0xFFFF',
+    '!A' : '{y} ^ 0xFFFF',
+    '-D' : '-{x} & 0xFFFF',
+    '-A' : '-{y} & 0xFFFF',
+    'D+1': '({x} + 1) & 0xFFFF',
+    'A+1': '({y} + 1) & 0xFFFF',
+    'D-1': '({x} - 1) & 0xFFFF',
+    'A-1': '({y} - 1) & 0xFFFF',
+    'D+A': '({x} + {y}) & 0xFFFF',
+    'D-A': '({x} - {y}) & 0xFFFF',
+    'A-D': '({y} - {x}) & 0xFFFF',
+    'D&A': '{x} & {y}',
+    'D|A': '{x} | {y}',
+}
+
+ALU_EXPRESSIONS = {COMP_TABLE[comp]: expr for comp, expr in _ALU_EXPRESSIONS.items()}
+
+# whether a jump is taken, indexed by j1..j3 and then 0 for a zero, 1 for a positive and 2 for a
+# negative ALU output. None if the instruction does not jump
+JUMP_TAKEN = [None] + [(bool(j & 2), bool(j & 1), bool(j & 4)) for j in range(1, 8)]
+
+# Python expressions deciding whether each entry of JUMP_TAKEN jumps given the ALU output in out,
+# used by BlockSimulator
+JUMP_CONDITION_EXPRESSIONS = {
+    JUMP_TAKEN[0b001]: '0 < out < 0x8000',
+    JUMP_TAKEN[0b010]: 'out == 0',
+    JUMP_TAKEN[0b011]: 'out < 0x8000',
+    JUMP_TAKEN[0b100]: 'out >= 0x8000',
+    JUMP_TAKEN[0b101]: 'out != 0',
+    JUMP_TAKEN[0b110]: 'out == 0 or out >= 0x8000',
+    JUMP_TAKEN[0b111]: 'True',
+}
+
+# computations whose result does not depend on the registers
+CONSTANT_COMPUTATIONS = {COMP_TABLE['0'], COMP_TABLE['1'], COMP_TABLE['-1']}
+
+def decode(code, hackx=True):
+  """
+  Returns the pre-decoded form of the instruction code. A-instructions are decoded into their
+  value and C-instructions into a tuple of (ALU function, y source, write A, write D, write M,
+  write W, jump) where jump is an entry of JUMP_TAKEN.
+
+  When hackx is False bits 14 and 13 are ignored as on the original HACK CPU.
+  """
+  if not code & 0x8000:
+    return code
+
+  w = hackx and not code & 0x4000
+  a = (code >> 12) & 1
+  if w and a:
+    raise ValueError(f'Invalid instruction {code:016b}, W and M cannot both be the y input')
+
+  y = Y_W if w else (Y_M if a else Y_A)
+  return (_alu_function((code >> 6) & 0b111111),
+          y,
+          bool(code & 0b100000),
+          bool(code & 0b010000),
+          bool(code & 0b001000),
+          hackx and not code & 0x2000,
+          JUMP_TAKEN[code & 0b111])
+
+def read_hack(path):
+  """
+  Returns the machine code in the .hack file path as a list of integers. Annotations, blank lines
+  and the _ of pretty printed output are ignored.
+  """
+  codes = []
+  with open(path) as fh:
+    for line in fh:
+      line = line.split('//', 1)[0].strip().replace('_', '')
+      if line:
+        codes.append(int(line, 2))
+  return codes
+
+class Simulator:
+  """
+  Runs a program given as a sequence of 16 bit machine codes. The registers, ram and number of
+  cycles executed can be inspected and modified between calls to run().
+  """
+
+  def __init__(self, codes, hackx=True):
+    codes = list(codes)
+    if len(codes) > ROM_SIZE:
+      raise ValueError(f'Program of {len(codes)} instructions does not fit in the ROM')
+
+    self.codes = codes
+    self.hackx = hackx
+    self.program = [decode(code, hackx) for code in codes]
+
+    # addresses of jumps which are always taken, JMP or a constant computation satisfying the
+    # condition such as the 0;JEQ of $call and of goto in vm2asm.py
+    self._unconditional = set()
+    for pc, inst in enumerate(self.program):
+      if type(inst) == tuple and inst[6] is not None:
+        out = inst[0](0, 0)
+        if inst[6] == JUMP_TAKEN[7] or (((codes[pc] >> 6) & 0b111111) in CONSTANT_COMPUTATIONS
+                                        and inst[6][0 if out == 0 else (2 if out & 0x8000 else 1)]):
+          self._unconditional.add(pc)
+
+    # addresses of the jumps of `(X) @X 0;JMP` loops. Taking the jump halts the simulation as
+    # nothing else can happen, unless the jump also writes somewhere
+    self._halt_loops = set()
+    for pc in self._unconditional:
+      if pc > 0 and self.program[pc - 1] == pc - 1 and not any(self.program[pc][2:6]):
+        self._halt_loops.add(pc)
+
+    self.reset()
+
+  def reset(self):
+    self.pc = 0
+    self.a = 0
+    self.d = 0
+    self.w = 0
+    self.ram = array('H', bytes(2 * RAM_SIZE))
+    self.cycles = 0
+    self.halted = False
+
+  @property
+  def screen(self):
+    """
+    Writable view of the screen memory, valid until reset()
+    """
+    return memoryview(self.ram)[SCREEN_ADDRESS:KBD_ADDRESS]
+
+  @property
+  def kbd(self):
+    """
+    Writable view of the one word keyboard register, valid until reset()
+    """
+    return memoryview(self.ram)[KBD_ADDRESS:KBD_ADDRESS + 1]
+
+  def ram_array(self):
+    """
+    Returns a NumPy uint16 array sharing memory with the RAM, valid until reset()
+    """
+    if numpy is None:
+      raise ImportError('ram_array() needs numpy')
+    return numpy.frombuffer(self.ram, dtype=numpy.uint16)
+
+  def ram_mismatches(self, start, expected):
+    """
+    Returns the addresses from start where RAM differs from the sequence of words expected
+    """
+    expected = array('H', expected)
+    actual = self.ram[start:start + len(expected)]
+    if actual == expected:
+      return []
+    return [start + offset for offset, (x, y) in enumerate(zip(actual, expected)) if x != y]
+
+  def run(self, max_cycles=None):
+    """
+    Runs until the program halts, by running off the end of the ROM or entering a `(X) @X 0;JMP`
+    loop or one like it, or max_cycles instructions have been executed. Returns the number
+    executed.
+    """
+    if self.halted:
+      return 0
+
+    program = self.program
+    ram = self.ram
+    halt_loops = self._halt_loops
+    num_instructions = len(program)
+
+    pc, a, d, w = self.pc, self.a, self.d, self.w
+    remaining = max_cycles if max_cycles is not None else -1
+    executed = 0
+    halted = False
+
+    while remaining:
+      remaining -= 1
+      if pc >= num_instructions:
+        halted = True
+        break
+
+      inst = program[pc]
+      executed += 1
+      if type(inst) is int:
+        a = inst
+        pc += 1
+        continue
+
+      func, y, write_a, write_d, write_m, write_w, jump = inst
+      if y == Y_A:
+        out = func(d, a)
+      elif y == Y_M:
+        out = func(d, ram[a & ADDRESS_MASK])
+      else:
+        out = func(d, w)
+
+      if write_m:
+        ram[a & ADDRESS_MASK] = out
+
+      if jump is not None and jump[0 if out == 0 else (2 if out & 0x8000 else 1)]:
+        if pc in halt_loops and a == pc - 1:
+          halted = True
+          pc = a & ADDRESS_MASK
+          break
+        pc = a & ADDRESS_MASK
+      else:
+        pc += 1
+
+      if write_a:
+        a = out
+      if write_d:
+        d = out
+      if write_w:
+        w = out
+
+    self.pc, self.a, self.d, self.w = pc, a, d, w
+    self.cycles += executed
+    self.halted = halted
+    return executed
+
+  def step(self):
+    """
+    Executes a single instruction, returns False if the program has halted
+    """
+    return self.run(1) == 1 and not self.halted
+
+class BlockSimulator(Simulator):
+  """
+  Simulator which translates each block of the program, from an address jumped to up to and
+  including the next unconditional jump, into a Python function the first time it is entered.
+  Conditional jumps return from the middle of the function. Within a block the value of A is
+  tracked while it is known, so `@X` followed by `M=D` becomes `ram[X] = d`, and a jump back to
+  the start of the block loops inside the function. Functions are cached by their entry address
+  and called one after the other, which saves the dispatch of every instruction. The ROM cannot
+  change so blocks never need recompiling.
+
+  When max_cycles ends part way through a block the rest is interpreted, so the state after a run
+  is the same as with Simulator.
+  """
+
+  def reset(self):
+    super().reset()
+
+    # maps entry addresses to (function, number of instructions)
+    self._blocks = {}
+
+  def _block_end(self, entry):
+    end = entry
+    while end < len(self.program) and end - entry < BLOCK_MAX_LENGTH:
+      inst = self.program[end]
+      end += 1
+      if type(inst) == tuple and inst[6] == JUMP_TAKEN[7]:
+        break
+    return end
+
+  def block_source(self, entry, loops=None):
+    """
+    Returns the source of the function implementing the block starting at entry, and the most
+    instructions it executes before returning unless it loops. The function takes (ram, a, d, w,
+    budget) and returns (next pc, a, d, w, halted, instructions executed). A jump back to entry
+    is a loop in the function, repeated while another pass fits in budget cycles.
+    """
+    end = self._block_end(entry)
+    indent = '    ' if loops else '  '
+    lines = []
+
+    def emit(line):
+      lines.append(indent + line)
+
+    # value of A if known at this point of the block
+    known_a = None
+    jumps_to_entry = False
+
+    def a_expr():
+      return str(known_a) if known_a is not None else 'a'
+
+    def address_expr():
+      return str(known_a & ADDRESS_MASK) if known_a is not None else f'a & {ADDRESS_MASK}'
+
+    def executed(count):
+      return f'n + {count}' if loops else str(count)
+
+    for pc in range(entry, end):
+      inst = self.program[pc]
+      if type(inst) is int:
+        known_a = inst
+        continue
+
+      func, y, write_a, write_d, write_m, write_w, jump = inst
+      if not (write_a or write_d or write_m or write_w or jump):
+        # only reading memory has no effect
+        continue
+
+      c1_c6 = (self.codes[pc] >> 6) & 0b111111
+      if y == Y_A:
+        y_expr = a_expr()
+      elif y == Y_M:
+        y_expr = f'ram[{address_expr()}]'
+      else:
+        y_expr = 'w'
+
+      try:
+        expr = ALU_EXPRESSIONS[c1_c6].format(x='d', y=y_expr)
+      except KeyError:
+        expr = f'alu({c1_c6}, d, {y_expr})'
+
+      # constant computations are folded by the compiler, but jumps on them are decided here
+      condition = None
+      if jump is not None:
+        condition = JUMP_CONDITION_EXPRESSIONS[jump]
+        if condition != 'True' and not ('a' in expr or 'd' in expr or 'w' in expr):
+          condition = str(eval(condition, dict(out=eval(expr))))
+          if condition == 'False':
+            condition = None
+
+      writes = []
+      if write_m:
+        writes.append(f'ram[{address_expr()}]')
+      if write_d:
+        writes.append('d')
+      if write_w:
+        writes.append('w')
+      if write_a:
+        writes.append('a')
+
+      if condition is not None:
+        # jumps go to where A pointed before this instruction
+        target = address_expr()
+        halt = 'False'
+        if pc in self._halt_loops:
+          halt = str(known_a == pc - 1) if known_a is not None else f'a == {pc - 1}'
+        if known_a is None:
+          emit(f'target = {target}')
+          emit(f'halt = {halt}')
+          target, halt = 'target', 'halt'
+
+      if writes and condition is None and len(writes) == 1:
+        emit(f'{writes[0]} = {expr}')
+      elif writes or condition not in (None, 'True', 'False'):
+        emit(f'out = {expr}')
+        for dest in writes:
+          emit(f'{dest} = out')
+
+      if write_a:
+        known_a = None
+
+      if condition is None:
+        continue
+
+      count = pc + 1 - entry
+      if condition == 'True':
+        if target == str(entry) and halt == 'False':
+          jumps_to_entry = True
+          if loops:
+            # the next pass reads a, which need not be entry when the block was entered
+            emit(f'n += {count}')
+            if known_a is not None:
+              emit(f'a = {known_a}')
+            emit(f'if n + {end - entry} <= budget: continue')
+            emit(f'return {target}, {a_expr()}, d, w, False, n')
+            break
+        emit(f'return {target}, {a_expr()}, d, w, {halt}, {executed(count)}')
+        break
+
+      emit(f'if {condition}:')
+      if target == str(entry) and halt == 'False':
+        jumps_to_entry = True
+        if loops:
+          emit(f'  n += {count}')
+          if known_a is not None:
+            emit(f'  a = {known_a}')
+          emit(f'  if n + {end - entry} <= budget: continue')
+          emit(f'  return {target}, {a_expr()}, d, w, False, n')
+          continue
+      emit(f'  return {target}, {a_expr()}, d, w, {halt}, {executed(count)}')
+    else:
+      emit(f'return {end}, {a_expr()}, d, w, False, {executed(end - entry)}')
+
+    if loops is None and jumps_to_entry:
+      return self.block_source(entry, loops=True)
+
+    header = ['def block(ram, a, d, w, budget):']
+    if loops:
+      header += ['  n = 0', '  while True:']
+    return '\n'.join(header + lines) + '\n', end - entry
+
+  def _compile_block(self, entry):
+    source, length = self.block_source(entry)
+    namespace = dict(alu=alu)
+    exec(compile(source, f'<block {entry}>', 'exec'), namespace)
+    block = self._blocks[entry] = (namespace['block'], length)
+    return block
+
+  def run(self, max_cycles=None):
+    if self.halted:
+      return 0
+
+    blocks = self._blocks
+    ram = self.ram
+    num_instructions = len(self.program)
+
+    pc, a, d, w = self.pc, self.a, self.d, self.w
+    remaining = max_cycles if max_cycles is not None else UNLIMITED_CYCLES
+    executed = 0
+    halted = False
+
+    while True:
+      if pc >= num_instructions:
+        halted = True
+        break
+
+      try:
+        block, length = blocks[pc]
+      except KeyError:
+        block, length = self._compile_block(pc)
+
+      if remaining < length:
+        break
+
+      pc, a, d, w, halted, length = block(ram, a, d, w, remaining)
+      executed += length
+      remaining -= length
+      if halted:
+        break
+
+    self.pc, self.a, self.d, self.w = pc, a, d, w
+    self.cycles += executed
+    self.halted = halted
+
+    # finish with the instructions left of the last block
+    if not halted and remaining > 0:
+      executed += super().run(remaining)
+
+    return executed
+
+class ProfilingSimulator(Simulator):
+  """
+  Simulator which counts how often each instruction is executed and each jump is taken. Given the
+  block of each instruction, as found by attribute_annotations(), a jump to the first instruction
+  of a block is also counted as a call, and a jump back to just after the calling jump as its
+  return. The cycles between the two are the inclusive cycles of the block called. Within a block
+  only unconditional jumps to its start are calls, as conditional ones are loops.
+  """
+
+  def __init__(self, codes, hackx=True, blocks=None):
+    self.blocks = list(blocks) if blocks is not None else [SIZE_REPORT_TOP_LEVEL] * len(codes)
+    if len(self.blocks) != len(codes):
+      raise ValueError(f'Got the blocks of {len(self.blocks)} instructions for a program of '
+                       f'{len(codes)}')
+
+    # maps the first instruction of each block to its name
+    self._entries = {}
+    seen = {SIZE_REPORT_TOP_LEVEL}
+    for pc, block in enumerate(self.blocks):
+      if block not in seen:
+        seen.add(block)
+        self._entries[pc] = block
+
+    super().__init__(codes, hackx)
+
+  def reset(self):
+    super().reset()
+    self.counts = [0] * len(self.program)
+    self.taken = [0] * len(self.program)
+
+    # maps (caller, callee) to the number of calls
+    self.calls = Counter()
+    self._inclusive = Counter()
+
+    # (callee, PC of the calling jump, cycle of the call) of each call not yet returned from
+    self._stack = []
+    self._active = Counter()
+
+  def _call(self, pc, target, cycle):
+    callee = self._entries[target]
+    self.calls[self.blocks[pc], callee] += 1
+    self._stack.append((callee, pc, cycle))
+    self._active[callee] += 1
+
+  def _return(self, cycle):
+    callee, _, start = self._stack.pop()
+    self._active[callee] -= 1
+
+    # time in recursive calls is already counted by the outermost one
+    if not self._active[callee]:
+      self._inclusive[callee] += cycle - start
+
+  def inclusive_cycles(self):
+    """
+    Returns a Counter of the cycles spent in each block, including in the blocks it called, with
+    calls not yet returned from counted up to now
+    """
+    inclusive = Counter(self._inclusive)
+    outermost = set()
+    for callee, _, start in self._stack:
+      if callee not in outermost:
+        outermost.add(callee)
+        inclusive[callee] += self.cycles - start
+    return inclusive
+
+  def run(self, max_cycles=None):
+    if self.halted:
+      return 0
+
+    program = self.program
+    ram = self.ram
+    halt_loops = self._halt_loops
+    entries = self._entries
+    unconditional = self._unconditional
+    stack = self._stack
+    counts = self.counts
+    taken = self.taken
+    num_instructions = len(program)
+
+    pc, a, d, w = self.pc, self.a, self.d, self.w
+    remaining = max_cycles if max_cycles is not None else -1
+    executed = 0
+    halted = False
+
+    while remaining:
+      remaining -= 1
+      if pc >= num_instructions:
+        halted = True
+        break
+
+      inst = program[pc]
+      executed += 1
+      counts[pc] += 1
+      if type(inst) is int:
+        a = inst
+        pc += 1
+        continue
+
+      func, y, write_a, write_d, write_m, write_w, jump = inst
+      if y == Y_A:
+        out = func(d, a)
+      elif y == Y_M:
+        out = func(d, ram[a & ADDRESS_MASK])
+      else:
+        out = func(d, w)
+
+      if write_m:
+        ram[a & ADDRESS_MASK] = out
+
+      if jump is not None and jump[0 if out == 0 else (2 if out & 0x8000 else 1)]:
+        taken[pc] += 1
+        target = a & ADDRESS_MASK
+        if pc in halt_loops and a == pc - 1:
+          halted = True
+          pc = target
+          break
+
+        if target in entries and (pc in unconditional or self.blocks[pc] != entries[target]):
+          self._call(pc, target, self.cycles + executed)
+        elif stack and 0 < target - stack[-1][1] <= RETURN_DISTANCE:
+          self._return(self.cycles + executed)
+        pc = target
+      else:
+        pc += 1
+
+      if write_a:
+        a = out
+      if write_d:
+        d = out
+      if write_w:
+        w = out
+
+    self.pc, self.a, self.d, self.w = pc, a, d, w
+    self.cycles += executed
+    self.halted = halted
+    return executed
+
+def parse_annotations(lines):
+  """
+  Returns the annotations of each instruction in the lines of a .hack file written with -A, as a
+  list indexed by PC of the source lines before and including the instruction. Instructions
+  removed by the optimiser are skipped but their source lines go to the next instruction.
+  """
+  annotations = []
+  block = []
+  for l in lines:
+    l = l.strip()
+    if l.startswith('//'):
+      if not l.startswith('// [OPTIMISER REMOVED]'):
+        block.append(l[3:])
+    elif l:
+      annotations.append(block)
+      block = []
+  return annotations
+
+def attribute_annotations(annotations):
+  """
+  Returns (asm, block, VM operation) of each instruction given their annotations as returned by
+  parse_annotations(). asm is the source line of the instruction and block is the func_/sub_
+  block or VM function it is in, as in the size report of the assembler. VM operation is
+  (PC of its first instruction, annotation) of the operation annotated by vm2asm.py -A the
+  instruction implements, or None.
+  """
+  attribution = []
+  block = SIZE_REPORT_TOP_LEVEL
+  operation = None
+  for pc, lines in enumerate(annotations):
+    for l in lines:
+      if l.startswith('(func_') or l.startswith('(sub_'):
+        block = l[1:l.index(')')]
+      elif l.startswith('// '):
+        m = VM_FUNCTION_ANNOTATION_RE.match(l)
+        if m:
+          block = m.group(1)
+        if l[3:].split(' ', 1)[0] in VM_OPERATIONS:
+          operation = (pc, l[3:])
+    attribution.append((lines[-1] if lines else '', block, operation))
+  return attribution
+
+def attribute_source_map(source_map, num_instructions):
+  """
+  Like attribute_annotations() but from the source map of the program, such as written by
+  assembler.py -m, for num_instructions instructions. asm is file:line and VM operations are only
+  found if the map includes the map written by vm2asm.py -m.
+  """
+  # the function operation of vm2asm.py is only a label, so the VM function of each line of asm is
+  # found from the order of operations rather than from the PCs
+  vm_functions = SourceMap()
+  if source_map.parent is not None:
+    function = None
+    for start, _, _, operation in source_map.parent.ranges():
+      if operation is not None and operation.startswith('FUNCTION '):
+        function = operation.split(' ')[1]
+      vm_functions.add(start, None, None, function)
+
+  attribution = []
+  operation = None
+  last_vm_source = None
+  for pc in range(num_instructions):
+    chain = source_map.resolve(pc)
+    if not chain:
+      attribution.append(('', SIZE_REPORT_TOP_LEVEL, None))
+      continue
+
+    asm_file, asm_line, block = chain[0]
+    vm_source = vm_functions.lookup(asm_line) if asm_line is not None else None
+    vm_function = vm_source[2] if vm_source else None
+    if len(chain) > 1 and chain[1] != last_vm_source:
+      last_vm_source = chain[1]
+      if chain[1][2] is not None:
+        operation = (pc, chain[1][2])
+
+    attribution.append((f'{asm_file}:{asm_line}', block or vm_function or SIZE_REPORT_TOP_LEVEL,
+                        operation))
+  return attribution
+
+class Profile:
+  """
+  Execution profile of a ProfilingSimulator run, attributed to the source of the program. Cycles
+  are aggregated per PC, per block and per VM operation, both each annotated operation and each
+  kind of operation, e.g. all CALLs.
+  """
+
+  def __init__(self, sim, attribution=None):
+    if attribution is None:
+      attribution = [('', block, None) for block in sim.blocks]
+    self.sim = sim
+    self.attribution = attribution
+
+  def pcs(self):
+    """
+    Returns a dict for each executed PC, most executed first
+    """
+    sim = self.sim
+    pcs = []
+    for pc, count in enumerate(sim.counts):
+      if not count:
+        continue
+      asm, block, operation = self.attribution[pc]
+      entry = dict(pc=pc, count=count, asm=asm, block=block,
+                   operation=operation[1] if operation else None)
+      inst = sim.program[pc]
+      if type(inst) is tuple and inst[6] is not None:
+        entry.update(taken=sim.taken[pc], not_taken=count - sim.taken[pc])
+      pcs.append(entry)
+    return sorted(pcs, key=lambda entry: (-entry['count'], entry['pc']))
+
+  def blocks(self):
+    """
+    Returns a dict for each block with the cycles spent in it, cycles including those in the
+    blocks it called and the calls made to it, most cycles first
+    """
+    cycles = Counter()
+    for (_, block, _), count in zip(self.attribution, self.sim.counts):
+      cycles[block] += count
+
+    inclusive = self.sim.inclusive_cycles()
+    inclusive[SIZE_REPORT_TOP_LEVEL] = self.sim.cycles
+    calls = Counter()
+    for (_, callee), count in self.sim.calls.items():
+      calls[callee] += count
+
+    return [dict(name=name, cycles=count, inclusive=inclusive[name], calls=calls[name])
+            for name, count in cycles.most_common() if count]
+
+  def operations(self):
+    """
+    Returns a dict for each annotated VM operation with the cycles spent in it and the number of
+    times it ran, most cycles first
+    """
+    cycles = Counter()
+    for (_, block, operation), count in zip(self.attribution, self.sim.counts):
+      if operation is not None:
+        cycles[block, operation] += count
+
+    return [dict(pc=pc, block=block, operation=text, cycles=count, runs=self.sim.counts[pc])
+            for (block, (pc, text)), count in cycles.most_common() if count]
+
+  def operation_kinds(self):
+    """
+    Returns a dict for each kind of VM operation with the cycles spent in all operations of the
+    kind and the number of times they ran, most cycles first
+    """
+    cycles = Counter()
+    runs = Counter()
+    for operation in self.operations():
+      kind = operation['operation'].split(' ', 1)[0]
+      cycles[kind] += operation['cycles']
+      runs[kind] += operation['runs']
+    return [dict(kind=kind, cycles=count, runs=runs[kind]) for kind, count in cycles.most_common()]
+
+  def call_graph(self):
+    """
+    Returns a dict for each call with the names of the caller and callee and the number of calls
+    """
+    return [dict(caller=caller, callee=callee, calls=count)
+            for (caller, callee), count in self.sim.calls.most_common()]
+
+  def to_dict(self):
+    return dict(cycles=self.sim.cycles,
+                pcs=self.pcs(),
+                blocks=self.blocks(),
+                operations=self.operations(),
+                operation_kinds=self.operation_kinds(),
+                call_graph=self.call_graph())
+
+  def write_json(self, path):
+    """
+    Writes the profile as JSON to path, or stdout if path is '-'
+    """
+    if path == '-':
+      json.dump(self.to_dict(), sys.stdout, indent=2)
+      sys.stdout.write('\n')
+    else:
+      with open(path, 'w') as fh:
+        json.dump(self.to_dict(), fh, indent=2)
+
+  def print(self, fh=None, top=PROFILE_TOP):
+    """
+    Prints the top entries of each table to fh, stderr if None
+    """
+    p = lambda s: (fh or sys.stderr).write(s + '\n')
+    total = self.sim.cycles or 1
+    pct = lambda count: 100 * count / total
+
+    p('')
+    p('HOT SPOTS')
+    p('='*(6+12+7+12+12+32+6))
+    p(f'{"PC":>6s} {"COUNT":>12s} {"%":>7s} {"TAKEN":>12s} {"NOT TAKEN":>12s} {"BLOCK":32s} ASM')
+    for entry in self.pcs()[:top]:
+      taken = f'{entry["taken"]:12d} {entry["not_taken"]:12d}' if 'taken' in entry else ' '*25
+      p(f'{entry["pc"]:6d} {entry["count"]:12d} {pct(entry["count"]):7.2f} {taken} '
+        f'{entry["block"]:32.32s} {entry["asm"]}')
+
+    p('')
+    p(f'{"BLOCK":40s} {"CYCLES":>12s} {"%":>7s} {"INCLUSIVE":>12s} {"%":>7s} {"CALLS":>10s}')
+    for block in self.blocks()[:top]:
+      p(f'{block["name"]:40.40s} {block["cycles"]:12d} {pct(block["cycles"]):7.2f} '
+        f'{block["inclusive"]:12d} {pct(block["inclusive"]):7.2f} {block["calls"]:10d}')
+
+    kinds = self.operation_kinds()
+    if kinds:
+      p('')
+      p(f'{"VM OPERATION":40s} {"CYCLES":>12s} {"%":>7s} {"RUNS":>10s} {"PER RUN":>8s}')
+      for kind in kinds[:top]:
+        p(f'{kind["kind"]:40s} {kind["cycles"]:12d} {pct(kind["cycles"]):7.2f} '
+          f'{kind["runs"]:10d} {kind["cycles"] / (kind["runs"] or 1):8.1f}')
+
+      p('')
+      p(f'{"PC":>6s} {"VM OPERATION":40s} {"CYCLES":>12s} {"%":>7s} {"RUNS":>10s} BLOCK')
+      for operation in self.operations()[:top]:
+        p(f'{operation["pc"]:6d} {operation["operation"]:40.40s} {operation["cycles"]:12d} '
+          f'{pct(operation["cycles"]):7.2f} {operation["runs"]:10d} {operation["block"]}')
+
+    calls = self.call_graph()
+    if calls:
+      callers = {}
+      for call in calls:
+        callers.setdefault(call['callee'], []).append(call)
+
+      p('')
+      p('CALL GRAPH')
+      p('='*(40+12+7+10+3))
+      for block in self.blocks():
+        if block['name'] not in callers:
+          continue
+        p(f'{block["name"]:40.40s} {block["inclusive"]:12d} {pct(block["inclusive"]):7.2f} '
+          f'{block["calls"]:10d}')
+        for call in callers[block['name']]:
+          p(f'  <- {call["caller"]:36.36s} {"":12s} {"":7s} {call["calls"]:10d}')
+    p('')
+
+# bytes with the order of their bits reversed. The leftmost pixel of a screen word is its least
+# significant bit while image formats put the leftmost pixel in the most significant bit.
+_REVERSE_BITS = bytes(int(f'{byte:08b}'[::-1], 2) for byte in range(256))
+_REVERSE_INVERT_BITS = bytes(byte ^ 0xFF for byte in _REVERSE_BITS)
+
+def pack_screen(words, invert=False):
+  """
+  Returns the screen held in words, such as Simulator.screen, as rows of bytes with the leftmost
+  pixel in the most significant bit and 1 for black, or 0 for black if invert is True
+  """
+  if sys.byteorder == 'big' or not isinstance(words, (array, memoryview)):
+    words = array('H', words)
+    if sys.byteorder == 'big':
+      words.byteswap()
+  return bytes(words).translate(_REVERSE_INVERT_BITS if invert else _REVERSE_BITS)
+
+def screen_pixels(words):
+  """
+  Returns the screen held in words as a SCREEN_HEIGHT x SCREEN_WIDTH NumPy array of 0 and 1
+  """
+  if numpy is None:
+    raise ImportError('screen_pixels() needs numpy')
+  data = numpy.frombuffer(words, dtype=numpy.uint16).astype('<u2').view(numpy.uint8)
+  return numpy.unpackbits(data, bitorder='little').reshape(SCREEN_HEIGHT, SCREEN_WIDTH)
+
+def write_pbm(path, words):
+  with open(path, 'wb') as fh:
+    fh.write(b'P4\n%d %d\n' % (SCREEN_WIDTH, SCREEN_HEIGHT))
+    fh.write(pack_screen(words))
+
+def read_pbm(path):
+  """
+  Returns the pixels of a screen sized PBM, such as written by write_pbm(), packed as by
+  pack_screen()
+  """
+  with open(path, 'rb') as fh:
+    data = fh.read()
+
+  # P4, width, height and a single whitespace before the pixels, comments are not supported
+  magic, width, height, pixels = data.split(maxsplit=3)
+  if magic != b'P4' or (int(width), int(height)) != (SCREEN_WIDTH, SCREEN_HEIGHT):
+    raise ValueError(f'{path} is not a {SCREEN_WIDTH}x{SCREEN_HEIGHT} binary PBM')
+  return pixels[:SCREEN_ROW_BYTES * SCREEN_HEIGHT]
+
+def _png_chunk(kind, data):
+  return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def write_png(path, words):
+  # 1 bit greyscale, in which 0 is black, and each row starts with filter type 0
+  pixels = pack_screen(words, invert=True)
+  rows = b''.join(b'\0' + pixels[offset:offset + SCREEN_ROW_BYTES]
+                  for offset in range(0, len(pixels), SCREEN_ROW_BYTES))
+  with open(path, 'wb') as fh:
+    fh.write(b'\x89PNG\r\n\x1a\n')
+    fh.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', SCREEN_WIDTH, SCREEN_HEIGHT, 1, 0, 0, 0, 0)))
+    fh.write(_png_chunk(b'IDAT', zlib.compress(rows)))
+    fh.write(_png_chunk(b'IEND', b''))
+
+def write_screen(path, words):
+  """
+  Writes the screen held in words to path as PNG if it ends with .png, otherwise PBM
+  """
+  (write_png if path.lower().endswith('.png') else write_pbm)(path, words)
+
+def screen_diff(words, expected):
+  """
+  Returns the number of pixels which differ between the screen held in words and expected, packed
+  as by pack_screen() or read_pbm()
+  """
+  return (int.from_bytes(pack_screen(words), 'big') ^ int.from_bytes(expected, 'big')).bit_count()
+
+ENGINE_INTERPRET = 'interpret'
+ENGINE_BLOCKS = 'blocks'
+ENGINE_CHOICES = (ENGINE_INTERPRET, ENGINE_BLOCKS)
+ENGINES = {ENGINE_INTERPRET: Simulator, ENGINE_BLOCKS: BlockSimulator}
+
+def _parse_ram_spec(spec):
+  addr, value = spec.split('=')
+  return int(addr, 0), int(value, 0) & 0xFFFF
+
+def _parse_dump_spec(spec):
+  if ':' in spec:
+    addr, count = spec.split(':')
+    return int(addr, 0), int(count, 0)
+  return int(spec, 0), 1
+
+@click.command()
+@click.argument('program', type=click.Path(dir_okay=False, exists=True))
+@click.option('-n', '--max-cycles', type=int,
+              help='Maximum number of instructions executed, unlimited if not given')
+@click.option('--hack', 'original_hack', is_flag=True,
+              help='If given the program runs on the original HACK CPU which has no W register')
+@click.option('--ram', 'ram_specs', multiple=True,
+              help='Use format AAA=VVV to set RAM[AAA] = VVV before running')
+@click.option('--dump', 'dump_specs', multiple=True,
+              help='Use format AAA or AAA:N to print N words of RAM from AAA after running')
+@click.option('-O', '--optimise', type=click.Choice(OPT_CHOICES), multiple=True,
+              help='Optimisations used when the program is .asm, see assembler.py')
+@click.option('-e', '--engine', type=click.Choice(ENGINE_CHOICES), default=ENGINE_BLOCKS,
+              help='"blocks" (default) compiles each basic block into a Python function, '
+                   '"interpret" decodes each instruction once and interprets it')
+@click.option('--screen', 'screen_path', type=click.Path(dir_okay=False),
+              help='Write the screen after running to this .png or .pbm file')
+@click.option('--frames', 'frames_pattern',
+              help='Write the screen every --frame-cycles cycles to files named by this pattern '
+                   'with a %d for the frame number, e.g. frame%05d.png')
+@click.option('--frame-cycles', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Number of cycles between frames written with --frames')
+@click.option('--pc-profile', 'print_pc_profile', is_flag=True,
+              help='If given the program is interpreted counting the executions of each '
+                   'instruction, and the hot spots, cycles per block and VM operation and the '
+                   'call graph are printed to stderr. .hack programs need to be assembled with -A '
+                   'to be attributed to their source')
+@click.option('--pc-profile-json', type=click.Path(dir_okay=False, allow_dash=True),
+              help='If given the execution profile is written as JSON to this file, - for stdout')
+@click.option('-m', '--source-map', 'source_map_path', type=click.Path(dir_okay=False, exists=True),
+              help='Source map used to attribute the profile instead of annotations: for a .hack '
+                   'program the map written by assembler.py -m, for a .asm program the map '
+                   'written by vm2asm.py -m')
+def main(program, max_cycles, original_hack, ram_specs, dump_specs, optimise, engine, screen_path,
+         frames_pattern, frame_cycles, print_pc_profile, pc_profile_json, source_map_path):
+  """
+  Runs a .hack program, or a .asm program after assembling it
+  """
+  profile = print_pc_profile or pc_profile_json is not None
+  source_map = SourceMap.read(source_map_path) if source_map_path is not None else None
+  if program.endswith('.asm'):
+    annotate = profile and source_map is None
+    assembler = Assembler(input_asm=program, optimise=optimise, annotate=annotate,
+                          input_source_map=source_map).assemble()
+    codes = assembler.machine_code
+    if annotate:
+      annotations = parse_annotations(assembler.hack_output)
+    else:
+      source_map = assembler.source_map
+  else:
+    codes = read_hack(program)
+    if profile and source_map is None:
+      with open(program) as fh:
+        annotations = parse_annotations(fh)
+
+  if profile:
+    if source_map is not None:
+      attribution = attribute_source_map(source_map, len(codes))
+    else:
+      attribution = attribute_annotations(annotations)
+    sim = ProfilingSimulator(codes, hackx=not original_hack,
+                             blocks=[block for _, block, _ in attribution])
+  else:
+    sim = ENGINES[engine](codes, hackx=not original_hack)
+  for spec in ram_specs:
+    addr, value = _parse_ram_spec(spec)
+    sim.ram[addr] = value
+
+  start = time.perf_counter()
+  if frames_pattern:
+    frame = 0
+    while not sim.halted and (max_cycles is None or sim.cycles < max_cycles):
+      cycles = frame_cycles if max_cycles is None else min(frame_cycles, max_cycles - sim.cycles)
+      sim.run(cycles)
+      write_screen(frames_pattern % frame, sim.screen)
+      frame += 1
+  else:
+    sim.run(max_cycles)
+  elapsed = time.perf_counter() - start
+
+  p = lambda s: sys.stderr.write(s + '\n')
+  state = 'halted' if sim.halted else 'stopped'
+  p(f'{state} at PC={sim.pc} after {sim.cycles} cycles in {elapsed:.3f}s '
+    f'({sim.cycles / elapsed / 1e6 if elapsed else 0:.2f} MIPS)')
+  p(f'A={sim.a} D={sim.d} W={sim.w}')
+
+  for spec in dump_specs:
+    addr, count = _parse_dump_spec(spec)
+    for offset in range(count):
+      value = sim.ram[addr + offset]
+      signed = value - 0x10000 if value & 0x8000 else value
+      print(f'RAM[{addr + offset}] = {signed}')
+
+  if screen_path:
+    write_screen(screen_path, sim.screen)
+
+  if print_pc_profile:
+    Profile(sim, attribution).print()
+
+  if pc_profile_json is not None:
+    Profile(sim, attribution).write_json(pc_profile_json)
+
+if __name__ == '__main__':
+  main()
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def _simulate(src, max_cycles=100000, **options):
+  sim = Simulator(Assembler(**options).assemble(src).machine_code)
+  sim.run(max_cycles)
+  return sim
+
+def test_alu_functions():
+  import random
+  rng = random.Random(0)
+  for c1_c6, func in ALU_FUNCTIONS.items():
+    for _ in range(100):
+      x, y = rng.randrange(0x10000), rng.randrange(0x10000)
+      assert func(x, y) == alu(c1_c6, x, y)
+
+def test_decode():
+  from assembler import C_Instruction
+  func, y, write_a, write_d, write_m, write_w, jump = decode(C_Instruction('AM=M+1;JGT').encode())
+  assert (y, write_a, write_d, write_m, write_w) == (Y_M, True, False, True, False)
+  assert func(0, 41) == 42
+  assert jump == (False, True, False)
+
+  func, y, _, _, _, write_w, jump = decode(C_Instruction('W=W-1').encode())
+  assert (y, write_w, jump) == (Y_W, True, None)
+  assert func(0, 0) == 0xFFFF
+
+  # on the original HACK the W bits are ignored
+  _, y, _, _, _, write_w, _ = decode(C_Instruction('W=W-1').encode(), hackx=False)
+  assert (y, write_w) == (Y_A, False)
+
+  assert decode(1234) == 1234
+
+def test_mult():
+  from assembler import HAZARD_CHOICES
+  with open('../projects/04/Mult.asm') as fh:
+    src = fh.read()
+
+  for hazard_model in HAZARD_CHOICES:
+    for optimise in (None, 'all'):
+      sim = Simulator(Assembler(hazard_model=hazard_model, optimise=optimise).assemble(
+          '@7\nD=A\n@R0\nM=D\n@6\nD=A\n@R1\nM=D\n' + src).machine_code)
+      sim.run(10000)
+      assert sim.halted
+      assert sim.ram[2] == 42
+
+def test_stack_test():
+  from vm2asm import VM2ASM
+  from assembler import HAZARD_CHOICES
+  with open('tests/StackTest.vm') as fh:
+    asm = VM2ASM(no_init=True).translate(fh.read()).dumps()
+
+  # the optimised program must leave RAM exactly as the unoptimised one does
+  for hazard_model in HAZARD_CHOICES:
+    rams = []
+    for optimise in (None, 'all'):
+      sim = Simulator(Assembler(hazard_model=hazard_model, optimise=optimise,
+                                opt_fixpoint=True).assemble(asm).machine_code)
+      sim.run(10000)
+      assert sim.halted
+      rams.append(list(sim.ram))
+    assert rams[0] == rams[1]
+
+def test_w_register():
+  sim = _simulate('''
+    @10
+    W=A
+  (LOOP)
+    @R0
+    M=M+1
+    W=W-1
+    @LOOP
+    W;JGT
+  (END)
+    @END
+    0;JMP
+  ''')
+  assert sim.halted
+  assert sim.ram[0] == 10
+  assert sim.w == 0
+
+def test_jump_uses_old_a():
+  # the jump goes to where A pointed before the instruction, even though it also writes A
+  sim = _simulate('''
+    @4
+    A=0;JMP
+    @R0
+    M=1
+  (END)
+    @END
+    0;JMP
+    ''', hazard_model='ideal')
+  assert sim.halted
+  assert sim.ram[0] == 0
+  assert sim.a == 4
+
+def test_run_limit():
+  sim = _simulate('(LOOP)\n@R0\nM=M+1\n@LOOP\n0;JMP', max_cycles=0)
+  assert sim.run(400) == 400
+  assert not sim.halted
+  assert sim.cycles == 400
+
+def test_halt():
+  # a jump on a constant computation that is always taken halts like 0;JMP, as goto does in
+  # vm2asm.py, but not if it also writes somewhere
+  for cls in ENGINES.values():
+    for end, halts in (('0;JMP', True), ('0;JEQ', True), ('-1;JLT', True),
+                       ('M=M+1;JMP', False)):
+      codes = Assembler().assemble(f'(END)\n@END\n{end}').machine_code
+      sim = cls(codes)
+      sim.run(100)
+      assert sim.halted == halts
+
+def test_block_engine():
+  import random
+  with open('../projects/04/Mult.asm') as fh:
+    mult = '@7\nD=A\n@R0\nM=D\n@6\nD=A\n@R1\nM=D\n' + fh.read()
+  # fills RAM[100..199] with a countdown, forever
+  fill = '''
+  (FILL)
+    @100
+    D=A
+    @R0
+    M=D
+  (NEXT)
+    @R0
+    D=M
+    @200
+    D=D-A
+    @FILL
+    D;JGE
+    @R0
+    AM=M+1
+    M=-D
+    @NEXT
+    0;JMP
+  '''
+
+  # stopping after any number of cycles leaves the same state as the interpreter
+  rng = random.Random(0)
+  for src in (mult, fill):
+    codes = Assembler(optimise='all').assemble(src).machine_code
+    interpreter, blocks = Simulator(codes), BlockSimulator(codes)
+    for _ in range(50):
+      max_cycles = rng.randrange(2000)
+      assert interpreter.run(max_cycles) == blocks.run(max_cycles)
+      for attr in ('pc', 'a', 'd', 'w', 'cycles', 'halted', 'ram'):
+        assert getattr(interpreter, attr) == getattr(blocks, attr)
+
+  sim = BlockSimulator(Assembler().assemble(mult).machine_code)
+  sim.run()
+  assert sim.halted
+  assert sim.ram[2] == 42
+
+  # the loop reads A, which is only the address of LOOP from the second pass on when the run
+  # is resumed just before it
+  codes = Assembler().assemble('@3\nD=A\n(LOOP)\nD=D+A\n@R0\nM=M+1\n@LOOP\n0;JMP').machine_code
+  interpreter, blocks = Simulator(codes), BlockSimulator(codes)
+  for sim in (interpreter, blocks):
+    sim.run(2)
+    sim.run(2000)
+  assert (blocks.pc, blocks.d, blocks.ram[0]) == (interpreter.pc, interpreter.d, interpreter.ram[0])
+
+def test_block_loop():
+  sim = BlockSimulator(Assembler().assemble('(LOOP)\n@R0\nM=M+1\n@LOOP\n0;JMP').machine_code)
+  source, _ = sim.block_source(0)
+  assert 'while True' in source
+  assert sim.run(1000) == 1000
+
+  interpreter = Simulator(sim.codes)
+  interpreter.run(1000)
+  assert (sim.pc, sim.ram[0]) == (interpreter.pc, interpreter.ram[0])
+
+def test_read_hack():
+  import os
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'prog.hack')
+    assembler = Assembler(input_asm='../projects/04/Mult.asm', output_hack=path, annotate=True,
+                          pretty_print=True)
+    assembler.assemble().write_output()
+    assert read_hack(path) == assembler.machine_code
+
+def test_ram_views():
+  sim = Simulator([])
+  sim.ram[SCREEN_ADDRESS + 1] = 0x8001
+  assert sim.screen[1] == 0x8001
+  assert len(sim.screen) == KBD_ADDRESS - SCREEN_ADDRESS
+
+  # views write through to RAM
+  sim.kbd[0] = ord('K')
+  assert sim.ram[KBD_ADDRESS] == ord('K')
+
+  sim.ram[100:103] = array('H', [1, 2, 3])
+  assert sim.ram_mismatches(100, [1, 2, 3]) == []
+  assert sim.ram_mismatches(99, [0, 1, 5, 3, 7]) == [101, 103]
+
+  if numpy is not None:
+    ram = sim.ram_array()
+    ram[200] = 42
+    assert sim.ram[200] == 42
+    pixels = screen_pixels(sim.screen)
+    assert pixels.shape == (SCREEN_HEIGHT, SCREEN_WIDTH)
+    assert list(pixels[0, 16:32].nonzero()[0]) == [0, 15]
+
+def test_screen_images():
+  import os
+  import tempfile
+  sim = Simulator([])
+
+  # the leftmost pixel of a word is its least significant bit
+  sim.ram[SCREEN_ADDRESS] = 0b11
+  sim.ram[KBD_ADDRESS - 1] = 0x8000
+  pixels = pack_screen(sim.screen)
+  assert len(pixels) == SCREEN_ROW_BYTES * SCREEN_HEIGHT
+  assert pixels[:2] == bytes([0b11000000, 0])
+  assert pixels[-1] == 1
+  assert pack_screen(list(sim.screen)) == pixels
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    pbm = os.path.join(tmpdir, 'screen.pbm')
+    write_screen(pbm, sim.screen)
+    assert read_pbm(pbm) == pixels
+    assert screen_diff(sim.screen, read_pbm(pbm)) == 0
+    sim.ram[SCREEN_ADDRESS + 100] = 0b101
+    assert screen_diff(sim.screen, read_pbm(pbm)) == 2
+
+    png = os.path.join(tmpdir, 'screen.png')
+    write_screen(png, sim.screen)
+    with open(png, 'rb') as fh:
+      data = fh.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height, depth = struct.unpack('>IIB', data[16:25])
+    assert (width, height, depth) == (SCREEN_WIDTH, SCREEN_HEIGHT, 1)
+
+    # single IDAT chunk follows IHDR, rows start with a filter byte and black is 0
+    length = struct.unpack('>I', data[33:37])[0]
+    rows = zlib.decompress(data[41:41 + length])
+    assert len(rows) == (1 + SCREEN_ROW_BYTES) * SCREEN_HEIGHT
+    assert rows[:3] == bytes([0, 0b00111111, 0xFF])
+
+def test_pc_profile():
+  src = '''
+    @256
+    D=A
+    @SP
+    M=D
+    // PUSH constant 3
+    @3
+    D=A
+    @R5
+    M=D
+    // CALL func_COUNT 0
+    $call func_COUNT
+    // CALL func_COUNT 0
+    $call func_COUNT
+  (END)
+    @END
+    0;JMP
+
+  (func_COUNT)
+    // LABEL LOOP
+  (LOOP)
+    @R6
+    M=M+1
+    @R5
+    MD=M-1
+    @LOOP
+    D;JGT
+    // RETURN
+    $return
+  '''
+  for optimise in (None, 'all'):
+    assembler = Assembler(annotate=True, optimise=optimise).assemble(src)
+    annotations = parse_annotations(assembler.hack_output)
+    assert len(annotations) == len(assembler.machine_code)
+
+    attribution = attribute_annotations(annotations)
+    sim = ProfilingSimulator(assembler.machine_code, blocks=[block for _, block, _ in attribution])
+    sim.run(10000)
+    assert sim.halted
+    assert sim.ram[6] == 4
+
+    profile = Profile(sim, attribution)
+    blocks = {block['name']: block for block in profile.blocks()}
+    assert blocks['func_COUNT']['calls'] == 2
+    assert blocks['func_COUNT']['inclusive'] == blocks['func_COUNT']['cycles']
+    assert blocks[SIZE_REPORT_TOP_LEVEL]['inclusive'] == sim.cycles
+    assert sum(block['cycles'] for block in profile.blocks()) == sim.cycles
+    assert profile.call_graph() == [dict(caller=SIZE_REPORT_TOP_LEVEL, callee='func_COUNT', calls=2)]
+
+    # the loop runs 3 times on the first call and once on the second
+    loop = [entry for entry in profile.pcs() if entry['asm'] == 'D;JGT'][0]
+    assert (loop['count'], loop['taken'], loop['not_taken']) == (4, 2, 2)
+
+    kinds = {kind['kind']: kind for kind in profile.operation_kinds()}
+    assert kinds['CALL']['runs'] == 2
+    assert kinds['RETURN']['runs'] == 2
+    assert kinds['PUSH']['runs'] == 1
+    # the code of LABEL is the loop body, which begins at the label
+    assert kinds['LABEL']['runs'] == 4
+
+def test_source_map_profile():
+  from vm2asm import VM2ASM
+  src = '''
+    function Sys.init 0
+    push constant 3
+    call Main.double 1
+    call Main.double 1
+    pop static 0
+    label END
+    goto END
+
+    function Main.double 0
+    push argument 0
+    push argument 0
+    add
+    return
+  '''
+  # as vm2asm.py does, the init code is translated on its own
+  vm_map = SourceMap()
+  translator = VM2ASM(compat=True).translate('call Sys.init 0')
+  translator.record_source_map(vm_map, 1)
+  asm = translator.dumps() + '\n'
+  translator = VM2ASM(compat=True, no_init=True).translate(src)
+  translator.record_source_map(vm_map, asm.count('\n') + 1)
+  asm += translator.dumps()
+
+  assembler = Assembler(input_source_map=vm_map).assemble(asm)
+  attribution = attribute_source_map(assembler.source_map, len(assembler.machine_code))
+  sim = ProfilingSimulator(assembler.machine_code, blocks=[block for _, block, _ in attribution])
+  sim.run(10000)
+  assert sim.halted
+  assert sim.ram[16] == 12
+
+  profile = Profile(sim, attribution)
+  blocks = {block['name']: block for block in profile.blocks()}
+  assert blocks['Main.double']['calls'] == 2
+  assert blocks['Sys.init']['calls'] == 1
+  assert sum(block['cycles'] for block in profile.blocks()) == sim.cycles
+
+  kinds = {kind['kind']: kind for kind in profile.operation_kinds()}
+  assert kinds['CALL']['runs'] == 3
+  assert kinds['ADD']['runs'] == 2
+  assert all(entry['asm'].startswith('<in memory>:') for entry in profile.pcs())
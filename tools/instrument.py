@@ -0,0 +1,203 @@
+"""
+Instrumentation shared by the assembler and the VM translator: timers for each phase of the work,
+counters and a hook to run under cProfile. Stats can be written as JSON so runs of the toolchain
+can be compared to spot performance regressions.
+"""
+
+import sys
+import json
+import time
+import cProfile
+import pstats
+from collections import Counter
+from contextlib import contextmanager
+
+# number of functions printed when profiling to stderr
+PROFILE_TOP_FUNCTIONS = 30
+
+class Stats:
+  """
+  Records the time spent in named phases and named counters. Phases can be nested and each
+  timer only holds the time spent in its phase, not in phases nested in it, so the timers add
+  up to the total time measured.
+
+  A disabled Stats records no time so code can be instrumented unconditionally. Counters are
+  always recorded as they are cheap, but counts which need extra work to find should only be
+  made when enabled is True.
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+
+    # maps phase names, in the order first entered, to seconds
+    self.timers = {}
+    self.counters = Counter()
+
+    # [name, start, time spent in nested phases] of each phase entered and not yet left
+    self._stack = []
+
+  def _enter(self, name):
+    self.timers.setdefault(name, 0.0)
+    self._stack.append([name, time.perf_counter(), 0.0])
+
+  def _leave(self):
+    name, start, nested = self._stack.pop()
+    elapsed = time.perf_counter() - start
+    self.timers[name] += elapsed - nested
+    if self._stack:
+      self._stack[-1][2] += elapsed
+
+  @contextmanager
+  def phase(self, name):
+    """
+    Context manager which times the code it wraps as phase name
+    """
+    if not self.enabled:
+      yield
+      return
+
+    self._enter(name)
+    try:
+      yield
+    finally:
+      self._leave()
+
+  def timed_iter(self, name, iterable, counter=None):
+    """
+    Returns iterable, timing the production of each item as phase name. This times lazy
+    generators separately from the code consuming them. If counter is given it is incremented
+    for each item.
+    """
+    if not self.enabled:
+      return iterable
+    return self._timed_iter(name, iterable, counter)
+
+  def _timed_iter(self, name, iterable, counter):
+    it = iter(iterable)
+    while True:
+      self._enter(name)
+      try:
+        item = next(it)
+      except StopIteration:
+        return
+      finally:
+        self._leave()
+
+      if counter is not None:
+        self.counters[counter] += 1
+      yield item
+
+  def count(self, name, n=1):
+    self.counters[name] += n
+
+  @property
+  def total_time(self):
+    return sum(self.timers.values())
+
+  def to_dict(self):
+    return dict(timers=dict(self.timers),
+                total_time=self.total_time,
+                counters=dict(self.counters))
+
+  def write_json(self, path):
+    """
+    Writes the stats as JSON to path, or stdout if path is '-'
+    """
+    if path == '-':
+      json.dump(self.to_dict(), sys.stdout, indent=2)
+      sys.stdout.write('\n')
+    else:
+      with open(path, 'w') as fh:
+        json.dump(self.to_dict(), fh, indent=2)
+
+  def print(self, fh=None):
+    """
+    Prints the timers and counters in a table to fh, stderr if None
+    """
+    fh = fh or sys.stderr
+    fh.write('\nPHASE STATS\n')
+    fh.write('='*(32+12+8+2) + '\n')
+    fh.write(f'{"PHASE":32s} {"TIME (ms)":>12s} {"%":>8s}\n')
+    total = self.total_time or 1.0
+    for name, elapsed in self.timers.items():
+      fh.write(f'{name:32s} {elapsed*1000:12.3f} {100*elapsed/total:8.1f}\n')
+    fh.write(f'{"TOTAL":32s} {self.total_time*1000:12.3f}\n')
+
+    if self.counters:
+      fh.write('\n')
+      fh.write(f'{"COUNTER":32s} {"VALUE":>12s}\n')
+      for name, value in sorted(self.counters.items()):
+        fh.write(f'{name:32s} {value:12d}\n')
+    fh.write('\n')
+
+@contextmanager
+def profiled(path=None):
+  """
+  Context manager which runs the code it wraps under cProfile. The profile is written to path for
+  use with pstats or snakeviz, or if path is '-' the functions taking the most time are printed
+  to stderr. Does nothing if path is None.
+  """
+  if path is None:
+    yield
+    return
+
+  profile = cProfile.Profile()
+  profile.enable()
+  try:
+    yield
+  finally:
+    profile.disable()
+    if path == '-':
+      stats = pstats.Stats(profile, stream=sys.stderr)
+      stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+    else:
+      profile.dump_stats(path)
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def test_phases():
+  stats = Stats()
+  with stats.phase('outer'):
+    with stats.phase('inner'):
+      time.sleep(0.01)
+
+  # time in a nested phase is not counted in the outer one
+  assert list(stats.timers) == ['outer', 'inner']
+  assert stats.timers['inner'] >= 0.01
+  assert stats.timers['outer'] < stats.timers['inner']
+
+def test_timed_iter():
+  stats = Stats()
+
+  def slow():
+    for idx in range(3):
+      time.sleep(0.005)
+      yield idx
+
+  with stats.phase('consume'):
+    assert list(stats.timed_iter('produce', slow(), counter='items')) == [0, 1, 2]
+
+  assert stats.timers['produce'] >= 0.015
+  assert stats.counters['items'] == 3
+
+def test_disabled():
+  stats = Stats(enabled=False)
+  items = [1, 2]
+  assert stats.timed_iter('produce', items) is items
+  with stats.phase('phase'):
+    pass
+  stats.count('things', 2)
+
+  assert stats.timers == {}
+  assert stats.to_dict()['counters'] == {'things': 2}
+
+def test_profiled():
+  import os
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'out.prof')
+    with profiled(path):
+      sum(range(1000))
+    assert pstats.Stats(path).total_calls > 0
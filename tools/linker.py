@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+"""
+Links relocatable object modules written by `assembler.py --object` into a single program.
+
+Modules are laid out one after the other in the order given, so the first module is where the
+program starts. Assembly files can be given instead of objects, in which case they are assembled
+first, in parallel.
+"""
+
+import os
+import sys
+import click
+from concurrent.futures import ProcessPoolExecutor
+
+from assembler import (Assembler, ObjectModule, A_Instruction, C_Instruction, OPT_CHOICES,
+                       HAZARD_CHOICES, HAZARD_IDEAL, HAZARD_MODELS, C_ENCODING_TABLE, NO_JUMP,
+                       format_machine_code, is_unconditional_jump)
+from firmware import FORMAT_HACK, FORMAT_CHOICES, write_firmware_file
+
+# inputs with these extensions are assembled before linking, everything else is read as an object
+ASM_EXTENSIONS = ('.asm', '.s')
+
+def assemble_module(path, options):
+  """
+  Assembles the file at path into an ObjectModule. options are passed on to Assembler. Returns
+  the module as a dict so it can be sent back from another process cheaply.
+  """
+  assembler = Assembler(input_asm=path, **options)
+  return assembler.assemble_object().to_dict()
+
+def load_modules(paths, options, jobs=None):
+  """
+  Returns an ObjectModule for each path, in the same order. Assembly files are assembled using
+  up to jobs processes, or os.cpu_count() if jobs is None.
+  """
+  asm_paths = [path for path in paths if path.endswith(ASM_EXTENSIONS)]
+
+  assembled = {}
+  if len(asm_paths) > 1 and jobs != 1:
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+      results = pool.map(assemble_module, asm_paths, [options] * len(asm_paths))
+      assembled = dict(zip(asm_paths, results))
+  else:
+    for path in asm_paths:
+      assembled[path] = assemble_module(path, options)
+
+  modules = []
+  for path in paths:
+    if path in assembled:
+      modules.append(ObjectModule.from_dict(assembled[path]))
+    else:
+      modules.append(ObjectModule.read(path))
+  return modules
+
+# an expression assembling to each C-instruction, so the linker can tell what the machine code of
+# a module does
+C_EXPRESSIONS = {}
+for (dest, comp, jump), code in C_ENCODING_TABLE.items():
+  C_EXPRESSIONS.setdefault(code, (f'{dest}=' if dest else '') + comp +
+                                 (f';{jump}' if jump != NO_JUMP else ''))
+
+NOP_CODE = C_ENCODING_TABLE[('', '0', NO_JUMP)]
+
+def decode_instruction(code):
+  """
+  Returns the A_Instruction or C_Instruction of the machine code code, or None if it is not valid
+  """
+  if not code & 0x8000:
+    return A_Instruction(f'@{code}')
+  expression = C_EXPRESSIONS.get(code)
+  return C_Instruction(expression) if expression is not None else None
+
+# orders in which the linker can lay out sections
+ORDER_INPUT = 'input'
+ORDER_CALLS = 'calls'
+ORDER_CHOICES = (ORDER_INPUT, ORDER_CALLS)
+
+class Section:
+  """
+  Instructions module.code[start:end] which are laid out together. labels maps the labels
+  defined in the section to their offset in the module.
+  """
+  __slots__ = ('module', 'start', 'end', 'labels', 'base')
+
+  def __init__(self, module, start, end):
+    self.module = module
+    self.start = start
+    self.end = end
+    self.labels = {}
+
+    # address of the first instruction once laid out
+    self.base = None
+
+  @property
+  def size(self):
+    return self.end - self.start
+
+  @property
+  def relocations(self):
+    return [(idx, symbol) for idx, symbol in self.module.relocations
+            if self.start <= idx < self.end]
+
+class Linker:
+  """
+  Lays out the sections of modules and patches their relocations. Every label is global, so a
+  label defined by more than one module is an error. A symbol which is neither a label nor a
+  constant of any module becomes a variable, allocated in the order symbols are first used just
+  as the assembler does for a single file.
+
+  Sections which fall through into the next one are kept together as a unit. If strip is True
+  units which cannot be reached from the first unit, or from a unit defining one of entries, by
+  following the labels they load are left out. order decides how units are laid out: ORDER_INPUT
+  keeps the order of the modules and ORDER_CALLS puts units after the first unit which uses them,
+  a unit which ends by jumping to another straight before it. The load and jump are then dropped
+  so the first unit falls through into the second.
+  """
+
+  def __init__(self, modules, strip=False, order=ORDER_INPUT, entries=()):
+    self.modules = list(modules)
+    self._strip = strip
+    self._order = order
+    self._entries = list(entries)
+
+    # absolute value of every symbol used by the linked program
+    self.symbols = {}
+
+    # list of (module name, first label of the section, address, number of instructions)
+    self.layout = []
+
+    # list of (module name, labels, number of instructions) for each section left out
+    self.stripped = []
+
+    # list of (module name, label jumped to, number of instructions) for each jump dropped b/c
+    # its target was laid out straight after it
+    self.dropped_jumps = []
+
+    self._next_variable_address = Assembler.VARIABLES_START_ADDRESS
+
+  def link(self):
+    """
+    Returns the machine code of the linked program as a list of integers
+    """
+    self._check_compatible()
+
+    units = self._units()
+    label_units = self._label_units(units)
+
+    if self._strip:
+      live = self._reachable_units(units, label_units)
+      for unit in units:
+        if unit not in live:
+          for section in unit:
+            self.stripped.append((section.module.name, list(section.labels), section.size))
+      units = [unit for unit in units if unit in live]
+
+    if self._order == ORDER_CALLS:
+      units = self._call_order(units, label_units)
+      self._drop_jumps_to_next(units)
+
+    sections = [section for unit in units for section in unit]
+
+    base = 0
+    for section in sections:
+      section.base = base
+      base += section.size
+      first_label = next(iter(section.labels), '')
+      self.layout.append((section.module.name, first_label, section.base, section.size))
+
+    for section in sections:
+      for label, offset in section.labels.items():
+        # labels of a dropped jump now refer to where it jumped to, the start of the next section
+        self.symbols[label] = section.base + min(offset, section.end) - section.start
+
+    for module in self.modules:
+      for name, value in module.constants.items():
+        self.symbols.setdefault(name, value)
+
+    codes = []
+    for section in sections:
+      section_code = section.module.code[section.start:section.end]
+      for idx, symbol in section.relocations:
+        section_code[idx - section.start] = self._resolve(symbol) & 0x7FFF
+      codes += section_code
+
+    return codes
+
+  def _check_compatible(self):
+    # NOPs are inserted when assembling so every module must agree on what the hardware needs
+    targets = {(module.hazard_model, module.compat) for module in self.modules}
+    if len(targets) > 1:
+      names = ', '.join(f'{module.name} ({module.hazard_model}'
+                        f'{", compat" if module.compat else ""})' for module in self.modules)
+      raise ValueError(f'Modules were assembled for different targets: {names}')
+
+  def _units(self):
+    """
+    Splits the modules into sections and returns them as a list of units, each a list of
+    sections which must be laid out one after the other
+    """
+    units = []
+    falls_through = False
+    defined_by = {}
+    for module in self.modules:
+      bounds = list(module.sections) + [len(module.code)]
+      sections = [Section(module, start, end) for start, end in zip(bounds, bounds[1:])]
+
+      for label, offset in module.labels.items():
+        if label in defined_by:
+          raise NameError(f'Redefinition of label {label} in {module.name}, already defined in '
+                          f'{defined_by[label]}')
+        defined_by[label] = module.name
+
+        # a label at the very end of the module belongs to the last section
+        section = next(section for section in reversed(sections) if section.start <= offset)
+        section.labels[label] = offset
+
+      for idx, section in enumerate(sections):
+        if idx == 0 and falls_through and units:
+          units[-1].append(section)
+        else:
+          units.append([section])
+
+      # an empty module passes on whether the module before it falls through
+      if module.code:
+        falls_through = module.falls_through
+
+    return units
+
+  @staticmethod
+  def _label_units(units):
+    return {label: unit for unit in units for section in unit for label in section.labels}
+
+  def _references(self, unit, label_units):
+    """
+    Returns the units whose labels unit loads, in the order they are first loaded except that
+    the unit unit ends by jumping to comes first
+    """
+    references = []
+    tail = self._tail_jump(unit)
+    if tail is not None:
+      target = label_units.get(tail[1])
+      if target is not None and target is not unit:
+        references.append(target)
+
+    for section in unit:
+      for _, symbol in section.relocations:
+        target = label_units.get(symbol)
+        if target is not None and target is not unit and target not in references:
+          references.append(target)
+    return references
+
+  @staticmethod
+  def _tail_jump(unit):
+    """
+    Returns (index in its module, label) of the load of the label the last section of unit ends
+    by jumping to unconditionally, with only NOPs in between, or None if it does not
+    """
+    section = unit[-1]
+    code = section.module.code
+    if section.size < 2:
+      return None
+
+    jump = decode_instruction(code[section.end - 1])
+    if type(jump) != C_Instruction or jump.dest or not is_unconditional_jump(jump):
+      return None
+
+    idx = section.end - 2
+    while idx > section.start and code[idx] == NOP_CODE:
+      idx -= 1
+
+    # a label between the load and the jump would be entered with something else in A
+    if any(idx < offset < section.end for offset in section.labels.values()):
+      return None
+
+    relocations = dict(section.relocations)
+    if idx not in relocations:
+      return None
+    return idx, relocations[idx]
+
+  @staticmethod
+  def _uses_a_on_entry(section):
+    """
+    Returns True if the code at the start of section may rely on A holding its address, as it
+    does when jumped to, by using A, M or jumping before A is loaded
+    """
+    for code in section.module.code[section.start:section.end]:
+      inst = decode_instruction(code)
+      if type(inst) == A_Instruction:
+        return False
+      if inst is None or 'A' in inst.comp or 'M' in inst.comp or 'M' in inst.dest or (
+          inst.jump != NO_JUMP):
+        return True
+      if 'A' in inst.dest:
+        return False
+    return True
+
+  def _drop_jumps_to_next(self, units):
+    """
+    Drops the load and jump ending each unit which jumps to the start of the unit laid out after
+    it, unless that unit relies on what the jump leaves in A or the instructions then running
+    back to back are a hazard
+    """
+    for unit, next_unit in zip(units, units[1:]):
+      tail = self._tail_jump(unit)
+      first = next_unit[0]
+      if (tail is None or first.labels.get(tail[1]) != first.start
+          or self._uses_a_on_entry(first)):
+        continue
+
+      idx, label = tail
+      section = unit[-1]
+      prev = None
+      if idx > section.start:
+        prev = section.module.code[idx - 1]
+      elif len(unit) > 1 and unit[-2].size:
+        prev = unit[-2].module.code[unit[-2].end - 1]
+
+      # when the unit is only the jump it is entered by jumping, as the next unit was before
+      if prev is not None:
+        prev, inst = decode_instruction(prev), decode_instruction(first.module.code[first.start])
+        hazard_model = HAZARD_MODELS[section.module.hazard_model]
+        if prev is None or inst is None or hazard_model.hazard(prev, inst):
+          continue
+
+      self.dropped_jumps.append((section.module.name, label, section.end - idx))
+      section.end = idx
+
+  def _roots(self, units, label_units):
+    roots = [units[0]] if units else []
+    for entry in self._entries:
+      if entry not in label_units:
+        raise NameError(f'Unknown entry point {entry}')
+      roots.append(label_units[entry])
+    return roots
+
+  def _reachable_units(self, units, label_units):
+    reachable = []
+    pending = list(reversed(self._roots(units, label_units)))
+    while pending:
+      unit = pending.pop()
+      if any(unit is seen for seen in reachable):
+        continue
+      reachable.append(unit)
+      pending.extend(reversed(self._references(unit, label_units)))
+    return reachable
+
+  def _call_order(self, units, label_units):
+    """
+    Orders units depth first from the roots, so code follows the code which first uses it. Units
+    which are not reachable keep their order at the end.
+    """
+    ordered = self._reachable_units(units, label_units)
+    ordered += [unit for unit in units if not any(unit is seen for seen in ordered)]
+    return ordered
+
+  def _resolve(self, symbol):
+    try:
+      return self.symbols[symbol]
+    except KeyError:
+      pass
+
+    self.symbols[symbol] = self._next_variable_address
+    self._next_variable_address += 1
+    return self.symbols[symbol]
+
+@click.command()
+@click.argument('inputs', nargs=-1, required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('-o', '--output-hack', type=click.Path(dir_okay=False),
+              help='Output file, stdout if not given')
+@click.option('-f', '--output-format', type=click.Choice(FORMAT_CHOICES), default=FORMAT_HACK,
+              help='Format of the output, see assembler.py')
+@click.option('-P', '--pretty-print', is_flag=True,
+              help='If given hack output will have _ inserted to make instructions easier to read')
+@click.option('-j', '--jobs', type=int,
+              help='Number of processes used to assemble .asm inputs. Defaults to the number of '
+                   'CPUs')
+@click.option('-C', '--compat', is_flag=True,
+              help='Assemble .asm inputs in compatibility mode, see assembler.py')
+@click.option('-H', '--hazard-model', type=click.Choice(HAZARD_CHOICES),
+              help='Hazard model used to assemble .asm inputs, see assembler.py')
+@click.option('-O', '--optimise', type=click.Choice(OPT_CHOICES), multiple=True,
+              help='Optimisations used to assemble .asm inputs, see assembler.py')
+@click.option('--strip', is_flag=True,
+              help='If given code which cannot be reached from the first module or an --entry is '
+                   'left out')
+@click.option('--order', type=click.Choice(ORDER_CHOICES), default=ORDER_INPUT,
+              help='Order of the code in the output. input keeps the order of the modules, calls '
+                   'puts functions after the code which first uses them and code after jumps to '
+                   'it, dropping the jumps')
+@click.option('--entry', 'entries', multiple=True,
+              help='Label which is kept by --strip even if nothing uses it, e.g. an interrupt '
+                   'handler. Can be given multiple times')
+@click.option('--print-layout', is_flag=True,
+              help='If given the address and size of each section is printed to stderr')
+def main(inputs, output_hack, output_format, pretty_print, jobs, compat, hazard_model, optimise,
+         strip, order, entries, print_layout):
+  if compat and hazard_model not in (None, HAZARD_IDEAL):
+    raise click.UsageError('--compat can only be used with the ideal hazard model')
+
+  options = dict(compat=compat, hazard_model=hazard_model, optimise=optimise)
+  linker = Linker(load_modules(inputs, options, jobs=jobs), strip=strip, order=order,
+                  entries=entries)
+  codes = linker.link()
+
+  if output_format == FORMAT_HACK:
+    lines = [format_machine_code(code, pretty_print and not compat) for code in codes]
+    if output_hack is None:
+      sys.stdout.write('\n'.join(lines) + '\n')
+    else:
+      with open(output_hack, 'w') as fh:
+        fh.write('\n'.join(lines))
+  else:
+    write_firmware_file(output_hack, codes, output_format)
+
+  if print_layout:
+    sys.stderr.write('\nLAYOUT\n')
+    sys.stderr.write('='*(24+32+8+8+3) + '\n')
+    for name, label, base, size in linker.layout:
+      sys.stderr.write(f'{name:24s} {label:32s} {base:8d} {size:8d}\n')
+
+    if linker.stripped:
+      sys.stderr.write('\nSTRIPPED\n')
+      sys.stderr.write('='*(24+32+8+2) + '\n')
+      for name, labels, size in linker.stripped:
+        label = labels[0] if labels else ''
+        sys.stderr.write(f'{name:24s} {label:32s} {size:8d}\n')
+      total = sum(size for _, _, size in linker.stripped)
+      sys.stderr.write(f'{total} instructions stripped\n')
+
+    if linker.dropped_jumps:
+      total = sum(size for _, _, size in linker.dropped_jumps)
+      sys.stderr.write(f'\n{len(linker.dropped_jumps)} jumps to the next section dropped, saving '
+                       f'{total} instructions\n')
+
+if __name__ == '__main__':
+  main()
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def _link_sources(*sources, strip=False, order=ORDER_INPUT, entries=(), **options):
+  modules = []
+  for idx, src in enumerate(sources):
+    assembler = Assembler(input_asm=f'module{idx}.asm', **options)
+    modules.append(assembler.assemble_object(src))
+  linker = Linker(modules, strip=strip, order=order, entries=entries)
+  return linker, linker.link()
+
+MAIN_SRC = '''
+    @R0
+    D=M
+    @func_DOUBLE
+    0;JMP
+  (RETURN)
+    @RESULT
+    M=D
+  (END)
+    @END
+    0;JMP
+'''
+
+DOUBLE_SRC = '''
+  (func_DOUBLE)
+    D=D+M
+    @COUNT
+    M=M+1
+    @RETURN
+    0;JMP
+'''
+
+def test_link():
+  linker, codes = _link_sources(MAIN_SRC, DOUBLE_SRC)
+
+  # linking modules gives the same machine code as assembling them as one file
+  expected = Assembler().assemble(MAIN_SRC + DOUBLE_SRC)
+  assert codes == expected.machine_code
+  assert linker.symbols['func_DOUBLE'] == expected.known_symbols['func_DOUBLE']
+  assert linker.symbols['RESULT'] == 16
+  assert linker.symbols['COUNT'] == 17
+  assert [(name, label, base) for name, label, base, _ in linker.layout] == [
+      ('module0', '', 0), ('module0', 'RETURN', 4), ('module1', 'func_DOUBLE', 10)]
+
+def test_link_constants():
+  _, codes = _link_sources('$const kFoo 5\n@kFoo\nD=A\n@kBar\n0;JMP',
+                           '$const kBar 7\n@kFoo\n0;JMP')
+  # constants of one module can be used by the others, as when assembling a single file
+  assert codes[0] == 5
+  assert codes[2] == 7
+  assert codes[4] == 5
+
+def test_link_redefinition():
+  try:
+    _link_sources('(LOOP)\n@LOOP\n0;JMP', '(LOOP)\n@LOOP\n0;JMP')
+    assert False, 'Should have failed'
+  except NameError:
+    pass
+
+def test_link_incompatible_modules():
+  a = Assembler().assemble_object('@0\n0;JMP')
+  b = Assembler(hazard_model=HAZARD_IDEAL).assemble_object('@0\n0;JMP')
+  try:
+    Linker([a, b]).link()
+    assert False, 'Should have failed'
+  except ValueError:
+    pass
+
+def test_object_roundtrip():
+  import tempfile
+  module = Assembler().assemble_object(MAIN_SRC)
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'main.hobj')
+    module.write(path)
+    loaded = ObjectModule.read(path)
+
+  assert loaded.to_dict() == module.to_dict()
+  assert loaded.imports == ['func_DOUBLE', 'RESULT']
+
+def test_load_modules_parallel():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    paths = []
+    for name, src in (('main', MAIN_SRC), ('double', DOUBLE_SRC)):
+      path = os.path.join(tmpdir, f'{name}.asm')
+      with open(path, 'w') as fh:
+        fh.write(src)
+      paths.append(path)
+
+    # a prebuilt object is reused as is
+    obj_path = os.path.join(tmpdir, 'double.hobj')
+    Assembler(input_asm=paths[1]).assemble_object().write(obj_path)
+
+    modules = load_modules(paths + [obj_path], dict(optimise=['all']), jobs=2)
+
+  assert [module.name for module in modules] == ['main', 'double', 'double']
+  assert modules[1].labels == modules[2].labels == {'func_DOUBLE': 0}
+
+UNUSED_SRC = '''
+  (func_UNUSED)
+    @COUNT
+    M=0
+    @RETURN
+    0;JMP
+  (func_TRIPLE)
+    D=D+M
+    D=D+M
+    @RETURN
+    0;JMP
+'''
+
+def test_link_strip():
+  linker, codes = _link_sources(MAIN_SRC, UNUSED_SRC, DOUBLE_SRC, strip=True)
+
+  # neither function of the second module is used
+  assert [labels for _, labels, _ in linker.stripped] == [['func_UNUSED'], ['func_TRIPLE']]
+  assert 'func_UNUSED' not in linker.symbols
+  assert codes == Assembler().assemble(MAIN_SRC + DOUBLE_SRC).machine_code
+
+  # unless one is an entry point
+  linker, codes = _link_sources(MAIN_SRC, UNUSED_SRC, DOUBLE_SRC, strip=True,
+                                entries=['func_TRIPLE'])
+  assert [labels for _, labels, _ in linker.stripped] == [['func_UNUSED']]
+  assert linker.symbols['func_TRIPLE'] == 10
+  assert len(codes) == 10 + 5 + 6
+
+  try:
+    _link_sources(MAIN_SRC, strip=True, entries=['func_MISSING'])
+    assert False, 'Should have failed'
+  except NameError:
+    pass
+
+def test_link_call_order():
+  linker, codes = _link_sources(MAIN_SRC, UNUSED_SRC, DOUBLE_SRC, order=ORDER_CALLS)
+
+  # func_DOUBLE follows the code calling it, unused code is kept at the end in input order
+  assert [label for _, label, _, _ in linker.layout] == [
+      '', 'func_DOUBLE', 'RETURN', 'func_UNUSED', 'func_TRIPLE']
+
+  # func_DOUBLE falls through into RETURN, which loads A first, so the jump to it goes. The jump
+  # to func_DOUBLE stays as D=D+M reads the word at the address of func_DOUBLE
+  assert linker.dropped_jumps == [('module2', 'RETURN', 2)]
+  assert linker.symbols['func_DOUBLE'] == 4
+  # 5 instructions once NOPs are inserted around the write
+  assert linker.symbols['RETURN'] == 9
+  assert codes[4] == Assembler().assemble('D=D+M').machine_code[0]
+  assert codes[9] == linker.symbols['RESULT']
+
+  # M=M+1 cannot run straight before an M access so the jump after it stays
+  linker, codes = _link_sources('@R0\nM=M+1\n@func_F\n0;JMP', '(func_F)\nD=M\n(END)\n@END\n0;JMP',
+                                order=ORDER_CALLS, optimise=['all'])
+  assert linker.dropped_jumps == []
+
+def test_link_fall_through():
+  # the first module runs into the second, so they have to stay together
+  linker, codes = _link_sources('@R0\nD=M\n', '(NEXT)\n@R1\nM=D\n(END)\n@END\n0;JMP',
+                                '(func_UNUSED)\n@END\n0;JMP', strip=True, order=ORDER_CALLS)
+  assert [(name, base) for name, _, base, _ in linker.layout] == [('module0', 0),
+                                                                   ('module1', 2)]
+  assert [labels for _, labels, _ in linker.stripped] == [['func_UNUSED']]
+  assert linker.symbols['END'] == 6
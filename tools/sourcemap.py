@@ -0,0 +1,149 @@
+"""
+Source maps relating generated code back to its source without annotating the output. vm2asm.py
+maps each line of asm it writes to the VM file, line and operation it came from, and the
+assembler maps each PC to the asm file and line, chaining the map of its input if there is one,
+so a PC can be followed all the way back to the VM operation it implements.
+"""
+
+import json
+from bisect import bisect_right
+
+SOURCE_MAP_VERSION = 1
+
+class SourceMap:
+  """
+  Maps addresses, the PCs of a program or the lines of an asm file counting from 1, to the file
+  and line their code came from and a name: the func_/sub_ block for the assembler and the
+  operation for vm2asm.py. Consecutive addresses from the same place share a range, so the map of
+  a VM translation, in which each operation is many lines of asm, stays small.
+
+  parent is the source map of the file the lines refer to, if any.
+  """
+
+  def __init__(self, parent=None):
+    self.parent = parent
+
+    # sorted first addresses of each range, and the (file, line, name) of each range
+    self._starts = []
+    self._sources = []
+
+  def add(self, address, file, line, name=None):
+    """
+    Records that the code at address, and all addresses after it until the next call, came from
+    line of file. Addresses must be added in increasing order.
+    """
+    source = (file, line, name)
+    if self._sources and self._sources[-1] == source:
+      return
+    if self._starts and address <= self._starts[-1]:
+      raise ValueError(f'Address {address} added after {self._starts[-1]}')
+    self._starts.append(address)
+    self._sources.append(source)
+
+  def lookup(self, address):
+    """
+    Returns (file, line, name) of address, or None if it comes before the first range
+    """
+    idx = bisect_right(self._starts, address) - 1
+    if idx < 0:
+      return None
+    return self._sources[idx]
+
+  def resolve(self, address):
+    """
+    Returns the list of (file, line, name) address came from, following the chain of parent maps,
+    the source of address first
+    """
+    chain = []
+    source_map = self
+    while source_map is not None:
+      source = source_map.lookup(address)
+      if source is None:
+        break
+      chain.append(source)
+      address = source[1]
+      source_map = source_map.parent
+    return chain
+
+  def ranges(self):
+    """
+    Generator of (first address, file, line, name) of each range in order
+    """
+    for start, (file, line, name) in zip(self._starts, self._sources):
+      yield start, file, line, name
+
+  def __len__(self):
+    return len(self._starts)
+
+  def to_dict(self):
+    # file names and names are stored once each and referred to by index
+    strings = {}
+    def intern(s):
+      return None if s is None else strings.setdefault(s, len(strings))
+
+    ranges = [[start, intern(file), line, intern(name)] for start, file, line, name in self.ranges()]
+    d = dict(version=SOURCE_MAP_VERSION, strings=list(strings), ranges=ranges)
+    if self.parent is not None:
+      d['parent'] = self.parent.to_dict()
+    return d
+
+  @classmethod
+  def from_dict(cls, d):
+    if d.get('version') != SOURCE_MAP_VERSION:
+      raise ValueError(f'Unsupported source map version {d.get("version")}')
+
+    strings = d['strings']
+    lookup = lambda idx: None if idx is None else strings[idx]
+    source_map = cls(parent=cls.from_dict(d['parent']) if 'parent' in d else None)
+    for start, file, line, name in d['ranges']:
+      source_map.add(start, lookup(file), line, lookup(name))
+    return source_map
+
+  def write(self, path):
+    with open(path, 'w') as fh:
+      json.dump(self.to_dict(), fh, separators=(',', ':'))
+
+  @classmethod
+  def read(cls, path):
+    with open(path) as fh:
+      return cls.from_dict(json.load(fh))
+
+#################
+# HERE BE TESTS #
+# ###############
+
+def test_lookup():
+  source_map = SourceMap()
+  source_map.add(0, 'a.vm', 1, 'PUSH constant 1')
+  source_map.add(5, 'a.vm', 1, 'PUSH constant 1')
+  source_map.add(9, 'a.vm', 2, 'ADD')
+
+  # repeated sources extend the previous range
+  assert len(source_map) == 2
+  assert source_map.lookup(8) == ('a.vm', 1, 'PUSH constant 1')
+  assert source_map.lookup(100) == ('a.vm', 2, 'ADD')
+
+  source_map = SourceMap()
+  source_map.add(3, 'a.asm', 1)
+  assert source_map.lookup(2) is None
+
+def test_resolve_and_round_trip():
+  import os
+  import tempfile
+  vm_map = SourceMap()
+  vm_map.add(1, None, None)
+  vm_map.add(10, 'Main.vm', 4, 'CALL Main.f 1')
+
+  asm_map = SourceMap(parent=vm_map)
+  asm_map.add(0, 'main.asm', 2, None)
+  asm_map.add(1, 'main.asm', 12, 'func_F')
+
+  assert asm_map.resolve(1) == [('main.asm', 12, 'func_F'), ('Main.vm', 4, 'CALL Main.f 1')]
+  assert asm_map.resolve(0) == [('main.asm', 2, None), (None, None, None)]
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'main.hack.map')
+    asm_map.write(path)
+    loaded = SourceMap.read(path)
+  assert loaded.to_dict() == asm_map.to_dict()
+  assert loaded.resolve(1) == asm_map.resolve(1)
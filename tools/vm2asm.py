@@ -10,6 +10,8 @@ import click
 
 from assembler import Assembler
 from asm import ASM
+from instrument import Stats, profiled
+from sourcemap import SourceMap
 
 NAMESPACE_FILE = 'file'
 NAMESPACE_FUNCTION = 'function'
@@ -42,35 +44,69 @@ NAMESPACE_FUNCTION = 'function'
               help='When compiling multiple files into a single assembly unit this specifies'
                    'the name of the function to call after initialisation. Defaults to'
                    'Sys.init as per course specifications')
+@click.option('-m', '--source-map', type=click.Path(dir_okay=False),
+              help='If given a map of each line of the output to the VM file, line and operation '
+                   'it came from is written to this file, see sourcemap.py')
+@click.option('--stats', 'print_stats', is_flag=True,
+              help='If given the time spent in each phase of translation and counts of lines, '
+                   'operations and macros are printed to stderr')
+@click.option('--stats-json', type=click.Path(dir_okay=False),
+              help='If given the phase timings and counts are written as JSON to this file, - '
+                   'for stdout')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help='If given translation is run under cProfile and the profile written to this '
+                   'file, or the top functions printed to stderr if -')
 def main(input_vm_files, *args, **kwargs):
 
   init_function_name = kwargs.pop('init_function')
   output_file = kwargs.pop('output_asm_file')
+  print_stats = kwargs.pop('print_stats')
+  stats_json = kwargs.pop('stats_json')
+  profile = kwargs.pop('profile')
+  source_map_path = kwargs.pop('source_map')
+  source_map = SourceMap()
+
+  # shared by all translation units
+  stats = Stats(enabled=print_stats or stats_json is not None)
+  kwargs['stats'] = stats
+
+  with profiled(profile):
+    if kwargs['no_init']:
+      output_asm = ''
+    else:
+      # generate init code
+      translator = VM2ASM(*args, **kwargs)
+      translator.translate(f'call {init_function_name} 0')
+      translator.record_source_map(source_map, 1)
+      output_asm = translator.dumps() + '\n\n'
+
+    # all sub-translation units do no initialisation
+    kwargs['no_init'] = True
+
+    for vm_file in input_vm_files:
+      kwargs['input_vm'] = vm_file
+      translator = VM2ASM(*args, **kwargs)
+      translator.translate()
+      translator.record_source_map(source_map, output_asm.count('\n') + 1)
+
+      output_asm += translator.dumps()
+      output_asm += '\n\n'
+
+    with stats.phase('write'):
+      if output_file is not None:
+        with open(output_file, 'w') as fh:
+          fh.write(output_asm)
+      else:
+        print(output_asm)
 
-  if kwargs['no_init']:
-    output_asm = ''
-  else:
-    # generate init code
-    translator = VM2ASM(*args, **kwargs)
-    translator.translate(f'call {init_function_name} 0')
-    output_asm = translator.dumps() + '\n\n'
-
-  # all sub-translation units do no initialisation
-  kwargs['no_init'] = True
-
-  for vm_file in input_vm_files:
-    kwargs['input_vm'] = vm_file
-    translator = VM2ASM(*args, **kwargs)
-    translator.translate()
+      if source_map_path is not None:
+        source_map.write(source_map_path)
 
-    output_asm += translator.dumps()
-    output_asm += '\n\n'
+  if print_stats:
+    stats.print()
 
-  if output_file is not None:
-    with open(output_file, 'w') as fh:
-      fh.write(output_asm)
-  else:
-    print(output_asm)
+  if stats_json is not None:
+    stats.write_json(stats_json)
 
 class VM2ASM:
   """
@@ -107,20 +143,32 @@ class VM2ASM:
                LCL=None,
                ARG=None,
                THIS=None,
-               THAT=None):
+               THAT=None,
+               stats=None):
+    """
+    :param stats: instrument.Stats recording the time spent in each phase of translation and
+                  counts of what was translated. Nothing is timed if None.
+    """
     self._input_vm = input_vm
     self._compat = compat
     self._annotate = annotate
     self._known_symbols = dict(VM2ASM.PREDEFINED_CONSTANTS)
     self._operations = None
+    self.stats = stats if stats is not None else Stats(enabled=False)
 
     ASM.set_compat(self._compat)
 
     self.asm_output = []
+
+    # (index in asm_output, VM file, VM line, operation) of the first line of asm of each
+    # operation, see record_source_map()
+    self.source_ranges = []
+
     if annotate:
       self.asm_output.append(f'// SOURCE FILE={input_vm}')
 
     if not no_init:
+      self.source_ranges.append((len(self.asm_output), None, None, 'INIT'))
       def set_ram(addr, value):
         asm = ASM(f'''
             // setup {addr}
@@ -183,21 +231,25 @@ class VM2ASM:
     return '\n'.join(self.asm_output)
 
   def translate(self, vm_text=None):
-    if vm_text:
-      vm_lines = vm_text.splitlines()
-    else:
-      with open(self._input_vm) as fh:
-        vm_lines = fh.readlines()
+    with self.stats.phase('read'):
+      if vm_text:
+        vm_lines = vm_text.splitlines()
+      else:
+        with open(self._input_vm) as fh:
+          vm_lines = fh.readlines()
 
     if self._input_vm is not None:
       filename = self._input_vm
     else:
       filename = '<in memory>'
-    # strip whitespace and remove empty lines
+    # strip whitespace and remove empty lines, keeping the number of each line for the source map
     vm_lines = [l.strip() for l in vm_lines]
+    line_numbers = [number for number, l in enumerate(vm_lines, 1) if len(l)]
     vm_lines = [l for l in vm_lines if len(l)]
+    self.stats.count('vm_lines', len(vm_lines))
 
     operations = []
+    operation_line_numbers = []
     source_block = []
     # 1st pass, convert to Operation objects and gather
     # symbols
@@ -206,27 +258,49 @@ class VM2ASM:
     # when a function "finished". AFAICT it doesn't
     # so this really just tracks the last function operation
     # encountered
-    current_function_name = None
-    for l in vm_lines:
-      source_block.append(l)
-      op = self._parse(l, current_function_name, filename)
-      if op:
-        operations.append(op)
-
-        if type(op) == FUNCTION_Operation:
-          current_function_name = op.function_name
-
-    # 2nd pass, emit asm
-    for op in operations:
-      if self._annotate:
-        for a in op.get_annotations():
-          self.asm_output.append(f'// {a}')
+    with self.stats.phase('parse'):
+      current_function_name = None
+      for number, l in zip(line_numbers, vm_lines):
+        source_block.append(l)
+        op = self._parse(l, current_function_name, filename)
+        if op:
+          operations.append(op)
+          operation_line_numbers.append(number)
+
+          if type(op) == FUNCTION_Operation:
+            current_function_name = op.function_name
+    self.stats.count('operations', len(operations))
+
+    # 2nd pass, emit asm. Operations are resolved to ASM objects before any is expanded so the
+    # two can be timed separately
+    with self.stats.phase('resolve'):
+      resolved = [op.resolve(self._known_symbols) for op in operations]
+
+    num_lines = len(self.asm_output)
+    num_macros = ASM.MACRO_CNT
+    with self.stats.phase('expand'):
+      for op, asm, number in zip(operations, resolved, operation_line_numbers):
+        self.source_ranges.append((len(self.asm_output), filename, number,
+                                   op.get_annotations()[0]))
+        if self._annotate:
+          for a in op.get_annotations():
+            self.asm_output.append(f'// {a}')
 
-      self.asm_output += op.resolve(self._known_symbols).to_list(indent=4)
+        self.asm_output += asm.to_list(indent=4)
+    self.stats.count('asm_lines', len(self.asm_output) - num_lines)
+    self.stats.count('macros_expanded', ASM.MACRO_CNT - num_macros)
 
     # this allows chaining, e.g. self.translate().dumps()
     return self
 
+  def record_source_map(self, source_map, first_line):
+    """
+    Adds the lines of the output, which start at line first_line of the output file, to
+    source_map as the VM file, line and operation they were translated from
+    """
+    for idx, filename, number, operation in self.source_ranges:
+      source_map.add(first_line + idx, filename, number, operation)
+
   def _parse(self, source_line, current_function_name, filename):
     if '//' in source_line:
       exp, _ = source_line.split('//', 1)
@@ -1433,5 +1507,39 @@ def test_return():
   Assembler().assemble(asm)
   print(asm)
 
+def test_stats():
+  stats = Stats()
+  translator = VM2ASM(no_init=True, stats=stats)
+  translator.translate('''
+    function Main.main 1
+    push constant 1
+    pop local 0
+    ''')
+
+  assert list(stats.timers) == ['read', 'parse', 'resolve', 'expand']
+  assert stats.counters['vm_lines'] == 3
+  assert stats.counters['operations'] == 3
+  assert stats.counters['macros_expanded'] > 0
+  assert stats.counters['asm_lines'] == len(translator.asm_output)
+
+def test_source_map():
+  from sourcemap import SourceMap
+  translator = VM2ASM(no_init=True, annotate=True)
+  translator.translate('''
+    function Main.main 0
+
+    // comment
+    push constant 1
+    return
+    ''')
+  source_map = SourceMap()
+  translator.record_source_map(source_map, 3)
+
+  # each operation begins at its annotation, the output starting at line 3
+  lines = translator.dumps().split('\n')
+  assert list(source_map.ranges()) == [
+      (lines.index(f'// {operation}') + 3, '<in memory>', number, operation)
+      for number, operation in ((2, 'FUNCTION Main.main 0'), (5, 'PUSH constant 1'), (6, 'RETURN'))]
+
 if __name__ == '__main__':
   main()